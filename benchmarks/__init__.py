@@ -0,0 +1,9 @@
+"""
+Offline benchmark suite, run from the repository root with::
+
+    python -m benchmarks --output results.json
+    python -m benchmarks --compare results.json
+
+AWS services are answered in memory by the backends of benchmarks.backends,
+so no credentials nor network access are needed.
+"""
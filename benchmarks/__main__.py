@@ -0,0 +1,231 @@
+import os
+import sys
+import json
+import time
+import atexit
+import fnmatch
+import platform
+import tempfile
+import subprocess
+
+from collections import OrderedDict
+
+import click
+
+from codebuilder import __version__ as VERSION
+from codebuilder.helpers.aws import AWSHelper
+from codebuilder.helpers.base import BaseHelper
+from codebuilder.helpers.retention import RetentionPolicy, RetentionRule
+
+from .backends import ECRBackend, CodePipelineBackend
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Slowdown over the baseline (0.25 = 25% slower) reported as a regression
+DEFAULT_THRESHOLD = 0.25
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name, quick=False):
+    """
+    Registers a benchmark. The decorated function does the untimed setup
+    and returns the callable to time; it is called again for every run.
+    Quick benchmarks are the ones run by --quick.
+    """
+    def decorator(func):
+        BENCHMARKS[name] = (func, quick)
+        return func
+    return decorator
+
+
+COLD_START = """
+import sys
+from codebuilder.cli import cli
+try:
+    cli.main(sys.argv[1:], prog_name='codebuilder')
+except SystemExit:
+    pass
+"""
+
+COLD_START_COMMANDS = [
+    ['--version'],
+    ['docker', 'get-tag', 'latest'],
+    ['docker', '--image-name', 'foo/bar', 'get-image', 'latest'],
+    ['aws', 'codepipeline', 'get-revision'],
+    ['github', '--help'],
+]
+
+
+def cold_start(args):
+    environ = dict(os.environ)
+    for name in ('CODEBUILD_BUILD_ID', 'CODEBUILD_INITIATOR', 'CODEBUILDER_TRACE'):
+        environ.pop(name, None)
+    environ['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, environ.get('PYTHONPATH')]))
+    command = [sys.executable, '-c', COLD_START] + args
+    devnull = open(os.devnull, 'w')
+    return lambda: subprocess.call(command, stdout=devnull, stderr=devnull, env=environ)
+
+
+for args in COLD_START_COMMANDS:
+    benchmark('cold_start[{}]'.format(' '.join(args)), quick=True)(lambda args=args: cold_start(args))
+
+
+def ecr_prune(untagged):
+    backend = ECRBackend(untagged)
+    aws = AWSHelper()
+
+    def run():
+        deleted = sum(1 for image in aws.ecr_prune('benchmark', client=backend.client) if 'failureCode' not in image)
+        assert deleted == untagged, 'pruned {} of {} images'.format(deleted, untagged)
+    return run
+
+
+for untagged, label in [(1000, '1k'), (10000, '10k'), (50000, '50k')]:
+    benchmark('ecr_prune[{}]'.format(label), quick=untagged == 1000)(lambda untagged=untagged: ecr_prune(untagged))
+
+
+def codepipeline_lookup(**kwargs):
+    backend = CodePipelineBackend(**kwargs)
+    aws = AWSHelper()
+    aws.client = lambda service, region=None: backend.client
+
+    def run():
+        artifacts = aws._codepipeline_get_artifacts_revision('benchmark', CodePipelineBackend.BUILD_ID)
+        assert artifacts and artifacts[0]['revisionId'] == 'ab42ab42cd'
+    return run
+
+
+benchmark('codepipeline_lookup[20x50 state]', quick=True)(lambda: codepipeline_lookup(stages=20, actions=50))
+benchmark('codepipeline_lookup[100x100 state]')(lambda: codepipeline_lookup(stages=100, actions=100))
+benchmark('codepipeline_lookup[superseded]', quick=True)(lambda: codepipeline_lookup(superseded=True, history=400))
+
+
+def ecr_retention_plan(images):
+    prefixes = ['release-', 'pr-', 'feature-', 'build-']
+    details = [{
+        'imageDigest': 'sha256:{:064x}'.format(i),
+        'imageTags': ['{}{}'.format(prefixes[i % len(prefixes)], i)] if i % 10 else [],
+        'imagePushedAt': 1500000000 + i * 60,
+        'imageSizeInBytes': 1024,
+    } for i in range(images)]
+    rules = [RetentionRule(1, 'untagged', count_type='sinceImagePushed', count_number=0)]
+    rules += [RetentionRule(len(rules) + 1, 'tagged', tag_prefixes=[prefix], count_number=100) for prefix in prefixes]
+    rules.append(RetentionRule(len(rules) + 1, 'any', count_type='sinceImagePushed', count_number=30))
+    policy = RetentionPolicy(rules, protect=[r'^release-\d*0000$'])
+
+    def run():
+        expired = sum(1 for _ in policy.evaluate(iter(details)))
+        assert expired > images - 500, 'expired {} of {} images'.format(expired, images)
+    return run
+
+
+benchmark('ecr_retention_plan[10k]', quick=True)(lambda: ecr_retention_plan(10000))
+benchmark('ecr_retention_plan[100k]')(lambda: ecr_retention_plan(100000))
+
+
+def output_in_place(parameters):
+    fd, path = tempfile.mkstemp(prefix='codebuilder-benchmark-', suffix='.json')
+    os.close(fd)
+    document = {'Parameters': dict(('Parameter{:05d}'.format(i), 'value-{:05d}-'.format(i) + 'x' * 64) for i in range(parameters))}
+    with open(path, 'w') as f:
+        json.dump(document, f)
+    atexit.register(os.remove, path)
+    helper = BaseHelper()
+    values = iter(range(sys.maxsize))
+
+    def run():
+        with open(path, 'r+') as f:
+            helper.output('foo/bar:{}'.format(next(values)), 'json', ['Parameters', 'DockerImage'], f, in_place=True)
+    return run
+
+
+benchmark('output_in_place[5k parameters]', quick=True)(lambda: output_in_place(5000))
+benchmark('output_in_place[50k parameters]')(lambda: output_in_place(50000))
+
+
+def run_benchmarks(names, repeat=3):
+    """
+    Runs the benchmarks named, returning for each the best of repeat runs.
+    """
+    results = OrderedDict()
+    for name in names:
+        setup, _ = BENCHMARKS[name]
+        timings = []
+        for _ in range(repeat):
+            run = setup()
+            start = time.time()
+            run()
+            timings.append(time.time() - start)
+        results[name] = {'seconds': min(timings), 'repeat': repeat}
+    return results
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Yields (name, baseline seconds, seconds, change, regressed) for the
+    benchmarks found in both result sets, change being relative.
+    """
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['seconds'], result['seconds']
+        change = (after - before) / before if before else 0.0
+        yield name, before, after, change, change > threshold
+
+
+def select(patterns, quick):
+    names = [name for name, (_, is_quick) in BENCHMARKS.items() if is_quick or not quick]
+    if patterns:
+        names = [name for name in names if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)]
+    return names
+
+
+@click.command()
+@click.option('-k', '--select', 'patterns', multiple=True, help='Only run benchmarks matching this shell-style pattern')
+@click.option('--quick', is_flag=True, help='Only run the small benchmarks')
+@click.option('--repeat', type=int, default=3, help='Runs per benchmark, the best is kept')
+@click.option('--output', type=click.Path(dir_okay=False, allow_dash=True), help='Write results as JSON (- for stdout)')
+@click.option('--compare', 'baseline_file', type=click.File('r'), help='Baseline results to compare with')
+@click.option('--threshold', type=float, default=DEFAULT_THRESHOLD, help='Relative slowdown reported as a regression')
+@click.option('--list', 'list_only', is_flag=True, help='List benchmarks and exit')
+def main(patterns, quick, repeat, output, baseline_file, threshold, list_only):
+    """Offline benchmarks of codebuilder with stubbed AWS backends"""
+    names = select(patterns, quick)
+    if list_only:
+        for name in names:
+            click.echo(name)
+        return
+
+    results = OrderedDict()
+    for name in names:
+        results.update(run_benchmarks([name], repeat))
+        click.echo('{:<56} {:>10.4f}s'.format(name, results[name]['seconds']), err=True)
+
+    if output:
+        document = {
+            'version': VERSION,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'benchmarks': results
+        }
+        with click.open_file(output, 'w') as f:
+            json.dump(document, f, indent=2)
+            f.write('\n')
+
+    if baseline_file:
+        baseline = json.load(baseline_file)['benchmarks']
+        regressions = 0
+        click.echo('{:<56} {:>10} {:>10} {:>8}'.format('benchmark', 'baseline', 'current', 'change'), err=True)
+        for name, before, after, change, regressed in compare(results, baseline, threshold):
+            regressions += regressed
+            click.echo('{:<56} {:>9.4f}s {:>9.4f}s {:>+7.1%}{}'.format(
+                name, before, after, change, '  REGRESSION' if regressed else ''
+            ), err=True)
+        if regressions:
+            click.echo('{} regression(s) over {:.0%}'.format(regressions, threshold), err=True)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(prog_name='python -m benchmarks')
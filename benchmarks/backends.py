@@ -0,0 +1,136 @@
+import json
+import threading
+
+from collections import Counter
+
+import boto3
+
+from botocore import xform_name
+from botocore.awsrequest import AWSResponse
+
+REGION = 'eu-west-1'
+
+
+class StubbedBackend(object):
+    """
+    Answers the API calls of a real boto3 client in memory, dispatching on
+    the operation name to methods of the backend (describe_images for
+    DescribeImages).
+
+    Calls go through botocore parameter validation and serialization, like
+    with botocore's Stubber, but responses are computed rather than queued
+    in call order, so paginators and worker threads can share the client.
+    Only JSON protocol services are supported.
+    """
+
+    service = None
+
+    def __init__(self):
+        session = boto3.Session(region_name=REGION, aws_access_key_id='benchmark', aws_secret_access_key='benchmark')
+        self.client = session.client(self.service)
+        self.client.meta.events.register_first('before-call.*.*', self._answer)
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def _answer(self, model, params, **kwargs):
+        operation = xform_name(model.name)
+        with self.lock:
+            self.calls[operation] += 1
+        body = params.get('body') or b'{}'
+        parsed = getattr(self, operation)(**json.loads(body.decode('utf-8')))
+        parsed['ResponseMetadata'] = {'HTTPStatusCode': 200, 'RetryAttempts': 0}
+        return AWSResponse(params.get('url'), 200, {}, None), parsed
+
+
+class ECRBackend(StubbedBackend):
+    """
+    A repository holding untagged images of 1 KiB.
+    """
+
+    service = 'ecr'
+
+    def __init__(self, untagged):
+        super(ECRBackend, self).__init__()
+        self.digests = ['sha256:{:064x}'.format(i) for i in range(untagged)]
+        self.images = set(self.digests)
+
+    def describe_images(self, repositoryName, filter=None, maxResults=100, nextToken=None):
+        start = int(nextToken or 0)
+        page = self.digests[start:start + maxResults]
+        response = {'imageDetails': [
+            {'repositoryName': repositoryName, 'imageDigest': digest, 'imageSizeInBytes': 1024}
+            for digest in page if digest in self.images
+        ]}
+        if start + maxResults < len(self.digests):
+            response['nextToken'] = str(start + maxResults)
+        return response
+
+    def batch_delete_image(self, repositoryName, imageIds):
+        response = {'imageIds': [], 'failures': []}
+        with self.lock:
+            for image_id in imageIds:
+                if image_id['imageDigest'] in self.images:
+                    self.images.discard(image_id['imageDigest'])
+                    response['imageIds'].append(image_id)
+                else:
+                    response['failures'].append({'imageId': image_id, 'failureCode': 'ImageNotFound', 'failureReason': 'Requested image not found'})
+        return response
+
+
+class CodePipelineBackend(StubbedBackend):
+    """
+    A pipeline of stages x actions CodeBuild actions. The build looked up
+    runs the last action of the last stage or, when superseded, only shows
+    up in the action executions history after `history` newer ones.
+    """
+
+    service = 'codepipeline'
+
+    BUILD_ID = 'build:benchmark'
+    EXECUTION_ID = 'execution-benchmark'
+
+    def __init__(self, stages=20, actions=50, superseded=False, history=400):
+        super(CodePipelineBackend, self).__init__()
+        self.stages = stages
+        self.actions = actions
+        self.superseded = superseded
+        self.history = history
+
+    def get_pipeline_state(self, name):
+        stage_states = []
+        for stage in range(self.stages):
+            action_states = [{
+                'actionName': 'Build{}'.format(action),
+                'latestExecution': {'status': 'Succeeded', 'externalExecutionId': 'build:{}-{}'.format(stage, action)}
+            } for action in range(self.actions)]
+            stage_states.append({
+                'stageName': 'Stage{}'.format(stage),
+                'latestExecution': {'pipelineExecutionId': 'execution-{}'.format(stage), 'status': 'Succeeded'},
+                'actionStates': action_states
+            })
+        if not self.superseded:
+            stage_states[-1]['latestExecution']['pipelineExecutionId'] = self.EXECUTION_ID
+            stage_states[-1]['actionStates'][-1]['latestExecution']['externalExecutionId'] = self.BUILD_ID
+        return {'pipelineName': name, 'stageStates': stage_states}
+
+    def list_action_executions(self, pipelineName, maxResults=100, nextToken=None):
+        start = int(nextToken or 0)
+        details = []
+        for index in range(start, min(start + maxResults, self.history + 1)):
+            found = index == self.history
+            details.append({
+                'pipelineExecutionId': self.EXECUTION_ID if found else 'execution-old-{}'.format(index),
+                'actionName': 'Build',
+                'output': {'executionResult': {'externalExecutionId': self.BUILD_ID if found else 'build:old-{}'.format(index)}}
+            })
+        response = {'actionExecutionDetails': details}
+        if start + maxResults <= self.history:
+            response['nextToken'] = str(start + maxResults)
+        return response
+
+    def get_pipeline_execution(self, pipelineName, pipelineExecutionId):
+        return {'pipelineExecution': {
+            'pipelineName': pipelineName,
+            'pipelineExecutionId': pipelineExecutionId,
+            'artifactRevisions': [{'name': 'MyApp', 'revisionId': 'ab42ab42cd'}]
+        }}
@@ -1,20 +1,95 @@
 from . import __version__ as VERSION
 
+import time
+import importlib
 import click
 
-@click.group()
+from .helpers.trace import TRACER
+
+
+class LazyGroup(click.Group):
+    """
+    Click group whose subcommands are only imported when they are dispatched.
+
+    ``lazy_commands`` maps a command name to a ``'module:attribute'`` string.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.lazy_commands = kwargs.pop('lazy_commands', {})
+        super(LazyGroup, self).__init__(*args, **kwargs)
+
+    def list_commands(self, ctx):
+        commands = super(LazyGroup, self).list_commands(ctx)
+        return sorted(set(commands) | set(self.lazy_commands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.commands and cmd_name in self.lazy_commands:
+            module_name, attribute = self.lazy_commands[cmd_name].split(':')
+            with TRACER.span('import ' + module_name, 'import'):
+                module = importlib.import_module(module_name)
+            self.add_command(getattr(module, attribute), cmd_name)
+        return super(LazyGroup, self).get_command(ctx, cmd_name)
+
+    def invoke(self, ctx):
+        # Consumed before the group callback runs, kept to name trace spans
+        ctx.meta['COMMAND_ARGS'] = ctx.protected_args + ctx.args
+        return super(LazyGroup, self).invoke(ctx)
+
+
+@click.group(cls=LazyGroup, lazy_commands={
+    'aws': 'codebuilder.subcommands.aws:aws',
+    'docker': 'codebuilder.subcommands.docker:docker',
+    'env': 'codebuilder.subcommands.env:env',
+    'github': 'codebuilder.subcommands.github:github',
+    'run': 'codebuilder.subcommands.run:run',
+    'serve': 'codebuilder.subcommands.serve:serve',
+})
 @click.version_option(VERSION)
 @click.option('--verbose', is_flag=True, help='Enable verbose mode')
+@click.option('--no-cache', is_flag=True, envvar='CODEBUILDER_NO_CACHE', help='Do not use cached AWS lookups')
+@click.option('--max-pool-connections', type=int, envvar='CODEBUILDER_MAX_POOL_CONNECTIONS', help='HTTP connections per AWS client')
+@click.option('--retry-mode', type=click.Choice(['legacy', 'standard', 'adaptive']), envvar='CODEBUILDER_RETRY_MODE', help='botocore retry mode')
+@click.option('--max-attempts', type=int, envvar='CODEBUILDER_MAX_ATTEMPTS', help='Maximum attempts per AWS call')
+@click.option('--connect-timeout', type=float, envvar='CODEBUILDER_CONNECT_TIMEOUT', help='AWS connect timeout (seconds)')
+@click.option('--read-timeout', type=float, envvar='CODEBUILDER_READ_TIMEOUT', help='AWS read timeout (seconds)')
+@click.option('--tcp-keepalive/--no-tcp-keepalive', default=None, envvar='CODEBUILDER_TCP_KEEPALIVE', help='TCP keepalive on AWS connections')
+@click.option('--trace', type=click.Path(dir_okay=False, allow_dash=True), envvar='CODEBUILDER_TRACE', help='Append timing spans to this file (- for stderr)')
+@click.option('--trace-format', type=click.Choice(['chrome', 'summary']), default='chrome', envvar='CODEBUILDER_TRACE_FORMAT', help='Chrome trace events or a summary table')
 @click.pass_context
-def cli(ctx, verbose):
+def cli(ctx, verbose, no_cache, trace, trace_format, **client_options):
     """CLI helper for AWS CodeBuild and CodePipeline"""
     ctx.meta['VERBOSE'] = verbose
+    ctx.meta['NO_CACHE'] = no_cache
+    ctx.meta['AWS_CLIENT_OPTIONS'] = dict((k, v) for k, v in client_options.items() if v is not None)
+    if trace:
+        start_tracing(ctx, trace, trace_format)
     pass
 
-from .subcommands.aws import aws
-from .subcommands.docker import docker
-from .subcommands.github import github
 
-cli.add_command(aws)
-cli.add_command(docker)
-cli.add_command(github)
+def command_name(ctx):
+    """
+    Returns the path of the subcommand invoked, leaving out arguments and
+    option values which may be secrets.
+    """
+    names = ['codebuilder']
+    command = ctx.command
+    for arg in ctx.meta.get('COMMAND_ARGS', []):
+        if not isinstance(command, click.MultiCommand):
+            break
+        subcommand = command.get_command(ctx, arg)
+        if subcommand is not None:
+            names.append(arg)
+            command = subcommand
+    return ' '.join(names)
+
+
+def start_tracing(ctx, path, format):
+    start = time.time()
+    TRACER.enable()
+
+    def stop_tracing():
+        TRACER.add(command_name(ctx), 'command', start, time.time())
+        TRACER.write(path, format)
+        TRACER.disable()
+
+    ctx.call_on_close(stop_tracing)
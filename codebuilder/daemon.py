@@ -0,0 +1,290 @@
+"""
+Optional resident mode: ``codebuilder serve`` keeps an interpreter with its
+imports, boto3 clients and connections warm on a unix socket, and the
+``codebuilder`` entry point forwards its argv, environment, working
+directory and umask to it. Without a daemon, commands run in-process.
+
+This module is imported by every invocation, so the client side only uses
+the standard library and defers everything else to the server side.
+"""
+import io
+import os
+import sys
+import json
+import stat
+import socket
+import struct
+
+from . import __version__ as VERSION
+
+DEFAULT_IDLE_TIMEOUT = 900
+
+# Response frames: stream id + length. A daemon from another version
+# rejects the request before running anything, so the client can run it.
+FRAME_HEADER = struct.Struct('>BI')
+EXIT, STDOUT, STDERR, REJECTED = 0, 1, 2, 3
+
+
+def socket_path():
+    path = os.getenv('CODEBUILDER_SOCKET')
+    if path:
+        return path
+    directory = os.getenv('XDG_RUNTIME_DIR') or os.getenv('TMPDIR') or '/tmp'
+    return os.path.join(directory, 'codebuilder-{}.sock'.format(os.getuid()))
+
+
+def should_forward(argv, environ):
+    """
+    Commands reading stdin ('-' file arguments), shell completion and the
+    daemon itself always run in-process.
+    """
+    return not (
+        environ.get('CODEBUILDER_NO_DAEMON')
+        or '_CODEBUILDER_COMPLETE' in environ
+        or argv[:1] == ['serve']
+        or '-' in argv
+    )
+
+
+def _binary(stream):
+    return getattr(stream, 'buffer', stream)
+
+
+def _read_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def trusted_socket(path):
+    """
+    Tells whether path is a unix socket owned by the current user, the only
+    kind of socket the environment (credentials included) is sent to.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+
+def _peer_uid(sock):
+    """
+    Returns the uid of the process listening on the other end of sock, or
+    None where SO_PEERCRED is not available.
+    """
+    option = getattr(socket, 'SO_PEERCRED', None)
+    if option is None:
+        return None
+    credentials = struct.Struct('3i')
+    pid, uid, gid = credentials.unpack(sock.getsockopt(socket.SOL_SOCKET, option, credentials.size))
+    return uid
+
+
+def forward(argv, path=None, stdout=None, stderr=None):
+    """
+    Runs argv in the daemon listening on path, copying its output to the
+    binary stdout and stderr streams. Returns the exit status, or None when
+    no daemon (of this version, run by the current user) is listening.
+    """
+    stdout = stdout or _binary(sys.stdout)
+    stderr = stderr or _binary(sys.stderr)
+    path = path or socket_path()
+    if not trusted_socket(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        uid = _peer_uid(sock)
+    except socket.error:
+        sock.close()
+        return None
+    if uid is not None and uid != os.getuid():
+        sock.close()
+        return None
+
+    umask = os.umask(0)
+    os.umask(umask)
+    request = {
+        'version': VERSION,
+        'argv': argv,
+        'env': dict(os.environ),
+        'cwd': os.getcwd(),
+        'umask': umask,
+        'encoding': getattr(sys.stdout, 'encoding', None) or 'utf-8'
+    }
+    try:
+        sock.sendall(json.dumps(request).encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        while True:
+            header = _read_exactly(sock, FRAME_HEADER.size)
+            if header is None:
+                stderr.write(b'codebuilder daemon closed the connection\n')
+                return 1
+            stream, size = FRAME_HEADER.unpack(header)
+            data = _read_exactly(sock, size) if size else b''
+            if stream == EXIT:
+                return int(data)
+            if stream == REJECTED:
+                return None
+            target = stdout if stream == STDOUT else stderr
+            target.write(data)
+            target.flush()
+    finally:
+        sock.close()
+
+
+def main():
+    argv = sys.argv[1:]
+    if should_forward(argv, os.environ):
+        status = forward(argv)
+        if status is not None:
+            sys.exit(status)
+
+    from .cli import cli
+    cli()
+
+
+class FrameWriter(io.RawIOBase):
+
+    def __init__(self, sock, stream):
+        self._sock = sock
+        self._stream = stream
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        if data:
+            self._sock.sendall(FRAME_HEADER.pack(self._stream, len(data)) + data)
+        return len(data)
+
+
+def _exit_status(code, stderr):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    stderr.write('{}\n'.format(code))
+    return 1
+
+
+class Server(object):
+    """
+    Runs forwarded commands one at a time (environment and working
+    directory are process-wide) and exits after idle_timeout seconds
+    without a request.
+    """
+
+    def __init__(self, path=None, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.path = path or socket_path()
+        self.idle_timeout = idle_timeout
+        self._credentials = None
+
+    def bind(self):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except socket.error:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        else:
+            raise RuntimeError('a codebuilder daemon is already listening on {}'.format(self.path))
+        finally:
+            probe.close()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        listener.listen(16)
+        listener.settimeout(self.idle_timeout)
+        return listener
+
+    def serve_forever(self, listener=None):
+        listener = listener or self.bind()
+        try:
+            while True:
+                try:
+                    connection, _ = listener.accept()
+                except socket.timeout:
+                    break
+                try:
+                    connection.settimeout(None)
+                    self.handle(connection)
+                except socket.error:
+                    pass
+                finally:
+                    connection.close()
+        finally:
+            listener.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def handle(self, connection):
+        data = b''
+        while True:
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        try:
+            request = json.loads(data.decode('utf-8'))
+        except ValueError:
+            return
+        if request.get('version') != VERSION:
+            connection.sendall(FRAME_HEADER.pack(REJECTED, 0))
+            return
+        status = str(self.run(request, connection)).encode('ascii')
+        connection.sendall(FRAME_HEADER.pack(EXIT, len(status)) + status)
+
+    def _stream(self, connection, stream, encoding):
+        return io.TextIOWrapper(FrameWriter(connection, stream), encoding=encoding, write_through=True)
+
+    def _reset_clients(self, environ):
+        # Clients keep the credentials resolved from the first environment
+        from .helpers.clients import CLIENTS
+
+        credentials = sorted((k, v) for k, v in environ.items() if k.startswith('AWS_'))
+        if credentials != self._credentials:
+            CLIENTS.clear()
+            self._credentials = credentials
+
+    def run(self, request, connection):
+        import traceback
+        from .cli import cli
+
+        stdout = self._stream(connection, STDOUT, request['encoding'])
+        stderr = self._stream(connection, STDERR, request['encoding'])
+        saved = (dict(os.environ), os.getcwd(), sys.stdout, sys.stderr)
+        umask = os.umask(request['umask'])
+        try:
+            sys.stdout, sys.stderr = stdout, stderr
+            try:
+                os.environ.clear()
+                os.environ.update(request['env'])
+                os.chdir(request['cwd'])
+                self._reset_clients(os.environ)
+                cli.main(request['argv'], prog_name='codebuilder')
+                status = 0
+            except SystemExit as e:
+                status = _exit_status(e.code, stderr)
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            stdout.flush()
+            stderr.flush()
+        finally:
+            environ, cwd, sys.stdout, sys.stderr = saved
+            os.environ.clear()
+            os.environ.update(environ)
+            os.chdir(cwd)
+            os.umask(umask)
+        return status
@@ -1,23 +1,103 @@
 import os
+import re
+import time
+import fnmatch
 import click
-import boto3
-import botocore
-import dpath.util
+import hashlib
+import calendar
+import subprocess
 
-import botocore.vendored.requests.packages.urllib3 as urllib3
-urllib3.disable_warnings(urllib3.exceptions.SecurityWarning)
+from base64 import b64decode, b64encode
 
-from base64 import b64decode
+from .base import BaseHelper, memoized
+from . import dockerconfig
+from .parallel import chunked, imap_bounded
+from .clients import CLIENTS
+from .s3cache import S3Cache
+from .trace import TRACER
 
-from .base import BaseHelper
+ECR_REGISTRY_RE = re.compile(r'^(?P<registry_id>\d{12})\.dkr\.ecr\.(?P<region>[a-z0-9-]+)\.amazonaws\.com(\.cn)?$')
+
+# Pages of 100 action executions searched when the pipeline state misses a build
+CODEPIPELINE_SEARCH_MAX_PAGES = 5
+CODEPIPELINE_SEARCH_PAGE_SIZE = 100
+
+# ECR tokens are valid 12 hours, stop reusing them a bit before they expire
+ECR_TOKEN_EXPIRY_MARGIN = 900
+
+# batch_delete_image accepts at most 100 image ids per call
+ECR_BATCH_DELETE_SIZE = 100
+ECR_DELETE_MAX_ATTEMPTS = 4
+ECR_DELETE_RETRY_DELAY = 0.5
+ECR_DELETE_PERMANENT_FAILURES = (
+    'InvalidImageDigest',
+    'InvalidImageTag',
+    'ImageTagDoesNotMatchDigest',
+    'ImageNotFound',
+    'MissingDigestAndTag',
+)
+
+# batch_get_image accepts at most 100 image ids per call
+ECR_BATCH_GET_SIZE = 100
+
+# get_parameters accepts at most 10 names per call
+SSM_GET_PARAMETERS_SIZE = 10
+
+# Manifests are copied as pushed, not converted by batch_get_image
+ECR_MANIFEST_MEDIA_TYPES = [
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.docker.distribution.manifest.v1+prettyjws',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json',
+]
+
+
+def codepipeline_index_state(state):
+    """
+    Maps the externalExecutionId of every action latest execution (the build
+    id for CodeBuild actions) to the pipelineExecutionId of its stage.
+    """
+    index = {}
+    for stage_state in state.get('stageStates', []):
+        pipeline_execution_id = stage_state.get('latestExecution', {}).get('pipelineExecutionId')
+        if not pipeline_execution_id:
+            continue
+        for action_state in stage_state.get('actionStates', []):
+            external_execution_id = action_state.get('latestExecution', {}).get('externalExecutionId')
+            if external_execution_id:
+                index.setdefault(external_execution_id, pipeline_execution_id)
+    return index
+
+
+def ecr_split_image(image):
+    """
+    Splits an ECR image 'registry/repository:tag' into (registry id, region,
+    repository, tag), or returns None for images of other registries.
+    """
+    registry, _, rest = image.partition('/')
+    match = ECR_REGISTRY_RE.match(registry)
+    repository, sep, tag = rest.rpartition(':')
+    if not match or not sep or not repository:
+        return None
+    return (match.group('registry_id'), match.group('region'), repository, tag)
 
 
 # TODO: Better permissions checking
 class AWSHelper(BaseHelper):
 
-    def __init__(self):
-        self._session = boto3.session.Session()
+    @property
+    def _session(self):
+        return CLIENTS.session()
 
+    def client(self, service, region=None):
+        """
+        Returns the process-wide client for service, configured from the
+        command line botocore options.
+        """
+        return CLIENTS.client(service, region=region, options=self._meta.get('AWS_CLIENT_OPTIONS'), counters=self.counters)
+
+    @memoized
     def codepipeline_get_artifacts_revision(self):
         CODEBUILD_BUILD_ID = os.getenv('CODEBUILD_BUILD_ID')
         CODEBUILD_INITIATOR = os.getenv('CODEBUILD_INITIATOR')
@@ -26,14 +106,25 @@ class AWSHelper(BaseHelper):
             return None
 
         (service, pipeline_name) = CODEBUILD_INITIATOR.split('/')
-        client = self._session.client('codepipeline')
-        response = client.get_pipeline_state(name=pipeline_name)
+        cache = self.get_cache('codepipeline')
+        if cache is None:
+            return self._codepipeline_get_artifacts_revision(pipeline_name, CODEBUILD_BUILD_ID)
+        return cache.get_or_set(
+            [CODEBUILD_BUILD_ID, pipeline_name],
+            lambda: self._codepipeline_get_artifacts_revision(pipeline_name, CODEBUILD_BUILD_ID)
+        )
 
-        pipeline_execution_id = None
-        for stage_state in response['stageStates']:
-            if CODEBUILD_BUILD_ID in dpath.util.values(stage_state, '/actionStates/*/latestExecution/externalExecutionId'):
-                pipeline_execution_id = stage_state['latestExecution']['pipelineExecutionId']
-                break
+    def _codepipeline_get_artifacts_revision(self, pipeline_name, build_id):
+        client = self.client('codepipeline')
+
+        with self.timed('codepipeline.state'):
+            response = client.get_pipeline_state(name=pipeline_name)
+            self.count('codepipeline.state.calls')
+            pipeline_execution_id = codepipeline_index_state(response).get(build_id)
+
+        if not pipeline_execution_id:
+            with self.timed('codepipeline.search'):
+                pipeline_execution_id = self._codepipeline_search_execution(client, pipeline_name, build_id)
 
         if not pipeline_execution_id:
             return None
@@ -45,6 +136,24 @@ class AWSHelper(BaseHelper):
 
         return response['pipelineExecution']['artifactRevisions']
 
+    def _codepipeline_search_execution(self, client, pipeline_name, build_id):
+        """
+        Looks build_id up in the most recent action executions of the
+        pipeline, for builds whose execution was replaced in the pipeline
+        state by a newer one. Stops after CODEPIPELINE_SEARCH_MAX_PAGES.
+        """
+        pages = client.get_paginator('list_action_executions').paginate(
+            pipelineName=pipeline_name,
+            PaginationConfig={'MaxItems': CODEPIPELINE_SEARCH_MAX_PAGES * CODEPIPELINE_SEARCH_PAGE_SIZE, 'PageSize': CODEPIPELINE_SEARCH_PAGE_SIZE}
+        )
+        for page in pages:
+            self.count('codepipeline.search.calls')
+            for detail in page.get('actionExecutionDetails', []):
+                execution_result = detail.get('output', {}).get('executionResult', {})
+                if execution_result.get('externalExecutionId') == build_id:
+                    return detail['pipelineExecutionId']
+        return None
+
     def codepipeline_get_artifact_attribute(self, name, attribute):
         artifacts = self.codepipeline_get_artifacts_revision()
         if not artifacts:
@@ -58,27 +167,442 @@ class AWSHelper(BaseHelper):
         return None
 
     def ecr_get_authorization(self):
-        client = self._session.client('ecr')
-        response = client.get_authorization_token()
-        user, token = b64decode(response['authorizationData'][0]['authorizationToken']).split(':')
-        return (user, token, response['authorizationData'][0]['proxyEndpoint'])
-
-    def ecr_prune(self, repository_name):
-        client = self._session.client('ecr')
-        response = client.list_images(
-            repositoryName=repository_name,
-            filter={
-                'tagStatus': 'UNTAGGED'
-            }
+        authorization = self.ecr_get_authorizations()[0]
+        return (authorization['user'], authorization['token'], authorization['proxyEndpoint'])
+
+    def ecr_get_authorizations(self, region=None, registry_ids=None):
+        """
+        Returns the authorizations (user, token, proxyEndpoint and expiresAt)
+        for registry_ids (default: own account) in region, cached until the
+        first one nears expiry.
+        """
+        registry_ids = sorted(registry_ids or [])
+        cache = self.get_cache('ecr')
+        if cache is None:
+            return self._ecr_get_authorizations(region, registry_ids)
+        session = self._session
+        return cache.get_or_set(
+            [region or session.region_name, session.profile_name, os.getenv('AWS_ACCESS_KEY_ID')] + registry_ids,
+            lambda: self._ecr_get_authorizations(region, registry_ids),
+            ttl=lambda authorizations: min(a['expiresAt'] for a in authorizations) - time.time() - ECR_TOKEN_EXPIRY_MARGIN
         )
-        images_to_delete = response['imageIds']
-        if images_to_delete:
+
+    def _ecr_get_authorizations(self, region, registry_ids):
+        client = self.client('ecr', region=region)
+        if registry_ids:
+            response = client.get_authorization_token(registryIds=registry_ids)
+        else:
+            response = client.get_authorization_token()
+        authorizations = []
+        for data in response['authorizationData']:
+            user, token = b64decode(data['authorizationToken']).decode('utf-8').split(':', 1)
+            authorizations.append({
+                'user': user,
+                'token': token,
+                'proxyEndpoint': data['proxyEndpoint'],
+                'expiresAt': calendar.timegm(data['expiresAt'].utctimetuple())
+            })
+        return authorizations
+
+    def ecr_login(self, regions=None, registry_ids=None, force=False, workers=4):
+        """
+        Logs docker in to registry_ids (default: own account) in every region
+        (default: default region) and returns one result per registry:
+        proxyEndpoint, tokenTime and loginTime in seconds, current (docker
+        already held the credentials) and error.
+
+        Tokens are fetched concurrently, one call per region. Credentials
+        docker keeps inline in its config are all written in a single atomic
+        update of that file; with a credentials store, docker login runs
+        concurrently for each registry.
+        """
+        def authorize(region):
+            start = time.time()
+            authorizations = self.ecr_get_authorizations(region, registry_ids)
+            return [dict(a, tokenTime=time.time() - start, loginTime=0.0, current=False, error=None) for a in authorizations]
+
+        results = [r for batch in imap_bounded(authorize, list(regions or [None]), workers) for r in batch]
+        pending = [r for r in results if force or not self.ecr_docker_login_is_current(r['user'], r['token'], r['proxyEndpoint'])]
+        for result in results:
+            result['current'] = not any(result is r for r in pending)
+
+        config = dockerconfig.load_config()
+        inline = [r for r in pending if not dockerconfig.uses_credentials_store(r['proxyEndpoint'], config)]
+        stored = [r for r in pending if dockerconfig.uses_credentials_store(r['proxyEndpoint'], config)]
+        if inline:
+            start = time.time()
+            dockerconfig.store_credentials(dict((r['proxyEndpoint'], (r['user'], r['token'])) for r in inline))
+            for result in inline:
+                result['loginTime'] = time.time() - start
+
+        def docker_login(result):
+            start = time.time()
+            with TRACER.span('docker login', 'subprocess', registry=result['proxyEndpoint']):
+                process = subprocess.Popen(
+                    ['docker', 'login', '-u', result['user'], '-p', result['token'], result['proxyEndpoint']],
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+                )
+                output = process.communicate()[0]
+            result['loginTime'] = time.time() - start
+            if process.returncode != 0:
+                result['error'] = output.decode('utf-8', 'replace').strip() or 'docker login exited with {}'.format(process.returncode)
+            return result
+
+        list(imap_bounded(docker_login, stored, workers))
+
+        for result in pending:
+            if not result['error']:
+                self.ecr_record_docker_login(result['user'], result['token'], result['proxyEndpoint'])
+        return results
+
+    def ecr_docker_login_is_current(self, user, token, endpoint):
+        """
+        Tells whether docker already holds these credentials for endpoint,
+        either inline in its config or, with a credentials store, as recorded
+        by ecr_record_docker_login.
+        """
+        config = dockerconfig.load_config()
+        if dockerconfig.get_auth_entry(endpoint, config) is None:
+            return False
+        credentials = dockerconfig.get_credentials(endpoint, config)
+        if credentials is not None:
+            return credentials == (user, token)
+        cache = self.get_cache('docker-login')
+        return cache is not None and cache.get(endpoint) == self.__fingerprint(user, token)
+
+    def ecr_record_docker_login(self, user, token, endpoint):
+        cache = self.get_cache('docker-login')
+        if cache is not None:
+            cache.set(endpoint, self.__fingerprint(user, token), ttl=12 * 3600)
+
+    def __fingerprint(self, user, token):
+        return hashlib.sha256('{}:{}'.format(user, token).encode('utf-8')).hexdigest()
+
+    def ecr_prune(self, repository_name, workers=4, client=None, policy=None, dry_run=False):
+        """
+        Deletes untagged images of repository_name, or the images a
+        RetentionPolicy expires, and yields one result per image as soon as
+        its batch completes: the imageId with its imageSizeInBytes on success,
+        or with failureCode and failureReason. With dry_run, nothing is
+        deleted and the image details to delete are yielded instead, with the
+        rulePriority of the rule expiring them.
+
+        Listing is paginated and feeds batches of ECR_BATCH_DELETE_SIZE image
+        ids to workers threads, so memory does not grow with the repository.
+        """
+        client = client or self.client('ecr')
+        params = {'repositoryName': repository_name}
+        if policy is None or policy.untagged_only:
+            params['filter'] = {'tagStatus': 'UNTAGGED'}
+        pages = client.get_paginator('describe_images').paginate(**params)
+        images = (image for page in pages for image in page['imageDetails'])
+        if policy is not None:
+            images = (dict(image, rulePriority=rule.priority) for image, rule in policy.evaluate(images))
+        if dry_run:
+            for image in images:
+                yield image
+            return
+        batches = chunked(images, ECR_BATCH_DELETE_SIZE)
+        delete = lambda batch: self._ecr_delete_images(client, repository_name, batch)
+        for results in imap_bounded(delete, batches, workers):
+            for result in results:
+                yield result
+
+    def _ecr_delete_images(self, client, repository_name, images):
+        sizes = dict((image['imageDigest'], image.get('imageSizeInBytes', 0)) for image in images)
+        image_ids = [{'imageDigest': image['imageDigest']} for image in images]
+        results = []
+        for attempt in range(ECR_DELETE_MAX_ATTEMPTS):
+            if attempt:
+                time.sleep(ECR_DELETE_RETRY_DELAY * 2 ** (attempt - 1))
             response = client.batch_delete_image(
                 repositoryName=repository_name,
-                imageIds=images_to_delete
+                imageIds=image_ids
             )
-            return response['imageIds']
-        return []
+            for image_id in response.get('imageIds', []):
+                results.append(dict(image_id, imageSizeInBytes=sizes.get(image_id.get('imageDigest'), 0)))
+            image_ids = []
+            for failure in response.get('failures', []):
+                if failure.get('failureCode') in ECR_DELETE_PERMANENT_FAILURES or attempt + 1 == ECR_DELETE_MAX_ATTEMPTS:
+                    results.append(dict(failure['imageId'], failureCode=failure.get('failureCode'), failureReason=failure.get('failureReason')))
+                else:
+                    image_ids.append(failure['imageId'])
+            if not image_ids:
+                break
+        return results
+
+    def ecr_list_repositories(self, pattern=None, client=None):
+        """
+        Yields the names of the registry repositories matching the shell-style
+        pattern, or all of them.
+        """
+        client = client or self.client('ecr')
+        for page in client.get_paginator('describe_repositories').paginate():
+            for repository in page['repositories']:
+                if pattern is None or fnmatch.fnmatchcase(repository['repositoryName'], pattern):
+                    yield repository['repositoryName']
+
+    def ecr_prune_repositories(self, repository_names, workers=4, client=None, policy=None, dry_run=False):
+        """
+        Prunes repositories concurrently, one repository per worker thread,
+        all sharing one ECR client, and yields a summary per repository as it
+        completes: repositoryName, deleted, reclaimedBytes and the failures.
+        With dry_run, deleted and reclaimedBytes are those of the plan.
+        """
+        client = client or self.client('ecr')
+
+        def prune(repository_name):
+            summary = {'repositoryName': repository_name, 'deleted': 0, 'reclaimedBytes': 0, 'failures': []}
+            for image in self.ecr_prune(repository_name, workers=1, client=client, policy=policy, dry_run=dry_run):
+                if 'failureCode' in image:
+                    summary['failures'].append(image)
+                else:
+                    summary['deleted'] += 1
+                    summary['reclaimedBytes'] += image.get('imageSizeInBytes', 0)
+            return summary
+
+        return imap_bounded(prune, repository_names, workers)
+
+    def ecr_images_exist(self, images, workers=4, client=None):
+        """
+        Checks which ECR images ('registry/repository:tag') exist, with one
+        batch_get_image call per repository and ECR_BATCH_GET_SIZE tags,
+        workers calls at a time. Returns a dict of image to its digest, None
+        when missing. Raises ValueError for images outside ECR.
+        """
+        from botocore.exceptions import ClientError
+
+        batches = {}
+        for image in images:
+            parts = ecr_split_image(image)
+            if parts is None:
+                raise ValueError('{} is not an ECR image'.format(image))
+            registry_id, region, repository, tag = parts
+            batches.setdefault((registry_id, region, repository), {})[tag] = image
+        calls = [(key, chunk) for key, tags in batches.items() for chunk in chunked(sorted(tags), ECR_BATCH_GET_SIZE)]
+
+        def check(call):
+            (registry_id, region, repository), tags = call
+            ecr = client or self.client('ecr', region=region)
+            try:
+                response = ecr.batch_get_image(
+                    registryId=registry_id,
+                    repositoryName=repository,
+                    imageIds=[{'imageTag': tag} for tag in tags]
+                )
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'RepositoryNotFoundException':
+                    raise
+                response = {}
+            digests = dict((image['imageId'].get('imageTag'), image['imageId'].get('imageDigest')) for image in response.get('images', []))
+            return [(batches[(registry_id, region, repository)][tag], digests.get(tag)) for tag in tags]
+
+        results = dict((image, None) for image in images)
+        for checked in imap_bounded(check, calls, workers):
+            results.update(checked)
+        return results
+
+    def ecr_retag(self, copies, workers=4, client=None):
+        """
+        Tags ECR images without pulling them: for every (source image, target
+        tag) pair, the manifest of the source image, fetched with one
+        batch_get_image call per repository and ECR_BATCH_GET_SIZE tags, is
+        put again under the target tag, workers calls at a time.
+
+        Yields a dict per pair as it completes with the target 'image', its
+        'digest' and a 'status': 'tagged', 'unchanged' when the target tag
+        already pointed at the source digest, 'missing' when the 'source'
+        image does not exist or 'failed' with the 'error' message. Raises ValueError
+        for images outside ECR.
+        """
+        from botocore.exceptions import ClientError
+
+        repositories = {}
+        for source, target in copies:
+            parts = ecr_split_image(source)
+            if parts is None:
+                raise ValueError('{} is not an ECR image'.format(source))
+            registry_id, region, repository, tag = parts
+            repositories.setdefault((registry_id, region, repository), []).append((tag, target, source))
+
+        def fetch(call):
+            (registry_id, region, repository), tags = call
+            ecr = client or self.client('ecr', region=region)
+            try:
+                response = ecr.batch_get_image(
+                    registryId=registry_id,
+                    repositoryName=repository,
+                    imageIds=[{'imageTag': tag} for tag in tags],
+                    acceptedMediaTypes=ECR_MANIFEST_MEDIA_TYPES
+                )
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'RepositoryNotFoundException':
+                    raise
+                response = {}
+            return (registry_id, region, repository), dict((image['imageId'].get('imageTag'), image) for image in response.get('images', []))
+
+        # sources and targets are fetched together, targets for their digest
+        calls = []
+        for key, pairs in repositories.items():
+            tags = sorted(set(tag for tag, _, _ in pairs) | set(target for _, target, _ in pairs))
+            calls += [(key, chunk) for chunk in chunked(tags, ECR_BATCH_GET_SIZE)]
+        manifests = {}
+        for key, images in imap_bounded(fetch, calls, workers):
+            manifests.setdefault(key, {}).update(images)
+
+        def put(copy):
+            (registry_id, region, repository), tag, target, source_image = copy
+            image = '{}:{}'.format(source_image.rpartition(':')[0], target)
+            images = manifests.get((registry_id, region, repository), {})
+            source = images.get(tag)
+            if source is None:
+                return {'image': image, 'source': source_image, 'digest': None, 'status': 'missing'}
+            digest = source['imageId'].get('imageDigest')
+            if target in images and images[target]['imageId'].get('imageDigest') == digest:
+                return {'image': image, 'digest': digest, 'status': 'unchanged'}
+            ecr = client or self.client('ecr', region=region)
+            params = {
+                'registryId': registry_id,
+                'repositoryName': repository,
+                'imageManifest': source['imageManifest'],
+                'imageTag': target,
+            }
+            if source.get('imageManifestMediaType'):
+                params['imageManifestMediaType'] = source['imageManifestMediaType']
+            try:
+                ecr.put_image(**params)
+            except ClientError as e:
+                # tagged concurrently with the same manifest
+                if e.response.get('Error', {}).get('Code') == 'ImageAlreadyExistsException':
+                    return {'image': image, 'digest': digest, 'status': 'unchanged'}
+                return {'image': image, 'digest': digest, 'status': 'failed', 'error': str(e)}
+            return {'image': image, 'digest': digest, 'status': 'tagged'}
+
+        puts = [(key, tag, target, source) for key, pairs in repositories.items() for tag, target, source in pairs]
+        return imap_bounded(put, puts, workers)
+
+    @memoized
+    def _secret_values(self):
+        """
+        Parameter and secret values fetched by this helper, so that names
+        requested again (e.g. by other steps of `codebuilder run`) are not
+        fetched twice.
+        """
+        return {}
+
+    def ssm_get_parameters_by_path(self, path, client=None):
+        """
+        Returns a dict of name to decrypted value of every SSM parameter
+        below path.
+        """
+        if ('ssm-path', path) in self._secret_values():
+            return self._secret_values()[('ssm-path', path)]
+        client = client or self.client('ssm')
+        parameters = {}
+        paginator = client.get_paginator('get_parameters_by_path')
+        for page in paginator.paginate(Path=path, Recursive=True, WithDecryption=True):
+            self.count('ssm.get_parameters_by_path.calls')
+            for parameter in page.get('Parameters', []):
+                parameters[parameter['Name']] = parameter['Value']
+        self._secret_values()[('ssm-path', path)] = parameters
+        for name, value in parameters.items():
+            self._secret_values()[('ssm', name)] = value
+        return parameters
+
+    def ssm_get_parameters(self, names, workers=4, client=None):
+        """
+        Fetches SSM parameters, SSM_GET_PARAMETERS_SIZE names per
+        get_parameters call, workers calls at a time. Returns (values,
+        errors), both dicts keyed by name.
+        """
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        cache = self._secret_values()
+        values = dict((name, cache[('ssm', name)]) for name in names if ('ssm', name) in cache)
+        missing = sorted(set(name for name in names if name not in values))
+
+        def fetch(batch):
+            ssm = client or self.client('ssm')
+            try:
+                response = ssm.get_parameters(Names=batch, WithDecryption=True)
+            except (BotoCoreError, ClientError) as e:
+                return {}, dict((name, e) for name in batch)
+            # names with a version or label selector come back split
+            fetched = dict((parameter['Name'] + parameter.get('Selector', ''), parameter['Value']) for parameter in response.get('Parameters', []))
+            # the names not found are listed in InvalidParameters
+            return fetched, dict((name, 'parameter not found') for name in batch if name not in fetched)
+
+        errors = {}
+        for fetched, failed in imap_bounded(fetch, chunked(missing, SSM_GET_PARAMETERS_SIZE), workers):
+            self.count('ssm.get_parameters.calls')
+            for name in set(fetched) & set(missing):
+                cache[('ssm', name)] = values[name] = fetched[name]
+            errors.update(failed)
+        return values, errors
+
+    def secretsmanager_get_secret_values(self, secret_ids, workers=8, client=None):
+        """
+        Fetches Secrets Manager secrets (names or ARNs) concurrently. Returns
+        (values, errors), both dicts keyed by secret id, binary secrets being
+        base64 encoded.
+        """
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        cache = self._secret_values()
+        values = dict((secret_id, cache[('secretsmanager', secret_id)]) for secret_id in secret_ids if ('secretsmanager', secret_id) in cache)
+        missing = sorted(set(secret_id for secret_id in secret_ids if secret_id not in values))
+
+        def fetch(secret_id):
+            secretsmanager = client or self.client('secretsmanager')
+            try:
+                response = secretsmanager.get_secret_value(SecretId=secret_id)
+            except (BotoCoreError, ClientError) as e:
+                return secret_id, None, e
+            if 'SecretString' in response:
+                return secret_id, response['SecretString'], None
+            return secret_id, b64encode(response['SecretBinary']).decode('ascii'), None
+
+        errors = {}
+        for secret_id, value, error in imap_bounded(fetch, missing, workers):
+            self.count('secretsmanager.get_secret_value.calls')
+            if error is None:
+                cache[('secretsmanager', secret_id)] = values[secret_id] = value
+            else:
+                errors[secret_id] = error
+        return values, errors
+
+    def s3_cache(self, bucket, prefix='codebuilder-cache', workers=16):
+        return S3Cache(self.client('s3'), bucket, prefix, workers=workers, counters=self.counters)
 
     def kms_decrypt(self, blob):
-        return self._session.client('kms').decrypt(CiphertextBlob=b64decode(blob))['Plaintext']
+        """
+        Decrypts the base64 blob and returns its plaintext decoded as UTF-8,
+        like kms_decrypt_many.
+        """
+        return self.client('kms').decrypt(CiphertextBlob=b64decode(blob))['Plaintext'].decode('utf-8')
+
+    def kms_decrypt_many(self, blobs, workers=8, client=None):
+        """
+        Decrypts a mapping of key to base64 blob concurrently through a single
+        KMS client. Returns (plaintexts, errors), both dicts keyed like blobs,
+        plaintexts being decoded as UTF-8.
+        """
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        client = client or self.client('kms')
+
+        def decrypt(item):
+            key, blob = item
+            try:
+                plaintext = client.decrypt(CiphertextBlob=b64decode(blob))['Plaintext']
+                return key, plaintext.decode('utf-8'), None
+            except (BotoCoreError, ClientError, TypeError, ValueError) as e:
+                return key, None, e
+
+        plaintexts, errors = {}, {}
+        for key, plaintext, error in imap_bounded(decrypt, blobs.items(), workers):
+            if error is None:
+                plaintexts[key] = plaintext
+            else:
+                errors[key] = error
+        return plaintexts, errors
@@ -1,12 +1,80 @@
 import os
-import json
+import time
 import click
-import dpath.util
+import functools
+
+from contextlib import contextmanager
+
+from .document import JSONDocument
+
+
+def memoized(method):
+    """
+    Caches the result of a no-argument method on the helper instance.
+    """
+    attribute = '_memoized_' + method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self):
+        if attribute not in self.__dict__:
+            self.__dict__[attribute] = method(self)
+        return self.__dict__[attribute]
+    return wrapper
+
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024 or unit == 'GiB':
+            break
+        size /= 1024.0
+    if unit == 'B':
+        return '{} B'.format(size)
+    return '{:.1f} {}'.format(size, unit)
+
 
 class BaseHelper(object):
 
     def __init__(self):
-        pass
+        ctx = click.get_current_context(silent=True)
+        self._meta = ctx.meta if ctx is not None else {}
+        self.counters = {}
+        if ctx is not None:
+            ctx.find_root().call_on_close(self._report)
+
+    @property
+    def verbose(self):
+        return self._meta.get('VERBOSE', False)
+
+    def log(self, message):
+        if self.verbose:
+            click.echo(message, err=True)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def timed(self, name):
+        """
+        Adds the time spent in the block to the name.ms counter.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.count(name + '.ms', int((time.time() - start) * 1000))
+
+    def _report(self):
+        for name in sorted(self.counters):
+            self.log('{}: {}'.format(name, self.counters[name]))
+
+    def get_cache(self, namespace, **kwargs):
+        """
+        Returns the persistent cache for namespace, or None with --no-cache.
+        """
+        if self._meta.get('NO_CACHE', False):
+            return None
+        from .cache import FileCache
+        return FileCache(namespace, counters=self.counters, **kwargs)
 
     def get_version(self):
         version = None
@@ -17,15 +85,21 @@ class BaseHelper(object):
 
     def output(self, value=None, format=None, jsonpath=None, source_json_file=None, in_place=False):
         if format == 'json':
-            if source_json_file:
-                d = json.load(source_json_file)
-            else:
-                d = {}
-            dpath.util.new(d, list(jsonpath) or '/value', value)
-            if in_place:
-                source_json_file.seek(0)
-                json.dump(d, source_json_file, indent=2, sort_keys=True)
-            else:
-                print(json.dumps(d, indent=2, sort_keys=True))
+            self.output_many([(list(jsonpath or []) or '/value', value)], source_json_file, in_place)
         elif format == 'text':
             print(value)
+
+    def output_many(self, assignments, source_json_file=None, in_place=False):
+        """
+        Applies every (jsonpath, value) assignment to the source JSON document
+        (or an empty one) and prints it, or with in_place replaces the source
+        file atomically, unless nothing changed.
+        """
+        if in_place and not source_json_file:
+            raise click.UsageError('--in-place requires --source-json-file')
+        document = JSONDocument(source_json_file)
+        document.update(assignments)
+        if in_place:
+            document.save()
+        else:
+            print(document.dumps())
@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (Windows)
+    fcntl = None
+
+from .trace import TRACER
+
+DEFAULT_TTL = 3600
+DEFAULT_MAX_ENTRIES = 256
+
+
+def default_cache_dir():
+    if os.getenv('CODEBUILDER_CACHE_DIR'):
+        return os.getenv('CODEBUILDER_CACHE_DIR')
+    base = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'codebuilder')
+
+
+def atomic_write(path, data, mode=0o600):
+    """
+    Writes data to path through a temporary file in the same directory and
+    a rename, so readers only ever see the old or the new content.
+    """
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+class FileCache(object):
+    """
+    Persistent JSON cache shared between codebuilder invocations.
+
+    Entries live in one file each under ``<cache dir>/<namespace>``, are
+    written atomically and expire after ``ttl`` seconds. Writers serialize on
+    a per-namespace lock file. ``get_or_set`` computes a missing value under
+    a lock file of its key, so concurrent calls compute it only once while
+    other keys are computed in parallel. Values are
+    normalized through JSON (non JSON types are stored as their ``str``).
+    Cache I/O errors are never fatal: the cache then behaves as a miss.
+    """
+
+    def __init__(self, namespace, directory=None, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, counters=None):
+        self._directory = os.path.join(directory or default_cache_dir(), namespace)
+        self._namespace = namespace
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._counters = counters if counters is not None else {}
+
+    def _count(self, event):
+        name = '{}.cache.{}'.format(self._namespace, event)
+        self._counters[name] = self._counters.get(name, 0) + 1
+
+    def _path(self, key, extension='.json'):
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self._directory, digest + extension)
+
+    @contextmanager
+    def _lock(self, path=None):
+        try:
+            if not os.path.isdir(self._directory):
+                os.makedirs(self._directory, 0o700)
+            f = open(path or os.path.join(self._directory, '.lock'), 'a')
+        except (IOError, OSError):
+            yield False
+            return
+        with f:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield True
+            finally:
+                if fcntl:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _read(self, key):
+        try:
+            with TRACER.span('cache read', 'json', namespace=self._namespace), open(self._path(key), 'r') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('expires', 0) < time.time():
+            return None
+        return entry
+
+    def get(self, key, default=None):
+        entry = self._read(key)
+        if entry is None:
+            self._count('misses')
+            return default
+        self._count('hits')
+        return entry['value']
+
+    def set(self, key, value, ttl=None):
+        with self._lock() as locked:
+            return self._write(key, value, ttl, locked)
+
+    def _write(self, key, value, ttl, locked):
+        if callable(ttl):
+            ttl = ttl(value)
+        entry = {
+            'key': key,
+            'expires': time.time() + (self._ttl if ttl is None else ttl),
+            'value': value
+        }
+        data = json.dumps(entry, default=str, sort_keys=True)
+        if locked:
+            try:
+                with TRACER.span('cache write', 'json', namespace=self._namespace):
+                    atomic_write(self._path(key), data.encode('utf-8'))
+                self._evict()
+            except (IOError, OSError):
+                pass
+        return json.loads(data)['value']
+
+    def delete(self, key):
+        with self._lock():
+            self._unlink(self._path(key))
+
+    def get_or_set(self, key, factory, ttl=None):
+        """
+        Returns the cached value for key, or calls factory and caches its
+        result. ``None`` results are returned but not cached. ``ttl`` may be
+        a callable computing the TTL from the value.
+        """
+        entry = self._read(key)
+        if entry is None:
+            with self._lock(self._path(key, '.lock')):
+                entry = self._read(key)
+                if entry is None:
+                    self._count('misses')
+                    value = factory()
+                    if value is None:
+                        return None
+                    return self.set(key, value, ttl)
+        self._count('hits')
+        return entry['value']
+
+    def _evict(self):
+        now = time.time()
+        entries = []
+        for name in os.listdir(self._directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self._directory, name)
+            try:
+                mtime = os.path.getmtime(path)
+                with open(path, 'r') as f:
+                    expires = json.load(f).get('expires', 0)
+            except (IOError, OSError, ValueError):
+                expires, mtime = 0, 0
+            if expires < now:
+                self._unlink(path)
+                self._unlink(path[:-len('.json')] + '.lock')
+            else:
+                entries.append((mtime, path))
+
+        entries.sort()
+        for mtime, path in entries[:max(0, len(entries) - self._max_entries)]:
+            self._unlink(path)
+            self._unlink(path[:-len('.json')] + '.lock')
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
@@ -0,0 +1,90 @@
+import threading
+
+from .trace import TRACER
+
+# Thread pools share clients, so allow more connections than botocore's 10
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+
+
+def _import_boto3():
+    """
+    Imports boto3 on first use, keeping it off the startup path of commands
+    that never talk to AWS.
+    """
+    with TRACER.span('import boto3', 'import'):
+        import boto3
+    return boto3
+
+
+def make_config(options):
+    from botocore.config import Config
+
+    kwargs = {'max_pool_connections': options.get('max_pool_connections') or DEFAULT_MAX_POOL_CONNECTIONS}
+    for name in ('connect_timeout', 'read_timeout', 'tcp_keepalive'):
+        if options.get(name) is not None:
+            kwargs[name] = options[name]
+    retries = {}
+    if options.get('retry_mode'):
+        retries['mode'] = options['retry_mode']
+    if options.get('max_attempts'):
+        retries['total_max_attempts'] = options['max_attempts']
+    if retries:
+        kwargs['retries'] = retries
+    return Config(**kwargs)
+
+
+class ClientPool(object):
+    """
+    Per-process pool of boto3 sessions and clients.
+
+    Clients are keyed by (service, region, config) and created once:
+    service models are loaded and HTTP connection pools built only on first
+    use, then shared by every helper and thread. Credentials come from the
+    environment (AWS_PROFILE included), the daemon clears the pool when they
+    change. Sessions are only used under a lock as they are not thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._sessions = {}
+        self._clients = {}
+        self.created = 0
+        self.reused = 0
+
+    def session(self, region=None):
+        with self._lock:
+            if region not in self._sessions:
+                session = _import_boto3().session.Session(region_name=region)
+                # spans are only recorded while tracing is enabled, which may
+                # start after the session (a warm daemon handling --trace)
+                TRACER.instrument_session(session)
+                self._sessions[region] = session
+            return self._sessions[region]
+
+    def client(self, service, region=None, options=None, counters=None):
+        options = options or {}
+        key = (service, region, tuple(sorted(options.items())))
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                session = self.session(region)
+                with TRACER.span('client ' + service, 'aws.client', region=region or session.region_name):
+                    client = session.client(service, config=make_config(options))
+                self._clients[key] = client
+                self.created += 1
+                event = 'created'
+            else:
+                self.reused += 1
+                event = 'reused'
+        if counters is not None:
+            name = 'aws.clients.{}'.format(event)
+            counters[name] = counters.get(name, 0) + 1
+        return client
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+            self._clients.clear()
+
+
+CLIENTS = ClientPool()
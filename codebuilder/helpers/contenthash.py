@@ -0,0 +1,214 @@
+import os
+import re
+import json
+import time
+import stat
+import hashlib
+import multiprocessing
+
+from .cache import atomic_write
+from .parallel import chunked, imap_bounded
+
+CONTENT_HASH_CACHE_VERSION = 1
+
+# Files modified this recently may change again within the same mtime tick,
+# their digest is not cached
+CONTENT_HASH_RACY_SECONDS = 2
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Files hashed per task, small files are too quick to be worth one task each
+HASH_BATCH_SIZE = 64
+
+# Sent to the daemon whatever .dockerignore says
+ALWAYS_INCLUDED = ('.dockerignore', 'Dockerfile')
+
+
+def _translate(pattern):
+    """
+    Translates a .dockerignore pattern (Go filepath.Match syntax plus **)
+    to a regular expression matching whole relative paths.
+    """
+    regex, i = '', 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                regex += re.escape(c)
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith(('!', '^')):
+                    body = '^' + body[1:]
+                regex += '[' + body.replace('\\', '\\\\') + ']'
+                i = end
+        elif c == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(c)
+        i += 1
+    return re.compile(regex + r'\Z')
+
+
+class DockerIgnore(object):
+    """
+    The patterns of a .dockerignore file. As with docker, a pattern excludes
+    the paths it matches and everything below them, '!' patterns include
+    paths again and the last matching pattern wins.
+    """
+
+    def __init__(self, lines=()):
+        self.patterns = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:].strip()
+            line = os.path.normpath(line).replace(os.sep, '/').lstrip('/')
+            if line and line != '.':
+                self.patterns.append((_translate(line), negated))
+        self.has_exceptions = any(negated for _, negated in self.patterns)
+
+    @classmethod
+    def load(cls, context):
+        try:
+            with open(os.path.join(context, '.dockerignore'), 'r') as f:
+                return cls(f.read().splitlines())
+        except (IOError, OSError):
+            return cls()
+
+    def matches(self, path, inherited=None):
+        """
+        Returns (excluded, matched) for the relative path, inherited being
+        what its directory's call returned as matched: whether each pattern
+        matched the directory or one of its parents.
+        """
+        matched = [bool(inherited and inherited[n]) or bool(regex.match(path)) for n, (regex, _) in enumerate(self.patterns)]
+        excluded = False
+        for (_, negated), hit in zip(self.patterns, matched):
+            if hit:
+                excluded = not negated
+        return excluded, matched
+
+
+def walk_context(context, ignore=None):
+    """
+    Yields (relative path, os.lstat result) for every directory, file and
+    symlink of the build context docker would send, in sorted order.
+    """
+    ignore = ignore if ignore is not None else DockerIgnore.load(context)
+
+    def walk(directory, inherited):
+        try:
+            names = sorted(os.listdir(os.path.join(context, directory)))
+        except OSError:
+            return
+        for name in names:
+            path = directory + '/' + name if directory else name
+            try:
+                st = os.lstat(os.path.join(context, path))
+            except OSError:
+                continue
+            excluded, matched = ignore.matches(path, inherited) if ignore.patterns else (False, None)
+            if stat.S_ISDIR(st.st_mode):
+                # exceptions may include files back below an excluded directory
+                if excluded and not ignore.has_exceptions:
+                    continue
+                if not excluded:
+                    yield path, st
+                for entry in walk(path, matched):
+                    yield entry
+            elif not excluded or path in ALWAYS_INCLUDED:
+                yield path, st
+
+    return walk('', None)
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_hash(context='.', cache_dir=None, workers=None, counters=None):
+    """
+    Returns the sha256 hex digest of the build context: the sorted paths
+    docker would send with their type, executable bit and content (or
+    symlink target).
+
+    Files are hashed by worker threads (hashlib releases the GIL). With
+    cache_dir, file digests are kept per context keyed by size and mtime, so
+    only files that changed since the previous run are read again.
+    """
+    context = os.path.abspath(context)
+    workers = workers or multiprocessing.cpu_count() * 2
+    counters = counters if counters is not None else {}
+
+    cache_path, cached = None, {}
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, hashlib.sha1(context.encode('utf-8')).hexdigest() + '.json')
+        try:
+            with open(cache_path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == CONTENT_HASH_CACHE_VERSION:
+                cached = data['files']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    started = time.time()
+    entries, files, stale = [], {}, []
+    for path, st in walk_context(context):
+        if stat.S_ISDIR(st.st_mode):
+            entries.append((path, 'd', ''))
+        elif stat.S_ISLNK(st.st_mode):
+            entries.append((path, 'l', os.readlink(os.path.join(context, path))))
+        elif stat.S_ISREG(st.st_mode):
+            kind = 'x' if st.st_mode & 0o111 else 'f'
+            entries.append((path, kind, None))
+            key = [st.st_size, st.st_mtime_ns]
+            entry = cached.get(path)
+            if entry and entry[:2] == key:
+                files[path] = entry
+            else:
+                files[path] = key + [None]
+                stale.append(path)
+
+    def digest(paths):
+        return [(path, _file_digest(os.path.join(context, path))) for path in paths]
+
+    for results in imap_bounded(digest, chunked(stale, HASH_BATCH_SIZE), workers):
+        for path, value in results:
+            files[path][2] = value
+    counters['content_hash.files'] = len(files)
+    counters['content_hash.hashed'] = len(stale)
+
+    digest = hashlib.sha256()
+    for path, kind, value in entries:
+        value = files[path][2] if value is None else value
+        digest.update('{}\0{}\0{}\n'.format(path, kind, value).encode('utf-8'))
+
+    if cache_path:
+        racy = int((started - CONTENT_HASH_RACY_SECONDS) * 1e9)
+        fresh = dict((path, entry) for path, entry in files.items() if entry[1] < racy)
+        if fresh != cached:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0o700)
+            atomic_write(cache_path, json.dumps({'version': CONTENT_HASH_CACHE_VERSION, 'files': fresh}).encode('utf-8'))
+    return digest.hexdigest()
@@ -1,54 +1,234 @@
 import os
+import time
+import queue
+import threading
+
+from collections import OrderedDict
+
+from .aws import AWSHelper, ECR_REGISTRY_RE
+from .base import memoized
+from .cache import default_cache_dir
+from .contenthash import content_hash
+from .engine import get_docker_client, encode_registry_auth, registry_host, split_image
+from .parallel import imap_bounded
+from . import dockerconfig
+
+DOCKER_HUB_REGISTRY = 'https://index.docker.io/v1/'
+
+CONTENT_HASH_LENGTH = 12
+
+
+# Tag kind -> (inputs, template). Inputs are resolved lazily, in order, and
+# resolution stops at the first missing one so cheap inputs go first.
+TAGS = OrderedDict([
+    ('full', (('version', 'short_revision_id'), '{version}-{short_revision_id}')),
+    ('version', (('version',), '{version}')),
+    ('revision-id', (('short_revision_id',), '{short_revision_id}')),
+    ('branch', (('branch',), '{branch}')),
+    ('latest', ((), 'latest')),
+    ('content-hash', (('content_hash',), '{content_hash}')),
+])
 
-from .aws import AWSHelper
 
 class DockerHelper(AWSHelper):
 
-    def __init__(self, image_name=None, artifact_name=None):
+    def __init__(self, image_name=None, artifact_name=None, build_context='.'):
         super(DockerHelper, self).__init__()
 
         self._image_name = image_name or self.__guess_image_name()
-        self._version = self.get_version()
-        self._branch = os.getenv('GITHUB_BRANCH', None)
-        self._build_id = os.getenv('CODEBUILD_BUILD_ID', None)
-        self._revision_id = self.codepipeline_get_artifact_attribute(artifact_name, 'revisionId')
-        self._short_revision_id = None
-        if self._revision_id:
-            self._short_revision_id = self._revision_id[:8]
+        self._artifact_name = artifact_name
+        self._build_context = build_context or '.'
 
-        self._available_tags = {
-            'latest': 'latest'
-        }
+    @memoized
+    def _input_version(self):
+        return self.get_version()
 
-        if self._version:
-            self._available_tags['version'] = self._version
+    @memoized
+    def _input_branch(self):
+        return os.getenv('GITHUB_BRANCH', None)
 
-        if self._branch:
-            self._available_tags['branch'] = self._branch
-
-        if self._short_revision_id:
-            self._available_tags['revision-id'] = self._short_revision_id
+    @memoized
+    def _input_short_revision_id(self):
+        revision_id = self.codepipeline_get_artifact_attribute(self._artifact_name, 'revisionId')
+        if revision_id:
+            return revision_id[:8]
+        return None
 
-        if self._short_revision_id and self._version:
-            self._available_tags['full'] = '{}-{}'.format(self._version, self._short_revision_id)
+    @memoized
+    def _input_content_hash(self):
+        cache_dir = None
+        if not self._meta.get('NO_CACHE', False):
+            cache_dir = os.path.join(default_cache_dir(), 'content-hash')
+        with self.timed('content_hash'):
+            return content_hash(self._build_context, cache_dir=cache_dir, counters=self.counters)[:CONTENT_HASH_LENGTH]
 
-        self._available_images = {}
-        if self._image_name:
-            for k, v in self._available_tags.items():
-                self._available_images[k] = '{}:{}'.format(self._image_name, v)
+    def get_revision_attribute(self, attribute):
+        return self.codepipeline_get_artifact_attribute(self._artifact_name, attribute)
 
     def get_image(self, tag):
-        return self._available_images.get(tag, None)
+        if not self._image_name:
+            return None
+        value = self.get_tag(tag)
+        if value:
+            return '{}:{}'.format(self._image_name, value)
+        return None
 
     def get_tag(self, tag):
-        return self._available_tags.get(tag, None)
-
-    def get_apply_tags_commands(self, tags=[]):
-        commands = []
-        for tag in tags:
-            if tag in self._available_images:
-                commands.append(['docker', 'tag', self._image_name, self._available_images[tag]])
-        return commands
+        if tag not in TAGS:
+            return None
+        inputs, template = TAGS[tag]
+        values = {}
+        for name in inputs:
+            values[name] = getattr(self, '_input_' + name)()
+            if not values[name]:
+                return None
+        return template.format(**values)
+
+    def get_available_tags(self):
+        tags = OrderedDict()
+        for tag in TAGS:
+            value = self.get_tag(tag)
+            if value:
+                tags[tag] = value
+        return tags
+
+    @memoized
+    def get_docker_client(self):
+        return get_docker_client()
+
+    def get_registry_auth(self, repository):
+        """
+        Returns the X-Registry-Auth header value for repository, from the
+        docker config or, for the default ECR registry, from an ECR token.
+        """
+        host = registry_host(repository) or DOCKER_HUB_REGISTRY
+        credentials = dockerconfig.get_credentials(host)
+        if credentials is None and ECR_REGISTRY_RE.match(host):
+            user, token, endpoint = self.ecr_get_authorization()
+            if endpoint.split('://')[-1] == host:
+                credentials = (user, token)
+        return encode_registry_auth(credentials, host)
+
+    def apply_tags(self, tags, push=False, workers=4):
+        """
+        Tags the image with every tag and optionally pushes them, workers tags
+        at a time, through the Docker Engine API. Yields a result per tag as
+        it completes (image, tagTime and pushTime in seconds). The first
+        failure raises DockerError and cancels pending tags.
+        """
+        images = [image for image in (self.get_image(tag) for tag in tags) if image]
+        client = self.get_docker_client()
+        auth = None
+        if push and images:
+            auth = self.get_registry_auth(split_image(images[0])[0])
+
+        def apply(image):
+            repository, tag = split_image(image)
+            start = time.time()
+            client.tag(self._image_name, repository, tag)
+            result = {'image': image, 'tagTime': time.time() - start}
+            if push:
+                start = time.time()
+                client.push(repository, tag, auth)
+                result['pushTime'] = time.time() - start
+            return result
+
+        return imap_bounded(apply, images, workers)
+
+    def retag(self, source_tag, tags, repositories=(), remote=False, push=False, workers=4):
+        """
+        Tags the image of source_tag with every tag, in the image repository
+        or, given repositories names, in each of them (in the registry of the
+        image). Remotely, manifests are copied in ECR without pulling (see
+        ecr_retag). Locally, images are tagged and optionally pushed through
+        the Docker Engine API, the first failure raising DockerError. Yields a
+        result per tag as it completes ('image', 'status').
+        """
+        if remote and push:
+            raise ValueError('--push only applies to local tags, not with --remote')
+        source = self.get_tag(source_tag)
+        if not self._image_name or not source:
+            return iter(())
+        names = [self._image_name]
+        if repositories:
+            registry = registry_host(self._image_name)
+            if registry is None:
+                raise ValueError('--repository needs an image name with a registry host, not {}'.format(self._image_name))
+            names = ['{}/{}'.format(registry, repository) for repository in repositories]
+        targets = [target for target in (self.get_tag(tag) for tag in tags) if target]
+        copies = [('{}:{}'.format(name, source), target) for name in names for target in targets]
+        if remote:
+            return self.ecr_retag(copies, workers=workers)
+
+        client = self.get_docker_client()
+        auth = self.get_registry_auth(names[0]) if push and copies else None
+
+        def apply(copy):
+            image, target = copy
+            repository = split_image(image)[0]
+            client.tag(image, repository, target)
+            if push:
+                client.push(repository, target, auth)
+            return {'image': '{}:{}'.format(repository, target), 'status': 'pushed' if push else 'tagged'}
+
+        return imap_bounded(apply, copies, workers)
+
+    def pull_images(self, images, workers=4, timeout=None):
+        """
+        Pulls images, workers at a time, through the Docker Engine API and
+        returns a dict of image to the pull time in seconds, or the
+        exception it failed with (DockerError, or an error getting registry
+        credentials). Pulls not done within timeout seconds are left out:
+        their threads are abandoned, not waited for.
+        """
+        images = list(images)
+        client = self.get_docker_client()
+        auths = {}
+        pending, done = queue.Queue(), queue.Queue()
+        for image in images:
+            pending.put(image)
+
+        def work():
+            while True:
+                try:
+                    image = pending.get_nowait()
+                except queue.Empty:
+                    return
+                repository, tag = split_image(image)
+                start = time.time()
+                try:
+                    registry = repository.split('/')[0]
+                    if registry not in auths:
+                        auths[registry] = self.get_registry_auth(repository)
+                    client.pull(repository, tag, auths[registry])
+                    done.put((image, time.time() - start))
+                except Exception as e:
+                    # not only DockerError: an unreported failure would wait out the timeout
+                    done.put((image, e))
+
+        for _ in range(min(workers, len(images))):
+            thread = threading.Thread(target=work)
+            thread.daemon = True
+            thread.start()
+
+        results = {}
+        deadline = time.time() + timeout if timeout is not None else None
+        while len(results) < len(images):
+            remaining = deadline - time.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                break
+            try:
+                image, result = done.get(timeout=remaining)
+            except queue.Empty:
+                break
+            results[image] = result
+        # pulls not started yet are not worth starting anymore
+        while not pending.empty():
+            try:
+                pending.get_nowait()
+            except queue.Empty:
+                break
+        return results
 
     def __guess_image_name(self):
         docker_registry = os.getenv('DOCKER_REGISTRY', None)
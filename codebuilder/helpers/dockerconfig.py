@@ -0,0 +1,81 @@
+import os
+import json
+
+from base64 import b64decode, b64encode
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (Windows)
+    fcntl = None
+
+from .cache import atomic_write
+
+
+def config_path():
+    directory = os.getenv('DOCKER_CONFIG') or os.path.join(os.path.expanduser('~'), '.docker')
+    return os.path.join(directory, 'config.json')
+
+
+def load_config():
+    try:
+        with open(config_path(), 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _registry_keys(registry):
+    host = registry.split('://', 1)[-1].rstrip('/')
+    return [registry, host, 'https://' + host]
+
+
+def get_auth_entry(registry, config=None):
+    """
+    Returns the ``auths`` entry docker stored for registry, whatever the
+    scheme used at login time, or None.
+    """
+    auths = (config if config is not None else load_config()).get('auths', {})
+    for key in _registry_keys(registry):
+        if key in auths:
+            return auths[key]
+    return None
+
+
+def get_credentials(registry, config=None):
+    """
+    Returns (user, password) stored inline for registry, or None when docker
+    delegates storage to a credentials helper.
+    """
+    entry = get_auth_entry(registry, config)
+    if not entry or not entry.get('auth'):
+        return None
+    user, password = b64decode(entry['auth']).decode('utf-8').split(':', 1)
+    return (user, password)
+
+
+def uses_credentials_store(registry, config=None):
+    config = config if config is not None else load_config()
+    host = registry.split('://', 1)[-1].rstrip('/')
+    return bool(config.get('credsStore') or host in config.get('credHelpers', {}))
+
+
+def store_credentials(credentials):
+    """
+    Stores a mapping of registry to (user, password) inline in the docker
+    config in one locked, atomic update, replacing any entry docker made for
+    the same registry under another scheme.
+    """
+    path = config_path()
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    with open(path + '.lock', 'a') as lock:
+        if fcntl:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        config = load_config()
+        auths = config.setdefault('auths', {})
+        for registry, (user, password) in credentials.items():
+            for key in _registry_keys(registry):
+                auths.pop(key, None)
+            auths[registry] = {'auth': b64encode('{}:{}'.format(user, password).encode('utf-8')).decode('ascii')}
+        atomic_write(path, json.dumps(config, indent=4).encode('utf-8'), mode=0o600)
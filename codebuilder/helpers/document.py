@@ -0,0 +1,87 @@
+import os
+import json
+import stat
+
+from .cache import atomic_write
+from .trace import TRACER
+
+_MISSING = object()
+
+
+def split_jsonpath(jsonpath):
+    """
+    Returns the segments of a jsonpath given as a list of segments or as a
+    '/' separated string.
+    """
+    if isinstance(jsonpath, (list, tuple)):
+        return list(jsonpath)
+    return [segment for segment in jsonpath.split('/') if segment]
+
+
+class JSONDocument(object):
+    """
+    JSON document edited through path=value assignments.
+
+    The source is parsed once, any number of assignments are applied in
+    memory and the result is serialized once. ``save`` replaces the source
+    file atomically (temporary file + rename, keeping its permissions) and
+    skips the write entirely when no assignment changed anything.
+    """
+
+    def __init__(self, source_json_file=None):
+        self._file = source_json_file
+        with TRACER.span('json load', 'json'):
+            self._data = json.load(source_json_file) if source_json_file else {}
+        self.changed = False
+
+    @property
+    def data(self):
+        return self._data
+
+    def get(self, jsonpath, default=None):
+        value = self._get(split_jsonpath(jsonpath))
+        return default if value is _MISSING else value
+
+    def _get(self, segments):
+        node = self._data
+        for segment in segments:
+            if isinstance(node, dict) and segment in node:
+                node = node[segment]
+            elif isinstance(node, list) and str(segment).isdigit() and int(segment) < len(node):
+                node = node[int(segment)]
+            else:
+                return _MISSING
+        return node
+
+    def set(self, jsonpath, value):
+        import dpath.util
+
+        segments = split_jsonpath(jsonpath)
+        if self._get(segments) == value:
+            return False
+        dpath.util.new(self._data, segments, value)
+        self.changed = True
+        return True
+
+    def update(self, assignments):
+        for jsonpath, value in assignments:
+            self.set(jsonpath, value)
+        return self.changed
+
+    def dumps(self):
+        return json.dumps(self._data, indent=2, sort_keys=True)
+
+    def save(self):
+        """
+        Writes the document back to its source file if it changed. Returns
+        whether the file was written.
+        """
+        if not self.changed:
+            return False
+        path = self._file.name
+        self._file.close()
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+        with TRACER.span('json save', 'json', path=path):
+            atomic_write(path, self.dumps().encode('utf-8'), mode=mode)
+        self.changed = False
+        return True
@@ -0,0 +1,175 @@
+import os
+import json
+import socket
+import threading
+import subprocess
+import http.client
+
+from base64 import urlsafe_b64encode
+from urllib.parse import urlencode, quote
+
+from .trace import TRACER
+
+DEFAULT_DOCKER_HOST = 'unix:///var/run/docker.sock'
+
+
+class DockerError(Exception):
+    pass
+
+
+def split_image(image):
+    """
+    Splits 'registry/name:tag' into ('registry/name', 'tag'), the tag being
+    None when absent.
+    """
+    name, sep, tag = image.rpartition(':')
+    if not sep or '/' in tag:
+        return (image, None)
+    return (name, tag)
+
+
+def registry_host(image):
+    """
+    Returns the registry host of an image name, or None for Docker Hub
+    names: like docker, the first component is a host when it contains a
+    '.' or a ':' or is 'localhost'.
+    """
+    host, sep, _ = image.partition('/')
+    if sep and ('.' in host or ':' in host or host == 'localhost'):
+        return host
+    return None
+
+
+def encode_registry_auth(credentials=None, registry=None):
+    auth = {}
+    if credentials:
+        auth = {'username': credentials[0], 'password': credentials[1], 'serveraddress': registry}
+    return urlsafe_b64encode(json.dumps(auth).encode('utf-8')).decode('ascii')
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self._path)
+        self.sock = sock
+
+
+class DockerEngineClient(object):
+    """
+    Minimal Docker Engine API client over the daemon unix socket.
+
+    Keep-alive connections are pooled, at most ``max_connections`` being
+    open at once, so the client can be shared by worker threads.
+    """
+
+    def __init__(self, socket_path, max_connections=8, timeout=None):
+        self._socket_path = socket_path
+        self._timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self.connections_created = 0
+
+    def _acquire(self):
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            self.connections_created += 1
+        return UnixHTTPConnection(self._socket_path, timeout=self._timeout)
+
+    def _release(self, connection, reusable):
+        if reusable:
+            with self._lock:
+                self._idle.append(connection)
+        else:
+            connection.close()
+        self._slots.release()
+
+    def request(self, method, path, params=None, headers=None, body=None):
+        """
+        Performs an API call and returns the response body. Streamed
+        responses (push, pull) are read to the end and any error message
+        they carry is raised as DockerError.
+        """
+        url = quote(path, safe='/:@')
+        if params:
+            url += '?' + urlencode(params)
+        connection = self._acquire()
+        reusable = False
+        try:
+            with TRACER.span('{} {}'.format(method, path), 'docker', params=params or {}):
+                connection.request(method, url, body=body, headers=headers or {})
+                response = connection.getresponse()
+                data = response.read()
+            reusable = not response.will_close
+        except (socket.error, http.client.HTTPException) as e:
+            raise DockerError('Docker daemon request {} {} failed: {}'.format(method, path, e))
+        finally:
+            self._release(connection, reusable)
+
+        if response.status >= 400:
+            try:
+                message = json.loads(data.decode('utf-8')).get('message')
+            except ValueError:
+                message = data.decode('utf-8', 'replace').strip()
+            raise DockerError(message or 'HTTP {}'.format(response.status))
+
+        for line in data.decode('utf-8', 'replace').splitlines():
+            if '"error"' in line:
+                try:
+                    error = json.loads(line).get('error')
+                except ValueError:
+                    continue
+                if error:
+                    raise DockerError(error)
+        return data
+
+    def tag(self, image, repository, tag):
+        self.request('POST', '/images/{}/tag'.format(image), {'repo': repository, 'tag': tag})
+
+    def push(self, repository, tag, registry_auth):
+        self.request('POST', '/images/{}/push'.format(repository), {'tag': tag}, {'X-Registry-Auth': registry_auth})
+
+    def pull(self, repository, tag, registry_auth):
+        self.request('POST', '/images/create', {'fromImage': repository, 'tag': tag}, {'X-Registry-Auth': registry_auth})
+
+
+class DockerCLIClient(object):
+    """
+    Fallback with the DockerEngineClient interface forking the docker CLI,
+    for daemons not reachable through a local unix socket.
+    """
+
+    def _call(self, command):
+        with TRACER.span(' '.join(command[:2]), 'subprocess', args=command[2:]):
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = process.communicate()[0]
+        if process.returncode != 0:
+            raise DockerError(output.decode('utf-8', 'replace').strip() or '{} failed'.format(' '.join(command)))
+
+    def tag(self, image, repository, tag):
+        self._call(['docker', 'tag', image, '{}:{}'.format(repository, tag)])
+
+    def push(self, repository, tag, registry_auth):
+        self._call(['docker', 'push', '{}:{}'.format(repository, tag)])
+
+    def pull(self, repository, tag, registry_auth):
+        self._call(['docker', 'pull', '{}:{}'.format(repository, tag)])
+
+
+def get_docker_client(max_connections=8):
+    """
+    Returns a DockerEngineClient when $DOCKER_HOST (or the default) is a
+    unix socket that exists, a DockerCLIClient otherwise.
+    """
+    host = os.getenv('DOCKER_HOST') or DEFAULT_DOCKER_HOST
+    if host.startswith('unix://') and os.path.exists(host[len('unix://'):]):
+        return DockerEngineClient(host[len('unix://'):], max_connections=max_connections)
+    return DockerCLIClient()
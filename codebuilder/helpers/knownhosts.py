@@ -0,0 +1,198 @@
+import os
+import hmac
+import hashlib
+import subprocess
+
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+
+from .cache import atomic_write
+from .parallel import imap_bounded
+from .trace import TRACER
+
+PINNED_KNOWN_HOSTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'known_hosts')
+
+SSH_CONFIG_BEGIN = '# BEGIN codebuilder'
+SSH_CONFIG_END = '# END codebuilder'
+
+
+class KeyscanError(Exception):
+    pass
+
+
+def split_host(host):
+    """
+    Splits 'host' or 'host:port' into (host, port), port being None.
+    """
+    hostname, sep, port = host.partition(':')
+    return hostname, port if sep else None
+
+
+def host_name(host):
+    """
+    Returns the known_hosts name of 'host' or 'host:port'.
+    """
+    hostname, port = split_host(host)
+    if port and port != '22':
+        return '[{}]:{}'.format(hostname, port)
+    return hostname
+
+
+def hash_name(name, salt=None):
+    salt = salt or os.urandom(20)
+    digest = hmac.new(salt, name.encode('utf-8'), hashlib.sha1).digest()
+    return '|1|{}|{}'.format(b64encode(salt).decode('ascii'), b64encode(digest).decode('ascii'))
+
+
+def name_matches(field, name):
+    """
+    Tells whether the host field of a known_hosts line, plain or hashed,
+    stands for name.
+    """
+    if field.startswith('|1|'):
+        try:
+            salt = b64decode(field[3:].split('|', 1)[0])
+        except (TypeError, ValueError):
+            return False
+        return hash_name(name, salt) == field
+    return name in field.split(',')
+
+
+def parse_line(line):
+    """
+    Returns (host field, key type, key) of a known_hosts line, or None for
+    blank lines, comments and marked (@cert-authority, @revoked) lines.
+    """
+    fields = line.split()
+    if len(fields) < 3 or fields[0].startswith(('#', '@')):
+        return None
+    return tuple(fields[:3])
+
+
+def pinned_entries(names):
+    """
+    Returns the bundled (name, key type, key) entries of names.
+    """
+    with open(PINNED_KNOWN_HOSTS, 'r') as f:
+        entries = [parse_line(line) for line in f]
+    return [entry for entry in entries if entry and entry[0] in names]
+
+
+def keyscan(host, timeout=5):
+    """
+    Returns the (name, key type, key) entries ssh-keyscan reports for 'host'
+    or 'host:port', which gives up after timeout seconds.
+    """
+    hostname, port = split_host(host)
+    cmdline = ['ssh-keyscan', '-T', str(max(1, int(round(timeout))))]
+    if port:
+        cmdline += ['-p', port]
+    cmdline.append(hostname)
+    with TRACER.span('ssh-keyscan', 'subprocess', host=host):
+        try:
+            process = subprocess.Popen(cmdline, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            raise KeyscanError(str(e))
+        out, err = process.communicate()
+    entries = []
+    for line in out.decode('utf-8', 'replace').splitlines():
+        entry = parse_line(line)
+        if entry:
+            entries.append((host_name(host), entry[1], entry[2]))
+    if not entries:
+        raise KeyscanError(err.decode('utf-8', 'replace').strip() or 'no host key found')
+    return entries
+
+
+def keyscan_many(hosts, timeout=5, workers=8):
+    """
+    Scans hosts concurrently and yields (host, entries, error) as each
+    completes, error being None on success.
+    """
+    def scan(host):
+        try:
+            return host, keyscan(host, timeout), None
+        except KeyscanError as e:
+            return host, [], e
+
+    return imap_bounded(scan, hosts, workers)
+
+
+def update_known_hosts(path, entries, hashed=True):
+    """
+    Adds the (name, key type, key) entries to the known_hosts file at path
+    unless already there, plain or hashed, and drops blank and duplicate
+    lines, so that repeated runs do not grow the file. The file is only
+    rewritten when it changes. Returns the number of entries added.
+    """
+    names = set(name for name, _, _ in entries)
+    try:
+        with open(path, 'r') as f:
+            existing = f.read().splitlines()
+    except (IOError, OSError):
+        existing = []
+
+    lines, seen, changed = [], set(), False
+    for line in existing:
+        entry = parse_line(line)
+        if entry is None:
+            if line.strip():
+                lines.append(line)
+            else:
+                changed = True
+            continue
+        field, keytype, key = entry
+        if field.startswith('|1|'):
+            identities = set((name, keytype, key) for name in names if name_matches(field, name)) or set([entry])
+        else:
+            identities = set((name, keytype, key) for name in field.split(','))
+        if identities <= seen:
+            changed = True
+            continue
+        seen |= identities
+        lines.append(line)
+
+    added = 0
+    for name, keytype, key in entries:
+        if (name, keytype, key) in seen:
+            continue
+        seen.add((name, keytype, key))
+        lines.append(' '.join([hash_name(name) if hashed else name, keytype, key]))
+        added += 1
+
+    if changed or added:
+        atomic_write(path, ''.join(line + '\n' for line in lines).encode('utf-8'), mode=0o600)
+    return added
+
+
+def update_ssh_config(path, identities):
+    """
+    Writes a Host section per host of the (host, identity file) pairs to the
+    block of the ssh config at path managed by codebuilder, at the top of
+    the file since ssh uses the first value it finds, replacing the block
+    of earlier runs.
+    """
+    files = OrderedDict()
+    for host, identity_file in identities:
+        files.setdefault(host, []).append(identity_file)
+    block = [SSH_CONFIG_BEGIN]
+    for host, identity_files in files.items():
+        hostname, port = split_host(host)
+        block += ['Host {}'.format(hostname), '    HostName {}'.format(hostname)]
+        if port:
+            block.append('    Port {}'.format(port))
+        block += ['    IdentityFile {}'.format(identity_file) for identity_file in identity_files]
+        block.append('    IdentitiesOnly yes')
+    block.append(SSH_CONFIG_END)
+
+    try:
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+    except (IOError, OSError):
+        lines = []
+    if SSH_CONFIG_BEGIN in lines and SSH_CONFIG_END in lines:
+        start, end = lines.index(SSH_CONFIG_BEGIN), lines.index(SSH_CONFIG_END)
+        lines[start:end + 1] = block
+    else:
+        lines = block + ([''] + lines if lines else [])
+    atomic_write(path, ''.join(line + '\n' for line in lines).encode('utf-8'), mode=0o600)
@@ -0,0 +1,45 @@
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+def chunked(iterable, size):
+    """
+    Yields lists of at most size items from iterable, consuming it lazily.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def imap_bounded(func, iterable, workers=4, backlog=None):
+    """
+    Applies func to every item of iterable on a pool of workers threads and
+    yields results as they complete.
+
+    At most ``backlog`` (default: twice the workers) items are pulled from
+    iterable ahead of completed results, so memory stays bounded however
+    long iterable is. The first exception raised by func is re-raised after
+    pending calls are cancelled.
+    """
+    backlog = backlog or workers * 2
+    iterator = iter(iterable)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        try:
+            for item in iterator:
+                pending.add(executor.submit(func, item))
+                if len(pending) < backlog:
+                    continue
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
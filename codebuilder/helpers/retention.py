@@ -0,0 +1,138 @@
+import re
+import json
+import time
+import heapq
+import calendar
+import itertools
+
+
+class RetentionError(ValueError):
+    pass
+
+
+def _timestamp(value):
+    if value is None:
+        return 0
+    if hasattr(value, 'utctimetuple'):
+        return calendar.timegm(value.utctimetuple())
+    return float(value)
+
+
+def _tag_pattern(pattern):
+    return re.compile('.*'.join(re.escape(part) for part in pattern.split('*')) + r'\Z')
+
+
+class RetentionRule(object):
+    """
+    An ECR lifecycle policy rule: images selected by their tags are expired
+    beyond the count_number most recently pushed (imageCountMoreThan) or
+    when pushed more than count_number days ago (sinceImagePushed).
+    """
+
+    def __init__(self, priority, tag_status='any', tag_prefixes=(), tag_patterns=(), count_type='imageCountMoreThan', count_number=0, description=None):
+        self.priority = priority
+        self.tag_status = tag_status
+        self.tag_prefixes = list(tag_prefixes)
+        self.tag_patterns = [_tag_pattern(pattern) for pattern in tag_patterns]
+        self.count_type = count_type
+        self.count_number = count_number
+        self.description = description
+
+    def selects(self, tags):
+        if self.tag_status == 'untagged':
+            return not tags
+        if self.tag_status == 'tagged':
+            # like ECR, an image must match every prefix and every pattern
+            return bool(tags) and all(any(tag.startswith(prefix) for tag in tags) for prefix in self.tag_prefixes) \
+                and all(any(pattern.match(tag) for tag in tags) for pattern in self.tag_patterns)
+        return True
+
+
+class RetentionPolicy(object):
+    """
+    Decides which images of a repository expire. As with ECR lifecycle
+    policies, the rule with the lowest priority number selecting an image
+    decides whether it is kept or expired, images no rule selects are kept.
+    Images with a tag matching one of the protect regular expressions are
+    always kept and not counted.
+    """
+
+    def __init__(self, rules, protect=(), now=None):
+        self.rules = sorted(rules, key=lambda rule: rule.priority)
+        self.protect = [re.compile(regex) for regex in protect]
+        self.now = now if now is not None else time.time()
+
+    @classmethod
+    def from_lifecycle_policy(cls, document, protect=(), now=None):
+        """
+        Builds the policy of an ECR lifecycle policy document (a dict or its
+        JSON text), raising RetentionError when it is not valid.
+        """
+        if not isinstance(document, dict):
+            try:
+                document = json.loads(document)
+            except ValueError as e:
+                raise RetentionError('Invalid lifecycle policy: {}'.format(e))
+        rules, priorities = [], set()
+        for item in document.get('rules') or []:
+            selection = item.get('selection') or {}
+            priority = item.get('rulePriority')
+            if not isinstance(priority, int) or priority < 1 or priority in priorities:
+                raise RetentionError('Invalid or duplicate rulePriority: {}'.format(priority))
+            priorities.add(priority)
+            tag_status = selection.get('tagStatus')
+            if tag_status not in ('tagged', 'untagged', 'any'):
+                raise RetentionError('Rule {}: invalid tagStatus {}'.format(priority, tag_status))
+            prefixes, patterns = selection.get('tagPrefixList') or [], selection.get('tagPatternList') or []
+            if tag_status == 'tagged' and not prefixes and not patterns:
+                raise RetentionError('Rule {}: tagged rules need a tagPrefixList or tagPatternList'.format(priority))
+            count_type, count_number = selection.get('countType'), selection.get('countNumber')
+            if count_type not in ('imageCountMoreThan', 'sinceImagePushed'):
+                raise RetentionError('Rule {}: unsupported countType {}'.format(priority, count_type))
+            if count_type == 'sinceImagePushed' and selection.get('countUnit') != 'days':
+                raise RetentionError('Rule {}: sinceImagePushed needs countUnit days'.format(priority))
+            if not isinstance(count_number, int) or count_number < 1:
+                raise RetentionError('Rule {}: countNumber must be a positive integer'.format(priority))
+            if (item.get('action') or {}).get('type') != 'expire':
+                raise RetentionError('Rule {}: action type must be expire'.format(priority))
+            rules.append(RetentionRule(priority, tag_status, prefixes, patterns, count_type, count_number, item.get('description')))
+        if not rules:
+            raise RetentionError('The lifecycle policy has no rules')
+        return cls(rules, protect, now)
+
+    @property
+    def untagged_only(self):
+        return all(rule.tag_status == 'untagged' for rule in self.rules)
+
+    def protected(self, tags):
+        return any(regex.search(tag) for regex in self.protect for tag in tags)
+
+    def evaluate(self, images):
+        """
+        Yields (image detail, rule) for every expired image of the
+        describe_images image details, consuming them lazily. Images beyond
+        the count of an imageCountMoreThan rule are selected with a heap of
+        the count_number most recent ones, so memory grows with the counts,
+        not with the repository, and expired images are yielded while
+        images are still being listed.
+        """
+        kept = dict((rule.priority, []) for rule in self.rules)
+        order = itertools.count()
+        for image in images:
+            tags = image.get('imageTags') or []
+            if self.protect and self.protected(tags):
+                continue
+            rule = next((rule for rule in self.rules if rule.selects(tags)), None)
+            if rule is None:
+                continue
+            pushed = _timestamp(image.get('imagePushedAt'))
+            if rule.count_type == 'sinceImagePushed':
+                if pushed <= self.now - rule.count_number * 86400:
+                    yield image, rule
+                continue
+            heap = kept[rule.priority]
+            entry = (pushed, next(order), image)
+            if len(heap) < rule.count_number:
+                heapq.heappush(heap, entry)
+            else:
+                yield heapq.heappushpop(heap, entry)[2], rule
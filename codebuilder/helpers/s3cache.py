@@ -0,0 +1,349 @@
+import os
+import json
+import stat
+import hashlib
+import tempfile
+import itertools
+
+from .parallel import imap_bounded
+from .trace import TRACER
+
+S3_CACHE_MANIFEST_VERSION = 1
+
+# Large files are split in chunks of this size, small files are packed into
+# chunks of at most this size
+S3_CACHE_CHUNK_SIZE = 8 * 1024 * 1024
+
+# A pack of small files ends after a file whose path hash is a multiple of
+# this, so adding or changing a file only changes its own pack
+S3_CACHE_PACK_FILES = 64
+
+
+class S3CacheError(Exception):
+    pass
+
+
+def _not_found(error):
+    return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+def _path_boundary(path):
+    return int(hashlib.sha1(path.encode('utf-8')).hexdigest()[:8], 16) % S3_CACHE_PACK_FILES == 0
+
+
+def _check_path(path):
+    if os.path.isabs(path) or '..' in path.split('/'):
+        raise S3CacheError('Unsafe path in cache manifest: {}'.format(path))
+
+
+def _restore_path(base, path, directory=False):
+    """
+    Returns where the manifest path is restored below base, raising
+    S3CacheError unless it stays below base once symlinks are resolved:
+    the path itself for directories, its parent otherwise, as files and
+    symlinks replace a symlink they find in place of following it.
+    """
+    if not path:
+        return base
+    _check_path(path)
+    target = os.path.join(base, *path.split('/'))
+    real_base = os.path.realpath(base)
+    real = os.path.realpath(target if directory else os.path.dirname(target))
+    if real != real_base and not real.startswith(os.path.join(real_base, '')):
+        raise S3CacheError('Cache manifest path escapes {}: {}'.format(base, path))
+    return target
+
+
+def scan_root(root):
+    """
+    Returns the dirs, files (path, mode, size, mtime) and symlinks (path,
+    target) below root, relative to it and sorted.
+    """
+    base = os.path.expanduser(root)
+    dirs, files, symlinks = [], [], []
+    if os.path.isfile(base):
+        st = os.stat(base)
+        return dirs, [('', stat.S_IMODE(st.st_mode), st.st_size, st.st_mtime)], symlinks
+    for directory, names, filenames in os.walk(base):
+        names.sort()
+        relative = os.path.relpath(directory, base).replace(os.sep, '/')
+        prefix = '' if relative == '.' else relative + '/'
+        for name in list(names):
+            if os.path.islink(os.path.join(directory, name)):
+                names.remove(name)
+                filenames.append(name)
+            else:
+                dirs.append(prefix + name)
+        for name in sorted(filenames):
+            path = os.path.join(directory, name)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                symlinks.append((prefix + name, os.readlink(path)))
+            elif stat.S_ISREG(st.st_mode):
+                files.append((prefix + name, stat.S_IMODE(st.st_mode), st.st_size, st.st_mtime))
+    return dirs, files, symlinks
+
+
+def plan_chunks(files):
+    """
+    Groups the (root, path, size) files into chunks, lists of (root, path,
+    offset, length) slices: files larger than S3_CACHE_CHUNK_SIZE are split,
+    smaller ones packed together.
+    """
+    chunks, pack, pack_size = [], [], 0
+    for root, path, size in files:
+        if size > S3_CACHE_CHUNK_SIZE:
+            for offset in range(0, size, S3_CACHE_CHUNK_SIZE):
+                chunks.append([(root, path, offset, min(S3_CACHE_CHUNK_SIZE, size - offset))])
+            continue
+        if pack and pack_size + size > S3_CACHE_CHUNK_SIZE:
+            chunks.append(pack)
+            pack, pack_size = [], 0
+        pack.append((root, path, 0, size))
+        pack_size += size
+        if _path_boundary(root + '/' + path):
+            chunks.append(pack)
+            pack, pack_size = [], 0
+    if pack:
+        chunks.append(pack)
+    return chunks
+
+
+class S3Cache(object):
+    """
+    Build cache in an S3 bucket. File contents are stored as content
+    addressed chunks (<prefix>/chunks/<sha256>), so a save only uploads the
+    chunks missing from the bucket, and the file list of each cache key in a
+    manifest (<prefix>/manifests/<key>.json). Chunks are transferred by
+    workers threads sharing the (thread-safe) S3 client.
+    """
+
+    def __init__(self, client, bucket, prefix='codebuilder-cache', workers=16, counters=None):
+        self._client = client
+        self._bucket = bucket
+        self._prefix = prefix.strip('/')
+        self._workers = workers
+        self.counters = counters if counters is not None else {}
+
+    def _count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def _chunk_key(self, digest):
+        return '{}/chunks/{}'.format(self._prefix, digest)
+
+    def _manifest_key(self, key):
+        return '{}/manifests/{}.json'.format(self._prefix, key)
+
+    def get_manifest(self, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self._client.get_object(Bucket=self._bucket, Key=self._manifest_key(key))
+        except ClientError as e:
+            if _not_found(e):
+                return None
+            raise
+        manifest = json.loads(response['Body'].read().decode('utf-8'))
+        if manifest.get('version') != S3_CACHE_MANIFEST_VERSION:
+            return None
+        return manifest
+
+    def find_manifest(self, key, restore_keys=()):
+        """
+        Returns the manifest of key or else of the most recently saved key
+        starting with the first restore key that has one, or None.
+        """
+        manifest = self.get_manifest(key)
+        if manifest is not None:
+            return manifest
+        for restore_key in restore_keys:
+            prefix, newest, token = self._manifest_key(restore_key)[:-len('.json')], None, None
+            while True:
+                params = {'Bucket': self._bucket, 'Prefix': prefix}
+                if token:
+                    params['ContinuationToken'] = token
+                response = self._client.list_objects_v2(**params)
+                for item in response.get('Contents', []):
+                    if item['Key'].endswith('.json') and (newest is None or item['LastModified'] > newest['LastModified']):
+                        newest = item
+                token = response.get('NextContinuationToken')
+                if not response.get('IsTruncated') or not token:
+                    break
+            if newest is not None:
+                manifest = self.get_manifest(newest['Key'][len(self._prefix) + len('/manifests/'):-len('.json')])
+                if manifest is not None:
+                    return manifest
+        return None
+
+    def save(self, key, roots, restore_keys=()):
+        """
+        Saves the files below roots under key and returns the manifest.
+        Chunks referenced by the current manifest of key are known to exist,
+        others (those of a restore key manifest included, which may have
+        expired since) are checked with head_object.
+        """
+        from botocore.exceptions import ClientError
+
+        previous = self.find_manifest(key, restore_keys)
+        known = set()
+        if previous is not None and previous['key'] == key:
+            for entry in previous['roots'].values():
+                for _, _, _, _, slices in entry['files']:
+                    known.update(digest for digest, _, _ in slices)
+
+        scanned = {}
+        for root in roots:
+            with TRACER.span('scan', 's3cache', root=root):
+                scanned[root] = scan_root(root)
+        chunks = plan_chunks((root, path, size) for root in roots for path, _, size, _ in scanned[root][1])
+
+        def upload(chunk):
+            data = b''.join(self._read(root, path, offset, length) for root, path, offset, length in chunk)
+            digest = hashlib.sha256(data).hexdigest()
+            uploaded = False
+            if digest not in known:
+                try:
+                    self._client.head_object(Bucket=self._bucket, Key=self._chunk_key(digest))
+                except ClientError as e:
+                    if not _not_found(e):
+                        raise
+                    with TRACER.span('put chunk', 's3cache', size=len(data)):
+                        self._client.put_object(Bucket=self._bucket, Key=self._chunk_key(digest), Body=data)
+                    uploaded = True
+            return chunk, digest, len(data), uploaded
+
+        slices = {}
+        for chunk, digest, size, uploaded in imap_bounded(upload, chunks, self._workers):
+            position = 0
+            for root, path, offset, length in chunk:
+                slices.setdefault((root, path), []).append((offset, [digest, position, length]))
+                position += length
+            self._count('s3cache.chunks')
+            if uploaded:
+                self._count('s3cache.uploaded')
+                self._count('s3cache.uploaded_bytes', size)
+
+        manifest = {'version': S3_CACHE_MANIFEST_VERSION, 'key': key, 'roots': {}}
+        for root in roots:
+            dirs, files, symlinks = scanned[root]
+            manifest['roots'][root] = {
+                'dirs': dirs,
+                'files': [[path, mode, size, mtime, [s for _, s in sorted(slices.get((root, path), []))]] for path, mode, size, mtime in files],
+                'symlinks': [list(symlink) for symlink in symlinks],
+            }
+        if manifest != previous:
+            body = json.dumps(manifest, sort_keys=True).encode('utf-8')
+            self._client.put_object(Bucket=self._bucket, Key=self._manifest_key(key), Body=body)
+        return manifest
+
+    def restore(self, manifest, roots=None):
+        """
+        Restores the files of manifest below roots (default: all of them).
+        Files that exist with the size and mtime of the manifest are left
+        as is, only the chunks of the others are downloaded. Paths resolving
+        outside their root are rejected, and symlinks are created last so
+        no file is written through one.
+
+        Each file is downloaded to a temporary file next to it, which only
+        replaces it once all its chunks arrived and were verified. Files
+        with a missing or corrupted chunk are left as they were, and
+        S3CacheError is raised once the others are restored.
+        """
+        from botocore.exceptions import ClientError
+
+        roots = [root for root in (roots or manifest['roots']) if root in manifest['roots']]
+        for root in roots:
+            entry = manifest['roots'][root]
+            for path in itertools.chain(entry['dirs'], (f[0] for f in entry['files']), (l[0] for l in entry['symlinks'])):
+                _check_path(path)
+
+        def download(item):
+            digest, slices = item
+            try:
+                with TRACER.span('get chunk', 's3cache'):
+                    data = self._client.get_object(Bucket=self._bucket, Key=self._chunk_key(digest))['Body'].read()
+            except ClientError as e:
+                if not _not_found(e):
+                    raise
+                return digest, 0, 'missing'
+            if hashlib.sha256(data).hexdigest() != digest:
+                return digest, 0, 'corrupted'
+            for target, offset, position, length in slices:
+                with open(target, 'r+b') as f:
+                    f.seek(offset)
+                    f.write(data[position:position + length])
+            return digest, len(data), None
+
+        needed, pending, failed = {}, [], {}
+        try:
+            for root in roots:
+                base = os.path.expanduser(root)
+                entry = manifest['roots'][root]
+                for path in entry['dirs']:
+                    directory = _restore_path(base, path, directory=True)
+                    if not os.path.isdir(directory):
+                        os.makedirs(directory)
+                for path, mode, size, mtime, slices in entry['files']:
+                    target = _restore_path(base, path)
+                    try:
+                        st = os.lstat(target)
+                        if stat.S_ISREG(st.st_mode) and st.st_size == size and int(st.st_mtime) == int(mtime):
+                            self._count('s3cache.unchanged')
+                            continue
+                    except OSError:
+                        pass
+                    if not os.path.isdir(os.path.dirname(target)):
+                        os.makedirs(os.path.dirname(target))
+                    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.tmp-')
+                    pending.append((target, tmp_path, mode, mtime, set(digest for digest, _, _ in slices)))
+                    with os.fdopen(fd, 'wb') as f:
+                        f.truncate(size)
+                    offset = 0
+                    for digest, position, length in slices:
+                        needed.setdefault(digest, []).append((tmp_path, offset, position, length))
+                        offset += length
+
+            for digest, size, error in imap_bounded(download, sorted(needed.items()), self._workers):
+                if error:
+                    failed[digest] = error
+                    continue
+                self._count('s3cache.downloaded')
+                self._count('s3cache.downloaded_bytes', size)
+
+            restored = 0
+            for target, tmp_path, mode, mtime, digests in pending:
+                if digests.isdisjoint(failed):
+                    os.chmod(tmp_path, mode)
+                    os.utime(tmp_path, (mtime, mtime))
+                    os.replace(tmp_path, target)
+                    restored += 1
+        finally:
+            for _, tmp_path, _, _, _ in pending:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+
+        for root in roots:
+            base = os.path.expanduser(root)
+            for path, link in manifest['roots'][root]['symlinks']:
+                target = _restore_path(base, path)
+                if os.path.lexists(target):
+                    if os.path.islink(target) and os.readlink(target) == link:
+                        continue
+                    if os.path.isdir(target) and not os.path.islink(target):
+                        raise S3CacheError('Cache manifest symlink replaces a directory: {}'.format(path))
+                    os.remove(target)
+                os.symlink(link, target)
+        self._count('s3cache.restored', restored)
+        if failed:
+            digest, error = sorted(failed.items())[0]
+            raise S3CacheError('Chunk {} is {}, {} file(s) not restored'.format(digest, error, len(pending) - restored))
+        return restored
+
+    def _read(self, root, path, offset, length):
+        base = os.path.expanduser(root)
+        with open(os.path.join(base, path) if path else base, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        if len(data) != length:
+            raise S3CacheError('{} changed while saving'.format(os.path.join(root, path)))
+        return data
@@ -0,0 +1,200 @@
+import io
+import json
+import time
+import shlex
+import threading
+
+from collections import OrderedDict
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class StepError(Exception):
+    pass
+
+
+def load_steps(f):
+    """
+    Reads a step file, YAML when its name ends in .yml or .yaml (which
+    requires PyYAML), JSON otherwise.
+    """
+    name = getattr(f, 'name', '')
+    if name.endswith(('.yml', '.yaml')):
+        try:
+            import yaml
+        except ImportError:
+            raise StepError('PyYAML is required for YAML step files: pip install codebuilder[yaml]')
+        try:
+            data = yaml.safe_load(f)
+        except yaml.YAMLError as e:
+            raise StepError('Invalid step file {}: {}'.format(name, e))
+    else:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise StepError('Invalid step file {}: {}'.format(name, e))
+    return parse_steps(data)
+
+
+def _source_json_file(args):
+    for index, arg in enumerate(args):
+        if arg == '--source-json-file' and index + 1 < len(args):
+            return args[index + 1]
+        if arg.startswith('--source-json-file='):
+            return arg.split('=', 1)[1]
+    return None
+
+
+def parse_steps(data):
+    """
+    Returns an OrderedDict of name to step ({'name', 'args', 'needs'}) from
+    ``{'steps': [{'name': ..., 'run': ..., 'needs': [...]}, ...]}`` or the
+    bare list, ``run`` being a command line or a list of arguments.
+
+    Steps editing the same --source-json-file --in-place implicitly need the
+    previous one, as concurrent edits of a file would lose updates.
+    """
+    items = data.get('steps') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        raise StepError('A step file holds a non empty list of steps')
+
+    steps = OrderedDict()
+    editors = {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or 'run' not in item:
+            raise StepError('Step #{} has nothing to run'.format(index + 1))
+        args = shlex.split(item['run']) if not isinstance(item['run'], list) else [str(arg) for arg in item['run']]
+        if not args or args[0].startswith('-'):
+            raise StepError('Step #{} must start with a subcommand, global options go before `run`'.format(index + 1))
+        name = str(item.get('name') or ' '.join(args))
+        if name in steps:
+            raise StepError('Duplicate step name: {}'.format(name))
+        needs = item.get('needs') or []
+        needs = [needs] if not isinstance(needs, list) else [str(need) for need in needs]
+
+        source = _source_json_file(args) if '--in-place' in args else None
+        if source is not None:
+            if source in editors and editors[source] not in needs:
+                needs.append(editors[source])
+            editors[source] = name
+
+        steps[name] = {'name': name, 'args': args, 'needs': needs}
+
+    for step in steps.values():
+        for need in step['needs']:
+            if need not in steps:
+                raise StepError('Step {} needs unknown step {}'.format(step['name'], need))
+    topological_order(steps)
+    return steps
+
+
+def topological_order(steps):
+    """
+    Returns the step names so that every step comes after the ones it needs,
+    or raises StepError on a dependency cycle.
+    """
+    order, state = [], {}
+
+    def visit(name, path):
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            raise StepError('Dependency cycle: {}'.format(' -> '.join(path + [name])))
+        state[name] = 'visiting'
+        for need in steps[name]['needs']:
+            visit(need, path + [name])
+        state[name] = 'done'
+        order.append(name)
+
+    for name in steps:
+        visit(name, [])
+    return order
+
+
+def run_steps(steps, execute, workers=4):
+    """
+    Calls execute(step) for every step once all the steps it needs
+    succeeded, up to workers at once, and yields (step, result) in the
+    order of the steps as soon as they and all earlier steps are done.
+
+    execute returns a dict with the exit 'status' of the step, 'seconds' is
+    added. Steps needing a failed or skipped step are skipped, their status
+    being None.
+    """
+    order = topological_order(steps)
+    results = {}
+    running = {}
+
+    def timed(step):
+        start = time.time()
+        result = execute(step)
+        result['seconds'] = time.time() - start
+        return result
+
+    def schedule(executor):
+        for name in order:
+            if name in results or name in running:
+                continue
+            statuses = [results[need]['status'] if need in results else 'pending' for need in steps[name]['needs']]
+            if any(status not in (0, 'pending') for status in statuses):
+                results[name] = {'status': None, 'seconds': 0.0}
+            elif 'pending' not in statuses:
+                running[name] = executor.submit(timed, steps[name])
+
+    names = list(steps)
+    reported = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        schedule(executor)
+        while reported < len(names):
+            while reported < len(names) and names[reported] in results:
+                yield steps[names[reported]], results[names[reported]]
+                reported += 1
+            if not running:
+                continue
+            done, _ = wait(list(running.values()), return_when=FIRST_COMPLETED)
+            for name, future in list(running.items()):
+                if future in done:
+                    del running[name]
+                    results[name] = future.result()
+            schedule(executor)
+
+
+def capture_stream(encoding='utf-8'):
+    """
+    Returns an in-memory replacement for sys.stdout or sys.stderr, its bytes
+    being available from .buffer.getvalue().
+    """
+    return io.TextIOWrapper(io.BytesIO(), encoding=encoding, write_through=True)
+
+
+def captured_bytes(stream):
+    return getattr(stream, 'buffer', stream).getvalue()
+
+
+class ThreadLocalStream(object):
+    """
+    Stands for sys.stdout or sys.stderr and routes every write to the stream
+    the current thread captures to, or to the original stream.
+    """
+
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def capture(self, stream):
+        self._local.stream = stream
+
+    def release(self):
+        self._local.stream = None
+
+    def _target(self):
+        return getattr(self._local, 'stream', None) or self._default
+
+    def write(self, data):
+        return self._target().write(data)
+
+    def flush(self):
+        return self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import threading
+
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (Windows)
+    fcntl = None
+
+
+class Tracer(object):
+    """
+    Records timed spans (imports, AWS client creation and calls, forks, JSON
+    I/O) and writes them as Chrome trace events or a summary table.
+
+    Chrome traces use the JSON array format without its closing bracket,
+    which trace viewers accept, so that every invocation of a build can
+    append its events to the same file.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._lock = threading.Lock()
+
+    def enable(self, process_name='codebuilder'):
+        self.enabled = True
+        self.events = [{
+            'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'tid': 0,
+            'args': {'name': process_name}
+        }]
+
+    def disable(self):
+        self.enabled = False
+        self.events = []
+
+    def add(self, name, category, start, end, **args):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int(start * 1e6),
+            'dur': int((end - start) * 1e6),
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+        }
+        if args:
+            event['args'] = args
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, category, **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.time(), **args)
+
+    def instrument_session(self, session):
+        """
+        Hooks a boto3 session so that every API call, retries included, is
+        recorded as an 'aws' span while tracing is enabled.
+        """
+        def before_call(model, context, **kwargs):
+            if not self.enabled:
+                return
+            context['trace_name'] = '{}.{}'.format(model.service_model.service_name, model.name)
+            context['trace_start'] = time.time()
+
+        def after_call(context, parsed=None, exception=None, **kwargs):
+            if 'trace_start' not in context:
+                return
+            args = {}
+            metadata = (parsed or {}).get('ResponseMetadata', {})
+            if 'RetryAttempts' in metadata:
+                args['retries'] = metadata['RetryAttempts']
+            if exception is not None:
+                args['error'] = str(exception)
+            self.add(context.pop('trace_name'), 'aws', context.pop('trace_start'), time.time(), **args)
+
+        # Ahead of handlers answering calls themselves (stubs, caches)
+        session.events.register_first('before-call.*.*', before_call)
+        session.events.register('after-call.*.*', after_call)
+        session.events.register('after-call-error.*.*', after_call)
+
+    def write(self, path, format='chrome'):
+        if format == 'summary':
+            data = self.summary()
+        else:
+            data = ''.join(json.dumps(event, sort_keys=True) + ',\n' for event in self.events)
+        if path == '-':
+            import click
+            click.echo(data, err=True, nl=False)
+            return
+        with open(path, 'a') as f:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            if format != 'summary' and f.tell() == 0:
+                f.write('[\n')
+            f.write(data)
+
+    def summary(self):
+        totals = {}
+        for event in self.events:
+            if event['ph'] != 'X':
+                continue
+            key = (event['cat'], event['name'])
+            count, total, longest = totals.get(key, (0, 0, 0))
+            totals[key] = (count + 1, total + event['dur'], max(longest, event['dur']))
+        lines = ['{:<12} {:<48} {:>6} {:>10} {:>10}'.format('category', 'name', 'count', 'total ms', 'max ms')]
+        for (category, name), (count, total, longest) in sorted(totals.items(), key=lambda item: -item[1][1]):
+            lines.append('{:<12} {:<48} {:>6} {:>10.1f} {:>10.1f}'.format(category, name, count, total / 1000.0, longest / 1000.0))
+        return '\n'.join(lines) + '\n'
+
+
+TRACER = Tracer()
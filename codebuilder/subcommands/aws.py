@@ -1,7 +1,11 @@
-import subprocess
+import re
+import sys
+import json
 import click
 
 from codebuilder.helpers.aws import AWSHelper
+from codebuilder.helpers.base import format_size
+from codebuilder.helpers.cache import atomic_write
 
 pass_aws = click.make_pass_decorator(AWSHelper, ensure=True)
 
@@ -28,43 +32,413 @@ def decrypt(aws, blob, format, source_json_file, in_place, jsonpath):
     aws.output(value, format, jsonpath, source_json_file, in_place)
 
 
+@kms.command('batch-decrypt')
+@click.option('--blobs-file', type=click.File('r'), help='JSON object mapping jsonpaths to encrypted blobs')
+@click.option('--set', 'assignments', multiple=True, metavar='JSONPATH=BLOB', help='Decrypt BLOB into JSONPATH (repeatable)')
+@click.option('--source-json-file', type=click.File('r+'))
+@click.option('--in-place', is_flag=True)
+@click.option('--workers', type=click.IntRange(1), default=8, show_default=True, help='Concurrent KMS calls')
+@pass_aws
+def batch_decrypt(aws, blobs_file, assignments, source_json_file, in_place, workers):
+    """
+    Decrypts many blobs into one JSON document.
+
+    Jsonpaths are '/' separated. Nothing is written unless every blob is
+    decrypted.
+
+    Examples:
+
+      \b
+      > codebuilder aws kms batch-decrypt --set Parameters/DbPassword=AQEC... --set Parameters/ApiKey=AQEC... --source-json-file config.json --in-place
+    """
+    blobs = json.load(blobs_file) if blobs_file else {}
+    for assignment in assignments:
+        jsonpath, sep, blob = assignment.partition('=')
+        if not sep:
+            raise click.BadParameter('expected JSONPATH=BLOB, got {}'.format(assignment), param_hint='--set')
+        blobs[jsonpath] = blob
+    if not blobs:
+        raise click.UsageError('Nothing to decrypt, use --blobs-file or --set')
+
+    plaintexts, errors = aws.kms_decrypt_many(blobs, workers=workers)
+    for jsonpath in sorted(errors):
+        click.echo('Failed to decrypt {}: {}'.format(jsonpath, errors[jsonpath]), err=True)
+    if errors:
+        sys.exit(1)
+    aws.output_many(sorted(plaintexts.items()), source_json_file, in_place)
+
+
 @aws.group()
 def ecr():
     pass
 
 
 @ecr.command()
+@click.option('--region', 'regions', multiple=True, help='Region of the registries (repeatable). Default: default region')
+@click.option('--registry-id', 'registry_ids', multiple=True, help='Account id of a registry (repeatable). Default: own account')
+@click.option('--force', is_flag=True, help='Log in even if docker credentials are current')
+@click.option('--workers', type=click.IntRange(1), default=4, show_default=True, help='Concurrent regions and docker logins')
 @pass_aws
-def login(aws):
+def login(aws, regions, registry_ids, force, workers):
     """
-    Login to default ECR registry in default region.
+    Login to ECR registries, by default the default registry in default region.
+
+    Every --registry-id is logged in to in every --region. Tokens are cached
+    until they near expiry and registries whose credentials docker already
+    holds are skipped, unless --force is given.
 
     Examples:
 
       \b
       > codebuilder aws ecr login
-      `docker login -u AWS -p {TOKEN} https://123456789012.dkr.ecr.eu-west-1.amazonaws.com`
+      Login Succeeded: https://123456789012.dkr.ecr.eu-west-1.amazonaws.com (token 0.21s, login 0.01s)
+
+      \b
+      > codebuilder aws ecr login --region eu-west-1 --region us-east-1 --registry-id 123456789012 --registry-id 210987654321
+    """
+    failed = False
+    for result in aws.ecr_login(regions, registry_ids, force=force, workers=workers):
+        if result['error']:
+            failed = True
+            click.echo('Login Failed: {} ({})'.format(result['proxyEndpoint'], result['error']), err=True)
+        elif result['current']:
+            click.echo('Credentials current: {} (token {:.2f}s)'.format(result['proxyEndpoint'], result['tokenTime']))
+        else:
+            click.echo('Login Succeeded: {} (token {:.2f}s, login {:.2f}s)'.format(result['proxyEndpoint'], result['tokenTime'], result['loginTime']))
+    if failed:
+        sys.exit(1)
+
+
+def retention_policy(policy_file, keep, tag_prefixes, older_than, protect):
+    """
+    Returns the RetentionPolicy of the prune options, or None to only
+    delete untagged images.
     """
-    (user, token, endpoint) = aws.ecr_get_authorization()
-    logincmd = ['docker', 'login', '-u', user, '-p', token, endpoint]
-    subprocess.call(logincmd)
+    from codebuilder.helpers.retention import RetentionError, RetentionPolicy, RetentionRule
+
+    for regex in protect:
+        try:
+            re.compile(regex)
+        except re.error as e:
+            raise click.BadParameter('invalid regular expression {}: {}'.format(regex, e), param_hint='--protect')
+    if policy_file:
+        if keep is not None or tag_prefixes or older_than is not None:
+            raise click.UsageError('--policy cannot be combined with --keep, --tag-prefix or --older-than')
+        try:
+            return RetentionPolicy.from_lifecycle_policy(policy_file.read(), protect)
+        except RetentionError as e:
+            raise click.UsageError(str(e))
+    if tag_prefixes and keep is None:
+        raise click.UsageError('--tag-prefix requires --keep')
+    if keep is not None and not tag_prefixes and older_than is not None:
+        # --keep would keep every tagged image, only untagged ones could get older
+        raise click.UsageError('--keep without --tag-prefix cannot be combined with --older-than')
+    if keep is None and older_than is None and not protect:
+        return None
+
+    # untagged images go first, as without rules
+    rules = [RetentionRule(1, 'untagged', count_type='sinceImagePushed', count_number=0)]
+    if keep is not None:
+        for prefix in tag_prefixes:
+            rules.append(RetentionRule(len(rules) + 1, 'tagged', tag_prefixes=[prefix], count_number=keep))
+        if not tag_prefixes:
+            rules.append(RetentionRule(len(rules) + 1, 'tagged', tag_patterns=['*'], count_number=keep))
+    if older_than is not None:
+        rules.append(RetentionRule(len(rules) + 1, 'any', count_type='sinceImagePushed', count_number=older_than))
+    return RetentionPolicy(rules, protect)
 
 
-# TODO: Add option to delete old images
 @ecr.command(short_help='Delete images from ECR')
-@click.argument('repository-name', envvar='IMAGE_NAME')
+@click.argument('repository-name', envvar='IMAGE_NAME', required=False)
+@click.option('--all', 'all_repositories', is_flag=True, help='Prune every repository of the registry')
+@click.option('--match', help='Prune repositories matching this shell pattern (e.g. \'team-*\')')
+@click.option('--keep', type=click.IntRange(0), help='Keep the N most recently pushed tagged images (per --tag-prefix)')
+@click.option('--tag-prefix', 'tag_prefixes', multiple=True, help='Apply --keep to the images with a tag starting with this (repeatable)')
+@click.option('--older-than', type=click.IntRange(0), metavar='DAYS', help='Delete images pushed more than DAYS days ago')
+@click.option('--protect', multiple=True, metavar='REGEX', help='Never delete images with a tag matching REGEX (repeatable)')
+@click.option('--policy', 'policy_file', type=click.File('r'), help='ECR lifecycle policy JSON file to apply')
+@click.option('--dry-run', is_flag=True, help='Print the images that would be deleted and the bytes reclaimed')
+@click.option('--workers', type=click.IntRange(1), default=4, show_default=True, help='Concurrent delete batches, or repositories with --all/--match')
 @pass_aws
-def prune(aws, repository_name):
+def prune(aws, repository_name, all_repositories, match, keep, tag_prefixes, older_than, protect, policy_file, dry_run, workers):
     """
     Delete images in the ECR repository (default from $IMAGE_NAME)
+
+    Without retention options, untagged images are deleted. Otherwise
+    untagged images are deleted first, then the tagged images beyond the
+    --keep most recent ones (per --tag-prefix), then the remaining images
+    pushed more than --older-than days ago. Images kept by a rule are not
+    deleted by a later one, like with ECR lifecycle policies, which --policy
+    applies instead.
+
+    With --all or --match, repositories are pruned concurrently and a summary
+    of deleted images and reclaimed bytes is printed per repository.
+
+    Examples:
+
+      \b
+      > codebuilder aws ecr prune foo --keep 10 --tag-prefix release- --tag-prefix rc- --older-than 30 --protect '^v\d+\.\d+\.\d+$' --dry-run
+
+      \b
+      > codebuilder aws ecr prune --all --policy lifecycle-policy.json
     """
-    deleted_images = aws.ecr_prune(repository_name)
-    if not deleted_images:
+    policy = retention_policy(policy_file, keep, tag_prefixes, older_than, protect)
+    if all_repositories or match:
+        return prune_repositories(aws, aws.ecr_list_repositories(match), workers, policy, dry_run)
+    if not repository_name:
+        raise click.UsageError('Missing argument "repository-name" (or --all/--match)')
+
+    if dry_run:
+        return print_prune_plan(aws.ecr_prune(repository_name, workers=workers, policy=policy, dry_run=True))
+
+    deleted, failed = 0, 0
+    for image in aws.ecr_prune(repository_name, workers=workers, policy=policy):
+        if 'failureCode' in image:
+            failed += 1
+            click.echo('Failed to delete image: {} ({}: {})'.format(image['imageDigest'], image['failureCode'], image['failureReason']), err=True)
+        else:
+            deleted += 1
+            click.echo('Deleted image: {}'.format(image['imageDigest']))
+    if not deleted and not failed:
         click.echo('No image deleted')
+    if failed:
+        sys.exit(1)
+
+
+def print_prune_plan(images):
+    count, reclaimed = 0, 0
+    for image in images:
+        count += 1
+        reclaimed += image.get('imageSizeInBytes', 0)
+        pushed = image.get('imagePushedAt')
+        click.echo('Would delete image: {} tags={} size={} pushed={} rule={}'.format(
+            image['imageDigest'], ','.join(image.get('imageTags') or []) or '-',
+            format_size(image.get('imageSizeInBytes', 0)), pushed if pushed is not None else '-', image.get('rulePriority', '-')))
+    click.echo('Total: {} image(s) would be deleted, {} reclaimed'.format(count, format_size(reclaimed)))
+
+
+def prune_repositories(aws, repository_names, workers, policy=None, dry_run=False):
+    verb = 'would be deleted' if dry_run else 'deleted'
+    repositories, deleted, failed, reclaimed = 0, 0, 0, 0
+    for summary in aws.ecr_prune_repositories(repository_names, workers=workers, policy=policy, dry_run=dry_run):
+        repositories += 1
+        deleted += summary['deleted']
+        failed += len(summary['failures'])
+        reclaimed += summary['reclaimedBytes']
+        for image in summary['failures']:
+            click.echo('Failed to delete image: {}@{} ({}: {})'.format(summary['repositoryName'], image['imageDigest'], image['failureCode'], image['failureReason']), err=True)
+        click.echo('{}: {} image(s) {}, {} reclaimed'.format(summary['repositoryName'], summary['deleted'], verb, format_size(summary['reclaimedBytes'])))
+    click.echo('Total: {} image(s) {}, {} reclaimed in {} repositories'.format(deleted, verb, format_size(reclaimed), repositories))
+    if failed:
+        sys.exit(1)
+
+
+@aws.group()
+def secrets():
+    pass
+
+
+DOTENV_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+DOTENV_PLAIN_RE = re.compile(r'^[A-Za-z0-9_./:@+,=-]*$')
+
+
+def dotenv_name(prefix, name):
+    return '{}_{}'.format(prefix, re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_').upper())
+
+
+def format_dotenv(values):
+    """
+    Formats (name, value) pairs as a dotenv file, double quoting values
+    that need it.
+    """
+    lines = []
+    for name, value in values:
+        if not DOTENV_PLAIN_RE.match(value):
+            for char, escaped in (('\\', '\\\\'), ('"', '\\"'), ('$', '\\$'), ('`', '\\`'), ('\n', '\\n')):
+                value = value.replace(char, escaped)
+            value = '"{}"'.format(value)
+        lines.append('{}={}\n'.format(name, value))
+    return ''.join(lines)
+
+
+def parse_sources(sources_file, assignments, paths):
+    """
+    Returns the {target: ('ssm' or 'secretsmanager', name)} sources and the
+    {target: ssm path} paths of the options.
+    """
+    items = list((json.load(sources_file) if sources_file else {}).items())
+    for assignment in assignments:
+        target, sep, source = assignment.partition('=')
+        if not sep or not target or not source:
+            raise click.BadParameter('expected TARGET=SOURCE, got {}'.format(assignment), param_hint='--set')
+        items.append((target, source))
+    sources = {}
+    for target, source in items:
+        if source.startswith('secretsmanager:'):
+            sources[target] = ('secretsmanager', source[len('secretsmanager:'):])
+        elif source.startswith('arn:') and ':secretsmanager:' in source:
+            sources[target] = ('secretsmanager', source)
+        else:
+            sources[target] = ('ssm', source[len('ssm:'):] if source.startswith('ssm:') else source)
+    by_path = {}
+    for assignment in paths:
+        target, sep, path = assignment.partition('=')
+        if not sep or not target or not path.startswith('/'):
+            raise click.BadParameter('expected TARGET=/SSM/PATH, got {}'.format(assignment), param_hint='--path')
+        by_path[target] = path
+    return sources, by_path
+
+
+@secrets.command('fetch')
+@click.option('--sources-file', type=click.File('r'), help='JSON object mapping targets to sources')
+@click.option('--set', 'assignments', multiple=True, metavar='TARGET=SOURCE', help='Fetch SOURCE into TARGET (repeatable)')
+@click.option('--path', 'paths', multiple=True, metavar='TARGET=/SSM/PATH', help='Fetch every SSM parameter below /SSM/PATH into TARGET (repeatable)')
+@click.option('--format', type=click.Choice(['json', 'dotenv']), default='json', show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), help='Dotenv file to write. Default: stdout')
+@click.option('--source-json-file', type=click.File('r+'))
+@click.option('--in-place', is_flag=True)
+@click.option('--workers', type=click.IntRange(1), default=8, show_default=True, help='Concurrent SSM and Secrets Manager calls')
+@pass_aws
+def fetch_secrets(aws, sources_file, assignments, paths, format, output, source_json_file, in_place, workers):
+    """
+    Fetches SSM parameters and Secrets Manager secrets into one JSON document
+    or dotenv file.
+
+    Targets are '/' separated jsonpaths, or variable names with --format
+    dotenv. Sources are SSM parameter names (optionally prefixed with
+    'ssm:'), Secrets Manager ARNs or names prefixed with 'secretsmanager:'.
+    Parameters below a --path go to TARGET/<relative name>, or
+    TARGET_<RELATIVE_NAME> with --format dotenv. Names are fetched 10 per SSM
+    call, secrets concurrently, and nothing is written unless every value
+    is fetched.
+
+    Examples:
+
+      \b
+      > codebuilder aws secrets fetch --set Parameters/DbPassword=/myapp/db/password --path Parameters/Api=/myapp/api --source-json-file config.json --in-place
+
+      \b
+      > codebuilder aws secrets fetch --format dotenv --output .env --set API_KEY=secretsmanager:myapp/api-key --path MYAPP=/myapp
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    sources, by_path = parse_sources(sources_file, assignments, paths)
+    if not sources and not by_path:
+        raise click.UsageError('Nothing to fetch, use --sources-file, --set or --path')
+    if format == 'dotenv':
+        if source_json_file or in_place:
+            raise click.UsageError('--source-json-file and --in-place require --format json')
+        invalid = sorted(target for target in list(sources) + list(by_path) if not DOTENV_NAME_RE.match(target))
+        if invalid:
+            raise click.UsageError('Invalid variable name(s): {}'.format(', '.join(invalid)))
+    elif output:
+        raise click.UsageError('--output requires --format dotenv, use --source-json-file --in-place')
+
+    values, errors = {}, {}
+    try:
+        for target, path in sorted(by_path.items()):
+            prefix = path.rstrip('/') + '/'
+            for name, value in aws.ssm_get_parameters_by_path(path).items():
+                relative = name[len(prefix):] if name.startswith(prefix) else name.lstrip('/')
+                values[dotenv_name(target, relative) if format == 'dotenv' else '{}/{}'.format(target, relative)] = value
+    except (BotoCoreError, ClientError) as e:
+        click.echo('Failed to fetch parameters by path: {}'.format(e), err=True)
+        sys.exit(1)
+
+    fetched, failed = {}, {}
+    for service, fetch in (('ssm', aws.ssm_get_parameters), ('secretsmanager', aws.secretsmanager_get_secret_values)):
+        names = sorted(set(name for kind, name in sources.values() if kind == service))
+        if names:
+            service_values, service_errors = fetch(names, workers=workers)
+            fetched.update(((service, name), value) for name, value in service_values.items())
+            failed.update(((service, name), error) for name, error in service_errors.items())
+    for target, source in sources.items():
+        if source in failed:
+            errors[target] = '{}: {}'.format(source[1], failed[source])
+        else:
+            values[target] = fetched[source]
+
+    for target in sorted(errors):
+        click.echo('Failed to fetch {}: {}'.format(target, errors[target]), err=True)
+    if errors:
+        sys.exit(1)
+
+    if format == 'json':
+        aws.output_many(sorted(values.items()), source_json_file, in_place)
+    elif output:
+        atomic_write(output, format_dotenv(sorted(values.items())).encode('utf-8'), mode=0o600)
     else:
-        for image in deleted_images:
-            click.echo('Deleted image: {}'.format(image['imageDigest']))
+        click.echo(format_dotenv(sorted(values.items())), nl=False)
+
+
+@aws.group('cache')
+def build_cache():
+    pass
+
+
+def cache_options(command):
+    command = click.option('--workers', type=click.IntRange(1), default=16, show_default=True, help='Concurrent chunk transfers')(command)
+    command = click.option('--prefix', default='codebuilder-cache', show_default=True, help='Key prefix of the cache in the bucket')(command)
+    command = click.option('--bucket', envvar='CODEBUILDER_CACHE_BUCKET', required=True, help='Default: ${CODEBUILDER_CACHE_BUCKET}')(command)
+    command = click.option('--restore-key', 'restore_keys', multiple=True, help='Fall back to the latest cache whose key starts with this (repeatable)')(command)
+    command = click.option('--key', required=True, help='Cache key, e.g. pip-${GITHUB_BRANCH}')(command)
+    return click.argument('paths', nargs=-1, required=True)(command)
+
+
+@build_cache.command('save')
+@cache_options
+@pass_aws
+def cache_save(aws, paths, key, restore_keys, bucket, prefix, workers):
+    """
+    Saves PATHS to the S3 cache under a key.
+
+    Files are stored as content addressed chunks, only the chunks missing
+    from the bucket are uploaded.
+
+    Example:
+
+      \b
+      > codebuilder aws cache save --bucket my-cache --key pip-${GITHUB_BRANCH} --restore-key pip-master ~/.cache/pip
+      Saved 1234 file(s) to pip-feature: 3 of 42 chunk(s) uploaded (8.1 MiB)
+    """
+    cache = aws.s3_cache(bucket, prefix, workers)
+    manifest = cache.save(key, paths, restore_keys)
+    files = sum(len(entry['files']) for entry in manifest['roots'].values())
+    click.echo('Saved {} file(s) to {}: {} of {} chunk(s) uploaded ({})'.format(
+        files, key, aws.counters.get('s3cache.uploaded', 0), aws.counters.get('s3cache.chunks', 0),
+        format_size(aws.counters.get('s3cache.uploaded_bytes', 0))))
+
+
+@build_cache.command('restore')
+@cache_options
+@pass_aws
+def cache_restore(aws, paths, key, restore_keys, bucket, prefix, workers):
+    """
+    Restores PATHS from the S3 cache of a key, or else of the latest key
+    starting with a restore key. A cache miss, or a missing or corrupted
+    chunk, is not an error: files without all their chunks are left as is.
+
+    Example:
+
+      \b
+      > codebuilder aws cache restore --bucket my-cache --key pip-${GITHUB_BRANCH} --restore-key pip-master ~/.cache/pip
+      Restored 1234 file(s) from pip-master (42 chunk(s), 160.2 MiB)
+    """
+    from codebuilder.helpers.s3cache import S3CacheError
 
+    cache = aws.s3_cache(bucket, prefix, workers)
+    manifest = cache.find_manifest(key, restore_keys)
+    if manifest is None:
+        click.echo('Cache not found: {}'.format(key), err=True)
+        return
+    try:
+        restored = cache.restore(manifest, paths)
+    except S3CacheError as e:
+        click.echo('Cache not restored from {}: {}'.format(manifest['key'], e), err=True)
+        return
+    click.echo('Restored {} file(s) from {} ({} chunk(s), {})'.format(
+        restored, manifest['key'], aws.counters.get('s3cache.downloaded', 0),
+        format_size(aws.counters.get('s3cache.downloaded_bytes', 0))))
 
 
 @aws.group()
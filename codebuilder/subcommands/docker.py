@@ -1,15 +1,17 @@
-import subprocess
+import sys
 import click
 
 from codebuilder.helpers.docker import DockerHelper
+from codebuilder.helpers.engine import DockerError
 
 
 @click.group()
 @click.option('--image-name', help='Default: ${DOCKER_REGISTRY}/${IMAGE_NAME}')
 @click.option('--artifact-name', help='CodePipeline artifact name. Default: First artifact')
+@click.option('--build-context', type=click.Path(exists=True, file_okay=False), default='.', help='Docker build context of the content-hash tag. Default: .')
 @click.pass_context
-def docker(ctx, image_name, artifact_name):
-    ctx.obj = DockerHelper(image_name, artifact_name)
+def docker(ctx, image_name, artifact_name, build_context):
+    ctx.obj = DockerHelper(image_name, artifact_name, build_context)
 
 
 DEFAULT_TAG_CHOICE = [
@@ -17,7 +19,8 @@ DEFAULT_TAG_CHOICE = [
     'version', # 1.0.0
     'revision-id', # ab42ab42
     'branch', # master
-    'latest' # latest
+    'latest', # latest
+    'content-hash' # 3f2a9c1e04b7, from the build context and its .dockerignore
 ]
 
 
@@ -75,17 +78,187 @@ def get_tag(dkr, tag, format, source_json_file, in_place, jsonpath):
 
 @docker.command('apply-tags')
 @click.option('--tag', '-t', 'tags', multiple=True, type=click.Choice(DEFAULT_TAG_CHOICE))
+@click.option('--push', is_flag=True, help='Push tags once applied')
+@click.option('--workers', type=click.IntRange(1), default=4, show_default=True, help='Tags applied and pushed concurrently')
 @click.pass_obj
-def apply_tags(dkr, tags):
+def apply_tags(dkr, tags, push, workers):
     """
     Apply tags to Docker image.
 
+    Tags are applied (and pushed with --push) concurrently through the Docker
+    Engine API, stopping at the first error.
+
     Examples:
 
       \b
       > codebuilder docker --image-name foo/bar apply-tags -t version
-      `docker tag foo/bar foo/bar:1.0.0`
+      Tagged foo/bar:1.0.0 (0.01s)
+
+      \b
+      > codebuilder docker --image-name 123456789012.dkr.ecr.eu-west-1.amazonaws.com/foo apply-tags --push -t version -t full
+      Pushed 123456789012.dkr.ecr.eu-west-1.amazonaws.com/foo:1.0.0 (tag 0.01s, push 4.20s)
+      Pushed 123456789012.dkr.ecr.eu-west-1.amazonaws.com/foo:1.0.0-ab42ab42 (tag 0.01s, push 4.31s)
+    """
+    try:
+        for result in dkr.apply_tags(tags, push=push, workers=workers):
+            if push:
+                click.echo('Pushed {} (tag {:.2f}s, push {:.2f}s)'.format(result['image'], result['tagTime'], result['pushTime']))
+            else:
+                click.echo('Tagged {} ({:.2f}s)'.format(result['image'], result['tagTime']))
+    except DockerError as e:
+        click.echo('Error: {}'.format(e), err=True)
+        sys.exit(1)
+
+
+@docker.command('image-exists')
+@click.argument('tags', nargs=-1, required=True, type=click.Choice(DEFAULT_TAG_CHOICE))
+@click.option('--quiet', '-q', is_flag=True, help='Only set the exit status')
+@click.option('--workers', type=click.IntRange(1), default=4, show_default=True, help='Concurrent ECR calls')
+@click.pass_obj
+def image_exists(dkr, tags, quiet, workers):
+    """
+    Checks that the images of TAGS exist in ECR.
+
+    Exits with 0 when they all exist, 1 when one is missing or its tag
+    cannot be computed, and 3 when ECR could not be queried, so that
+    buildspecs can skip building and pushing.
+
+    Examples:
+
+      \b
+      > codebuilder docker --image-name 123456789012.dkr.ecr.eu-west-1.amazonaws.com/foo image-exists full version
+      123456789012.dkr.ecr.eu-west-1.amazonaws.com/foo:1.0.0-ab42ab42 sha256:5f1e...
+      123456789012.dkr.ecr.eu-west-1.amazonaws.com/foo:1.0.0 missing
+
+      \b
+      > codebuilder docker image-exists -q full || docker build -t ${IMAGE} .
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    images = [dkr.get_image(tag) for tag in tags]
+    unresolved = [tag for tag, image in zip(tags, images) if not image]
+    try:
+        digests = dkr.ecr_images_exist([image for image in images if image], workers=workers)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    except (BotoCoreError, ClientError) as e:
+        click.echo('Error: {}'.format(e), err=True)
+        sys.exit(3)
+
+    if not quiet:
+        for tag in unresolved:
+            click.echo('{}: cannot compute the tag'.format(tag), err=True)
+        for image in images:
+            if image:
+                click.echo('{} {}'.format(image, digests[image] or 'missing'))
+    if unresolved or not all(digests.values()):
+        sys.exit(1)
+
+
+@docker.command('retag')
+@click.argument('source', type=click.Choice(DEFAULT_TAG_CHOICE))
+@click.option('--tag', '-t', 'tags', multiple=True, required=True, type=click.Choice(DEFAULT_TAG_CHOICE), help='Tags to add (repeatable)')
+@click.option('--repository', '-r', 'repositories', multiple=True, help='Retag this repository of the image registry instead (repeatable)')
+@click.option('--remote', is_flag=True, help='Copy manifests in ECR instead of tagging local images')
+@click.option('--push', is_flag=True, help='Push local tags once applied')
+@click.option('--workers', type=click.IntRange(1), default=4, show_default=True, help='Tags applied concurrently')
+@click.pass_obj
+def retag(dkr, source, tags, repositories, remote, push, workers):
     """
-    commands = dkr.get_apply_tags_commands(tags)
-    for command in commands:
-        subprocess.call(command)
+    Adds tags to the image of the SOURCE tag.
+
+    With --remote, tags are added in ECR by copying the image manifest, so
+    promotion jobs do not have to pull the image first. Tags already
+    pointing at the image are left as is.
+
+    Examples:
+
+      \b
+      > codebuilder docker --image-name 123456789012.dkr.ecr.eu-west-1.amazonaws.com/foo retag full --remote -t version -t latest
+      123456789012.dkr.ecr.eu-west-1.amazonaws.com/foo:1.0.0 tagged
+      123456789012.dkr.ecr.eu-west-1.amazonaws.com/foo:latest unchanged
+
+      \b
+      > codebuilder docker --image-name 123456789012.dkr.ecr.eu-west-1.amazonaws.com/foo retag full --remote -t latest -r foo -r bar
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    if not dkr.get_tag(source):
+        click.echo('{}: cannot compute the tag'.format(source), err=True)
+        sys.exit(1)
+    failed = False
+    try:
+        for result in dkr.retag(source, tags, repositories, remote=remote, push=push, workers=workers):
+            if result['status'] == 'missing':
+                failed = True
+                click.echo('{}: {} not found'.format(result['image'], result['source']), err=True)
+            elif result['status'] == 'failed':
+                failed = True
+                click.echo('{}: {}'.format(result['image'], result['error']), err=True)
+            else:
+                click.echo('{} {}'.format(result['image'], result['status']))
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    except DockerError as e:
+        click.echo('Error: {}'.format(e), err=True)
+        sys.exit(1)
+    except (BotoCoreError, ClientError) as e:
+        click.echo('Error: {}'.format(e), err=True)
+        sys.exit(3)
+    if failed:
+        sys.exit(1)
+
+
+@docker.command('cache-pull')
+@click.option('--tag', '-t', 'tags', multiple=True, type=click.Choice(DEFAULT_TAG_CHOICE), default=['branch', 'latest', 'version'], show_default=True, help='Candidate cache images')
+@click.option('--timeout', type=float, default=300, show_default=True, help='Time budget for all the pulls (seconds)')
+@click.option('--workers', type=click.IntRange(1), default=4, show_default=True, help='Images pulled concurrently')
+@click.pass_obj
+def cache_pull(dkr, tags, timeout, workers):
+    """
+    Pulls the images to build from with --cache-from.
+
+    The images of the candidate tags found in ECR are pulled concurrently,
+    and the --cache-from arguments of the pulled ones are printed. Missing
+    images, failed pulls and pulls exceeding the time budget are skipped
+    with a warning: a build without cache only takes longer.
+
+    Example:
+
+      \b
+      > docker build $(codebuilder docker cache-pull) -t ${IMAGE} .
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    images = []
+    for tag in tags:
+        image = dkr.get_image(tag)
+        if image and image not in images:
+            images.append(image)
+
+    candidates = images
+    try:
+        digests = dkr.ecr_images_exist(images, workers=workers)
+        candidates = [image for image in images if digests[image]]
+        for image in images:
+            if not digests[image]:
+                click.echo('Skipped {}: not found'.format(image), err=True)
+    except ValueError:
+        # outside ECR, missing images just fail to pull
+        pass
+    except (BotoCoreError, ClientError) as e:
+        click.echo('Warning: cannot check images in ECR: {}'.format(e), err=True)
+
+    results = dkr.pull_images(candidates, workers=workers, timeout=timeout)
+    args = []
+    for image in candidates:
+        result = results.get(image)
+        if result is None:
+            click.echo('Skipped {}: not pulled within {:g}s'.format(image, timeout), err=True)
+        elif isinstance(result, Exception):
+            click.echo('Skipped {}: {}'.format(image, result), err=True)
+        else:
+            dkr.log('Pulled {} ({:.2f}s)'.format(image, result))
+            args += ['--cache-from', image]
+    if args:
+        click.echo(' '.join(args))
@@ -0,0 +1,76 @@
+import re
+import json
+import click
+
+from shlex import quote
+
+from codebuilder.helpers.docker import DockerHelper, TAGS
+from codebuilder.subcommands.aws import format_dotenv
+
+# Artifact revision attribute -> variable name
+REVISION_ATTRIBUTES = [
+    ('name', 'ARTIFACT_NAME'),
+    ('revisionId', 'REVISION_ID'),
+    ('revisionSummary', 'REVISION_SUMMARY'),
+    ('revisionUrl', 'REVISION_URL'),
+    ('revisionChangeIdentifier', 'REVISION_CHANGE_IDENTIFIER'),
+    ('created', 'REVISION_CREATED'),
+]
+
+# Hashing the build context is not worth it unless asked for
+DEFAULT_ENV_TAGS = [tag for tag in TAGS if tag != 'content-hash']
+
+
+def variable_name(tag):
+    return re.sub(r'[^A-Z0-9]+', '_', tag.upper())
+
+
+def compute_env(dkr, tags, prefix=''):
+    """
+    Returns the (name, value) pairs of the version, the tags and images of
+    tags, and the revision attributes of the artifact, skipping the values
+    that cannot be computed. Every input is looked up once.
+    """
+    values = [('VERSION', dkr.get_tag('version'))]
+    for tag in tags:
+        values.append(('TAG_' + variable_name(tag), dkr.get_tag(tag)))
+    for tag in tags:
+        values.append(('IMAGE_' + variable_name(tag), dkr.get_image(tag)))
+    for attribute, name in REVISION_ATTRIBUTES:
+        value = dkr.get_revision_attribute(attribute)
+        if name == 'REVISION_CREATED' and value is not None:
+            # a datetime, formatted like the cached artifacts
+            value = str(value)
+        values.append((name, value))
+    return [(prefix + name, value) for name, value in values if value]
+
+
+@click.command()
+@click.option('--image-name', help='Default: ${DOCKER_REGISTRY}/${IMAGE_NAME}')
+@click.option('--artifact-name', help='CodePipeline artifact name. Default: First artifact')
+@click.option('--build-context', type=click.Path(exists=True, file_okay=False), default='.', help='Docker build context of the content-hash tag. Default: .')
+@click.option('--tag', '-t', 'tags', multiple=True, type=click.Choice(list(TAGS)), help='Tags to compute (repeatable). Default: all but content-hash')
+@click.option('--format', type=click.Choice(['export', 'dotenv', 'json']), default='export', show_default=True)
+@click.option('--prefix', default='', help='Prefix of the variable names, e.g. CODEBUILDER_')
+def env(image_name, artifact_name, build_context, tags, format, prefix):
+    """
+    Prints the version, the Docker tags and images and the revision of the
+    CodePipeline artifact as shell exports, dotenv or JSON, computing them
+    in one process. Values that cannot be computed are left out.
+
+    Example:
+
+      \b
+      > eval "$(codebuilder env --image-name foo/bar)"
+      > echo ${IMAGE_FULL}
+      foo/bar:1.0.0-ab42ab42
+    """
+    dkr = DockerHelper(image_name, artifact_name, build_context)
+    values = compute_env(dkr, tags or DEFAULT_ENV_TAGS, prefix)
+    if format == 'json':
+        click.echo(json.dumps(dict(values), indent=4, sort_keys=True))
+    elif format == 'dotenv':
+        click.echo(format_dotenv(values), nl=False)
+    else:
+        for name, value in values:
+            click.echo('export {}={}'.format(name, quote(value)))
@@ -1,8 +1,11 @@
 import os
-import subprocess
+import re
+import sys
 import click
 
 from codebuilder.subcommands.aws import pass_aws
+from codebuilder.helpers.cache import atomic_write
+from codebuilder.helpers.knownhosts import host_name, keyscan_many, pinned_entries, update_known_hosts, update_ssh_config
 
 
 @click.group()
@@ -10,27 +13,83 @@ def github():
     pass
 
 
+def parse_keys(keys):
+    blobs = {}
+    for key in keys:
+        host, sep, blob = key.partition('=')
+        if not sep or not host or not blob:
+            raise click.BadParameter('expected HOST=BLOB, got {}'.format(key), param_hint='--key')
+        blobs[host] = blob
+    return blobs
+
+
 @github.command('ssh-config')
-@click.argument('encrypted-ssh-key', envvar='ENCRYPTED_SSH_KEY')
+@click.argument('encrypted-ssh-key', envvar='ENCRYPTED_SSH_KEY', required=False)
+@click.option('--key', 'keys', multiple=True, metavar='HOST=BLOB', help='Encrypted private key for HOST or HOST:PORT (repeatable)')
+@click.option('--host', 'hosts', multiple=True, metavar='HOST', help='Also trust HOST or HOST:PORT (repeatable)')
+@click.option('--keyscan', is_flag=True, help='Scan the host keys of hosts without pinned keys over the network')
+@click.option('--keyscan-timeout', type=float, default=5, help='Per host keyscan timeout (seconds)')
+@click.option('--workers', type=click.IntRange(1), default=8, help='Concurrent decryptions and keyscans')
 @pass_aws
-def ssh_config(aws, encrypted_ssh_key):
-    decrypted_ssh_key = aws.kms_decrypt(encrypted_ssh_key)
+def ssh_config(aws, encrypted_ssh_key, keys, hosts, keyscan, keyscan_timeout, workers):
+    """
+    Installs SSH keys and trusts the host keys of their Git hosts.
+
+    ENCRYPTED_SSH_KEY becomes ~/.ssh/id_rsa for github.com. Keys given with
+    --key go to ~/.ssh/codebuilder_<host>, mapped to their host in
+    ~/.ssh/config. Host keys come from the pinned keys shipped with
+    codebuilder (github.com, gitlab.com, bitbucket.org) and, with --keyscan,
+    from ssh-keyscan for the other hosts, and are added to
+    ~/.ssh/known_hosts only once. Hosts are checked before any key is
+    written.
+    """
+    blobs = parse_keys(keys)
+    if not encrypted_ssh_key and not blobs:
+        raise click.UsageError('Missing ENCRYPTED_SSH_KEY or --key')
+
+    trusted = (['github.com'] if encrypted_ssh_key else []) + sorted(blobs) + list(hosts)
+    trusted = sorted(set(trusted), key=trusted.index)
+    entries = pinned_entries([host_name(host) for host in trusted])
+    pinned = set(name for name, _, _ in entries)
+    unpinned = [host for host in trusted if host_name(host) not in pinned]
+    if unpinned and not keyscan:
+        raise click.UsageError('No pinned host key for {}, use --keyscan'.format(', '.join(host_name(host) for host in unpinned)))
+
     dir = os.path.expanduser('~/.ssh')
     if not os.path.exists(dir):
         os.makedirs(dir)
     ssh_key_file = dir + '/' + 'id_rsa'
     known_hosts_file = dir + '/' + 'known_hosts'
 
-    if os.path.isfile(ssh_key_file):
-        click.echo('{} already exists'.format(ssh_key_file), err=True)
-        raise click.Abort()
-    else:
-        with click.open_file(ssh_key_file, 'w') as f:
-            click.echo(decrypted_ssh_key, file=f)
-        os.chmod(ssh_key_file, 0o600)
-
-    cmdline = ['ssh-keyscan', '-H', 'github.com']
-    result = subprocess.check_output(cmdline)
-    with click.open_file(known_hosts_file, 'a') as f:
-        click.echo(result, file=f)
-    os.chmod(known_hosts_file, 0o600)
+    if encrypted_ssh_key:
+        if os.path.isfile(ssh_key_file):
+            click.echo('{} already exists'.format(ssh_key_file), err=True)
+            raise click.Abort()
+        blobs[ssh_key_file] = encrypted_ssh_key
+
+    plaintexts, errors = aws.kms_decrypt_many(blobs, workers=workers)
+    if errors:
+        for name, error in sorted(errors.items()):
+            click.echo('Failed to decrypt key for {}: {}'.format(name, error), err=True)
+        sys.exit(1)
+
+    identities = []
+    for host, plaintext in sorted(plaintexts.items()):
+        key_file = host if host == ssh_key_file else dir + '/' + 'codebuilder_' + re.sub(r'[^\w.-]', '_', host)
+        atomic_write(key_file, (plaintext.rstrip('\n') + '\n').encode('utf-8'), mode=0o600)
+        if key_file != ssh_key_file:
+            identities.append((host, key_file))
+    if identities:
+        update_ssh_config(dir + '/' + 'config', identities)
+
+    failed = False
+    for host, scanned, error in keyscan_many(unpinned, timeout=keyscan_timeout, workers=workers):
+        if error is not None:
+            click.echo('Keyscan failed for {}: {}'.format(host, error), err=True)
+            failed = True
+        entries += scanned
+
+    added = update_known_hosts(known_hosts_file, entries)
+    aws.log('{} host key(s) added to {}'.format(added, known_hosts_file))
+    if failed:
+        sys.exit(1)
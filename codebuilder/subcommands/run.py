@@ -0,0 +1,111 @@
+import sys
+import traceback
+import click
+
+from codebuilder.helpers.aws import AWSHelper
+from codebuilder.helpers.steps import StepError, ThreadLocalStream, capture_stream, captured_bytes, load_steps, run_steps
+
+
+def invoke_step(root, args):
+    """
+    Invokes a subcommand command line below the root context, like the
+    command line `codebuilder <global options> <args>` would, and returns
+    its exit status.
+    """
+    try:
+        name, command, rest = root.command.resolve_command(root, list(args))
+        with command.make_context(name, rest, parent=root) as ctx:
+            command.invoke(ctx)
+        return 0
+    except click.ClickException as e:
+        e.show()
+        return e.exit_code
+    except click.Abort:
+        click.echo('Aborted!', err=True)
+        return 1
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        click.echo(e.code, err=True)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+
+
+@click.command()
+@click.argument('step-file', type=click.File('r'))
+@click.option('--workers', type=click.IntRange(1), default=4, help='Steps run concurrently')
+@click.pass_context
+def run(ctx, step_file, workers):
+    """
+    Runs the codebuilder commands of a YAML or JSON step file in this
+    process. Steps run as soon as the steps they need succeeded; their
+    output is printed in the order of the file.
+
+    Example:
+
+      \b
+      steps:
+        - name: login
+          run: aws ecr login
+        - name: ssh
+          run: github ssh-config
+        - name: image
+          run: docker get-image full --format json --source-json-file config.json --in-place Parameters DockerImage
+          needs: [login]
+    """
+    try:
+        steps = load_steps(step_file)
+    except StepError as e:
+        raise click.UsageError(str(e))
+
+    root = ctx.find_root()
+    for step in steps.values():
+        if step['args'][0] in ('run', 'serve'):
+            raise click.UsageError('Step {} cannot run `{}`'.format(step['name'], step['args'][0]))
+        try:
+            root.command.resolve_command(root, list(step['args']))
+        except click.UsageError as e:
+            raise click.UsageError('Step {}: {}'.format(step['name'], e.message))
+
+    # Commands taking the AWSHelper from the context share this one
+    root.obj = AWSHelper()
+
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = ThreadLocalStream(stdout), ThreadLocalStream(stderr)
+
+    def execute(step):
+        out, err = capture_stream(), capture_stream()
+        sys.stdout.capture(out)
+        sys.stderr.capture(err)
+        try:
+            status = invoke_step(root, step['args'])
+        finally:
+            sys.stdout.release()
+            sys.stderr.release()
+        return {'status': status, 'stdout': captured_bytes(out), 'stderr': captured_bytes(err)}
+
+    summary = []
+    try:
+        for step, result in run_steps(steps, execute, workers):
+            summary.append((step, result))
+            if result['status'] is None:
+                continue
+            click.echo('==> {}'.format(step['name']), file=stderr)
+            click.echo(result['stdout'], file=stdout, nl=False)
+            click.echo(result['stderr'], file=stderr, nl=False)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+    click.echo('{:<40} {:<12} {:>8}'.format('step', 'status', 'seconds'), err=True)
+    for step, result in summary:
+        if result['status'] is None:
+            status, seconds = 'skipped', '-'
+        else:
+            status = 'ok' if result['status'] == 0 else 'failed ({})'.format(result['status'])
+            seconds = '{:.2f}'.format(result['seconds'])
+        click.echo('{:<40} {:<12} {:>8}'.format(step['name'], status, seconds), err=True)
+
+    if any(result['status'] != 0 for _, result in summary):
+        sys.exit(1)
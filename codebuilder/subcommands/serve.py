@@ -0,0 +1,29 @@
+import sys
+import signal
+import click
+
+from codebuilder.daemon import DEFAULT_IDLE_TIMEOUT, Server
+
+
+@click.command()
+@click.option('--socket', 'path', type=click.Path(dir_okay=False), envvar='CODEBUILDER_SOCKET', help='Unix socket to listen on')
+@click.option('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT, envvar='CODEBUILDER_IDLE_TIMEOUT', help='Exit after this many seconds without a request')
+@click.pass_context
+def serve(ctx, path, idle_timeout):
+    """Run codebuilder commands from a resident process"""
+    server = Server(path, idle_timeout)
+    try:
+        listener = server.bind()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Warm up what the first forwarded command would otherwise import
+    from codebuilder.helpers.clients import _import_boto3
+    root = ctx.find_root()
+    for name in root.command.list_commands(root):
+        root.command.get_command(root, name)
+    _import_boto3()
+
+    click.echo('Listening on {}'.format(server.path), err=True)
+    server.serve_forever(listener)
@@ -40,37 +40,44 @@ setup(
 
         'License :: OSI Approved :: MIT License',
 
-        # Specify the Python versions you support here. In particular, ensure
-        # that you indicate whether you support Python 2, Python 3 or both.
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.6',
-        'Programming Language :: Python :: 2.7',
+        # Specify the Python versions you support here. botocore>=1.27
+        # requires Python 3.7 or later.
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
 
     keywords='aws codebuild codepipeline docker kms',
 
-    packages=find_packages(exclude=['contrib', 'docs', 'tests*']),
+    packages=find_packages(exclude=['benchmarks', 'contrib', 'docs', 'tests*']),
     package_data={
         'codebuilder': [
-            'codebuilder-complete.sh'
+            'codebuilder-complete.sh',
+            'known_hosts'
         ]
     },
     include_package_data=True,
 
     install_requires=[
         'click==6.7',
-        'botocore>=1.5.0,<1.6.0',
-        'boto3>=1.4.4',
+        'botocore>=1.27.0',
+        'boto3>=1.24.0',
         'dpath==1.4'
     ],
 
+    python_requires='>=3.7',
+
+    extras_require={
+        'yaml': ['PyYAML']
+    },
+
     entry_points={
         'console_scripts': [
-            'codebuilder=codebuilder.cli:cli',
+            'codebuilder=codebuilder.daemon:main',
         ],
     },
 
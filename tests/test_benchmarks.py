@@ -0,0 +1,33 @@
+from benchmarks.__main__ import BENCHMARKS, compare, run_benchmarks, select
+from benchmarks.backends import ECRBackend, CodePipelineBackend
+from codebuilder.helpers.aws import AWSHelper
+
+
+def test_ecr_backend_serves_paginator_and_workers():
+    backend = ECRBackend(250)
+    results = list(AWSHelper().ecr_prune('benchmark', workers=4, client=backend.client))
+    assert len(results) == 250 and not backend.images
+    assert backend.calls == {'describe_images': 3, 'batch_delete_image': 3}
+
+
+def test_codepipeline_backend_superseded_build():
+    backend = CodePipelineBackend(stages=2, actions=2, superseded=True, history=150)
+    aws = AWSHelper()
+    aws.client = lambda service, region=None: backend.client
+    assert aws._codepipeline_get_artifacts_revision('benchmark', CodePipelineBackend.BUILD_ID)[0]['revisionId'] == 'ab42ab42cd'
+    assert backend.calls['list_action_executions'] == 2
+
+
+def test_quick_suite_runs():
+    names = select(['ecr_prune*', 'codepipeline*', 'output*'], quick=True)
+    assert names and all(BENCHMARKS[name][1] for name in names)
+    results = run_benchmarks(names, repeat=1)
+    assert list(results) == names
+
+
+def test_compare_flags_regressions():
+    baseline = {'a': {'seconds': 1.0}, 'b': {'seconds': 1.0}, 'gone': {'seconds': 1.0}}
+    results = {'a': {'seconds': 1.1}, 'b': {'seconds': 1.5}, 'new': {'seconds': 1.0}}
+    rows = dict((row[0], row[1:]) for row in compare(results, baseline, threshold=0.25))
+    assert sorted(rows) == ['a', 'b']
+    assert not rows['a'][-1] and rows['b'][-1]
@@ -0,0 +1,84 @@
+import threading
+import time
+
+from codebuilder.helpers.cache import FileCache
+
+
+class TestFileCache:
+    def test_get_set(self, tmpdir):
+        cache = FileCache('test', directory=str(tmpdir))
+        assert cache.get(['a', 'b']) is None
+        assert cache.set(['a', 'b'], {'x': 1}) == {'x': 1}
+        assert FileCache('test', directory=str(tmpdir)).get(['a', 'b']) == {'x': 1}
+
+    def test_counters(self, tmpdir):
+        counters = {}
+        cache = FileCache('test', directory=str(tmpdir), counters=counters)
+        cache.get_or_set('key', lambda: 'value')
+        cache.get_or_set('key', lambda: 'value')
+        assert counters == {'test.cache.misses': 1, 'test.cache.hits': 1}
+
+    def test_ttl(self, tmpdir):
+        cache = FileCache('test', directory=str(tmpdir), ttl=-1)
+        cache.set('key', 'value')
+        assert cache.get('key') is None
+
+    def test_none_is_not_cached(self, tmpdir):
+        cache = FileCache('test', directory=str(tmpdir))
+        assert cache.get_or_set('key', lambda: None) is None
+        assert cache.get_or_set('key', lambda: 'value') == 'value'
+
+    def test_eviction(self, tmpdir):
+        cache = FileCache('test', directory=str(tmpdir), max_entries=3)
+        for i in range(5):
+            cache.set(i, i)
+            time.sleep(0.01)
+        assert [cache.get(i) for i in range(5)] == [None, None, 2, 3, 4]
+        assert len(tmpdir.join('test').listdir(lambda p: p.ext == '.json')) == 3
+
+    def test_concurrent_get_or_set_computes_once(self, tmpdir):
+        calls = []
+
+        def factory():
+            calls.append(1)
+            time.sleep(0.05)
+            return 'value'
+
+        results = []
+
+        def worker():
+            cache = FileCache('test', directory=str(tmpdir))
+            results.append(cache.get_or_set('key', factory))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == ['value'] * 8
+        assert len(calls) == 1
+
+    def test_concurrent_get_or_set_of_other_keys_overlap(self, tmpdir):
+        running, overlaps = [], []
+
+        def factory():
+            running.append(1)
+            time.sleep(0.1)
+            overlaps.append(len(running))
+            running.pop()
+            return 'value'
+
+        def worker(key):
+            FileCache('test', directory=str(tmpdir)).get_or_set(key, factory)
+
+        threads = [threading.Thread(target=worker, args=(key,)) for key in ('a', 'b')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert max(overlaps) == 2
+
+    def test_unwritable_directory(self, tmpdir):
+        tmpdir.join('file').write('')
+        cache = FileCache('test', directory=str(tmpdir.join('file')))
+        assert cache.get_or_set('key', lambda: 'value') == 'value'
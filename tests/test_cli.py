@@ -1,23 +1,206 @@
 from click.testing import CliRunner
+from botocore.exceptions import ClientError
 import pytest
 import os
+import sys
 import json
+import time
+import base64
 
 from codebuilder import __version__ as VERSION
 from codebuilder.cli import cli as codebuilder
+from codebuilder.helpers.aws import AWSHelper
+from codebuilder.helpers.contenthash import content_hash
+from codebuilder.helpers.docker import DockerHelper
 
 runner = CliRunner()
 
+FAKE_DOCKER = '''#!{python}
+import base64, json, os, sys
+with open({log!r}, 'a') as f:
+    f.write(' '.join(sys.argv[1:]) + '\\n')
+if sys.argv[1] == 'login':
+    user, password, registry = sys.argv[3], sys.argv[5], sys.argv[6]
+    directory = os.environ['DOCKER_CONFIG']
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    auth = base64.b64encode('{{}}:{{}}'.format(user, password).encode()).decode()
+    with open(os.path.join(directory, 'config.json'), 'w') as f:
+        json.dump({{'auths': {{registry: {{'auth': auth}}}}}}, f)
+'''
+
+def b64(value):
+    return base64.b64encode(value.encode('utf-8')).decode('utf-8')
+
+class FakeKMS(object):
+    def decrypt(self, CiphertextBlob):
+        if CiphertextBlob == b'invalid':
+            raise ClientError({'Error': {'Code': 'InvalidCiphertextException', 'Message': 'invalid'}}, 'Decrypt')
+        return {'Plaintext': CiphertextBlob}
+
+FAKE_CLIENTS = {'kms': FakeKMS()}
+
+def fake_client(self, service, region=None):
+    return FAKE_CLIENTS[service]
+
+def ecr_login_env(tmpdir, monkeypatch):
+    """Stubs ECR authorization tokens and docker, returns the list of token requests"""
+    monkeypatch.setenv('CODEBUILDER_CACHE_DIR', str(tmpdir.join('cache')))
+    monkeypatch.setenv('DOCKER_CONFIG', str(tmpdir.join('docker-config')))
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'eu-west-1')
+    monkeypatch.setenv('PATH', str(tmpdir), prepend=os.pathsep)
+    fake_docker(tmpdir)
+    calls = []
+    def authorizations(self, region, registry_ids):
+        calls.append((region, registry_ids))
+        return [{
+            'user': 'AWS',
+            'token': 'secret-{}'.format(region or 'eu-west-1'),
+            'proxyEndpoint': 'https://{}.dkr.ecr.{}.amazonaws.com'.format(registry_id, region or 'eu-west-1'),
+            'expiresAt': time.time() + 43200
+        } for registry_id in registry_ids or ['123456789012']]
+    monkeypatch.setattr(AWSHelper, '_ecr_get_authorizations', authorizations)
+    return calls
+
+def fake_docker(tmpdir):
+    """Installs a `docker` executable in tmpdir logging its arguments to docker.log"""
+    script = tmpdir.join('docker')
+    script.write(FAKE_DOCKER.format(python=sys.executable, log=str(tmpdir.join('docker.log'))))
+    script.chmod(0o755)
+    return script
+
 def test_version():
     r = runner.invoke(codebuilder, ['--version'])
     assert r.exit_code == 0
     assert VERSION in r.output
 
+@pytest.mark.parametrize('command', [
+    ['aws', 'kms', 'batch-decrypt'], ['aws', 'ecr', 'login'], ['aws', 'ecr', 'prune'], ['aws', 'secrets', 'fetch'],
+    ['aws', 'cache', 'save'], ['aws', 'cache', 'restore'], ['docker', 'apply-tags'], ['docker', 'image-exists'],
+    ['docker', 'retag'], ['docker', 'cache-pull'], ['github', 'ssh-config'], ['run'],
+])
+def test_workers_must_be_positive(command):
+    r = runner.invoke(codebuilder, command + ['--workers', '0'])
+    assert r.exit_code == 2
+    assert 'Invalid value for "--workers"' in r.output
+
 class TestAWS:
     def test_base(self):
         r = runner.invoke(codebuilder, ['aws'])
         assert r.exit_code == 0
 
+    def test_get_revision_cache(self, tmpdir, monkeypatch):
+        monkeypatch.setenv('CODEBUILDER_CACHE_DIR', str(tmpdir))
+        monkeypatch.setenv('CODEBUILD_BUILD_ID', 'build:1')
+        monkeypatch.setenv('CODEBUILD_INITIATOR', 'codepipeline/pipeline')
+        calls = []
+        def revision(self, pipeline_name, build_id):
+            calls.append((pipeline_name, build_id))
+            return [{'name': 'MyApp', 'revisionId': 'ab42ab42cd'}]
+        monkeypatch.setattr(AWSHelper, '_codepipeline_get_artifacts_revision', revision)
+        for _ in range(2):
+            r = runner.invoke(codebuilder, ['aws', 'codepipeline', 'get-revision'])
+            assert r.output == 'ab42ab42cd\n'
+        assert calls == [('pipeline', 'build:1')]
+
+        r = runner.invoke(codebuilder, ['--verbose', 'aws', 'codepipeline', 'get-revision'])
+        assert 'codepipeline.cache.hits: 1' in r.output
+
+        r = runner.invoke(codebuilder, ['--no-cache', 'aws', 'codepipeline', 'get-revision'])
+        assert r.output == 'ab42ab42cd\n'
+        assert len(calls) == 2
+
+    def test_ecr_login_reuses_token_and_credentials(self, tmpdir, monkeypatch):
+        calls = ecr_login_env(tmpdir, monkeypatch)
+        for _ in range(2):
+            r = runner.invoke(codebuilder, ['aws', 'ecr', 'login'])
+            assert r.exit_code == 0
+        assert r.output.startswith('Credentials current: https://123456789012.dkr.ecr.eu-west-1.amazonaws.com')
+        assert calls == [(None, [])]
+        config = json.loads(tmpdir.join('docker-config', 'config.json').read())
+        assert config['auths']['https://123456789012.dkr.ecr.eu-west-1.amazonaws.com']['auth'] == b64('AWS:secret-eu-west-1')
+        assert not tmpdir.join('docker.log').check()
+
+        r = runner.invoke(codebuilder, ['aws', 'ecr', 'login', '--force'])
+        assert r.output.startswith('Login Succeeded: https://123456789012.dkr.ecr.eu-west-1.amazonaws.com')
+
+    def test_ecr_login_with_credentials_store(self, tmpdir, monkeypatch):
+        ecr_login_env(tmpdir, monkeypatch)
+        tmpdir.join('docker-config', 'config.json').write('{"credsStore": "fake"}', ensure=True)
+        for _ in range(2):
+            r = runner.invoke(codebuilder, ['aws', 'ecr', 'login'])
+            assert r.exit_code == 0
+        assert tmpdir.join('docker.log').readlines() == ['login -u AWS -p secret-eu-west-1 https://123456789012.dkr.ecr.eu-west-1.amazonaws.com\n']
+
+    def test_ecr_login_many_targets(self, tmpdir, monkeypatch):
+        calls = ecr_login_env(tmpdir, monkeypatch)
+        tmpdir.join('docker-config', 'config.json').write('{"credsStore": "fake", "auths": {"other": {}}}', ensure=True)
+        r = runner.invoke(codebuilder, [
+            'aws', 'ecr', 'login', '--region', 'eu-west-1', '--region', 'us-east-1',
+            '--registry-id', '123456789012', '--registry-id', '210987654321'
+        ])
+        assert r.exit_code == 0
+        assert sorted(calls) == [('eu-west-1', ['123456789012', '210987654321']), ('us-east-1', ['123456789012', '210987654321'])]
+        assert len(r.output.splitlines()) == 4
+        assert len(tmpdir.join('docker.log').readlines()) == 4
+
+    def test_ecr_login_fetches_regions_concurrently(self, tmpdir, monkeypatch):
+        ecr_login_env(tmpdir, monkeypatch)
+        fetch = AWSHelper._ecr_get_authorizations
+        spans = []
+        def slow_authorizations(self, region, registry_ids):
+            start = time.time()
+            time.sleep(0.2)
+            spans.append((start, time.time()))
+            return fetch(self, region, registry_ids)
+        monkeypatch.setattr(AWSHelper, '_ecr_get_authorizations', slow_authorizations)
+        r = runner.invoke(codebuilder, ['aws', 'ecr', 'login', '--region', 'eu-west-1', '--region', 'us-east-1'])
+        assert r.exit_code == 0
+        (first_start, first_end), (second_start, second_end) = sorted(spans)
+        assert second_start < first_end
+
+    def test_kms_decrypt(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(AWSHelper, 'client', fake_client)
+        r = runner.invoke(codebuilder, ['aws', 'kms', 'decrypt', b64('secret')])
+        assert (r.exit_code, r.output) == (0, 'secret\n')
+
+        source = tmpdir.join('config.json')
+        source.write(json.dumps({'Parameters': {'Existing': 'value'}}))
+        r = runner.invoke(codebuilder, [
+            'aws', 'kms', 'decrypt', '--format', 'json', '--source-json-file', str(source), '--in-place',
+            b64('secret'), 'Parameters', 'DbPassword'
+        ])
+        assert r.exit_code == 0
+        assert json.loads(source.read()) == {'Parameters': {'Existing': 'value', 'DbPassword': 'secret'}}
+
+    def test_kms_batch_decrypt_in_place(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(AWSHelper, 'client', fake_client)
+        source = tmpdir.join('config.json')
+        source.write(json.dumps({'Parameters': {'Existing': 'value', 'Padding': 'x' * 100}}))
+        blobs = tmpdir.join('blobs.json')
+        blobs.write(json.dumps({'Parameters/ApiKey': b64('api-key')}))
+        r = runner.invoke(codebuilder, [
+            'aws', 'kms', 'batch-decrypt', '--blobs-file', str(blobs),
+            '--set', 'Parameters/DbPassword=' + b64('db-password'),
+            '--source-json-file', str(source), '--in-place'
+        ])
+        assert r.exit_code == 0
+        assert json.loads(source.read()) == {'Parameters': {
+            'ApiKey': 'api-key', 'DbPassword': 'db-password', 'Existing': 'value', 'Padding': 'x' * 100
+        }}
+
+    def test_kms_batch_decrypt_reports_failures(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(AWSHelper, 'client', fake_client)
+        source = tmpdir.join('config.json')
+        source.write('{}')
+        r = runner.invoke(codebuilder, [
+            'aws', 'kms', 'batch-decrypt', '--set', 'a=' + b64('ok'), '--set', 'b=' + b64('invalid'),
+            '--source-json-file', str(source), '--in-place'
+        ])
+        assert r.exit_code == 1
+        assert 'Failed to decrypt b' in r.output
+        assert source.read() == '{}'
+
 class TestDocker:
     def test_base(self):
         r = runner.invoke(codebuilder, ['docker'])
@@ -53,6 +236,79 @@ class TestDocker:
         r = runner.invoke(codebuilder, ['docker', 'get-tag', 'latest'])
         assert r.output == 'latest\n'
 
+    def test_get_tag_version_skips_codepipeline(self, tmpdir, monkeypatch):
+        tmpdir.join('VERSION').write('1.0.0')
+        tmpdir.chdir()
+        monkeypatch.setenv('CODEBUILD_BUILD_ID', 'build:1')
+        monkeypatch.setenv('CODEBUILD_INITIATOR', 'codepipeline/pipeline')
+        def fail(self):
+            raise AssertionError('unexpected CodePipeline lookup')
+        monkeypatch.setattr(AWSHelper, 'codepipeline_get_artifacts_revision', fail)
+        r = runner.invoke(codebuilder, ['docker', 'get-tag', 'version'])
+        assert r.output == '1.0.0\n'
+
+    def test_revision_lookup_is_memoized(self, tmpdir, monkeypatch):
+        tmpdir.join('VERSION').write('1.0.0')
+        tmpdir.chdir()
+        calls = []
+        def revision(self):
+            calls.append(1)
+            return [{'name': 'MyApp', 'revisionId': 'ab42ab42cd'}]
+        monkeypatch.setattr(AWSHelper, 'codepipeline_get_artifacts_revision', revision)
+        dkr = DockerHelper('foo/bar')
+        assert dkr.get_image('full') == 'foo/bar:1.0.0-ab42ab42'
+        assert dkr.get_tag('revision-id') == 'ab42ab42'
+        assert len(calls) == 1
+
+class TestEnv:
+    def setup(self, tmpdir, monkeypatch):
+        tmpdir.join('VERSION').write('1.0.0')
+        tmpdir.chdir()
+        monkeypatch.setenv('GITHUB_BRANCH', 'feature/x')
+        monkeypatch.setenv('CODEBUILDER_CACHE_DIR', str(tmpdir.join('cache')))
+        monkeypatch.setenv('CODEBUILD_BUILD_ID', 'build:1')
+        monkeypatch.setenv('CODEBUILD_INITIATOR', 'codepipeline/pipeline')
+        monkeypatch.delenv('DOCKER_REGISTRY', raising=False)
+        monkeypatch.delenv('IMAGE_NAME', raising=False)
+        calls = []
+        def revision(self, pipeline_name, build_id):
+            calls.append(1)
+            return [{'name': 'MyApp', 'revisionId': 'ab42ab42cd', 'revisionSummary': "Fix 'quotes'", 'created': '2020-01-01 00:00:00+00:00'}]
+        monkeypatch.setattr(AWSHelper, '_codepipeline_get_artifacts_revision', revision)
+        return calls
+
+    def test_export(self, tmpdir, monkeypatch):
+        calls = self.setup(tmpdir, monkeypatch)
+        r = runner.invoke(codebuilder, ['--no-cache', 'env', '--image-name', 'foo/bar', '-t', 'full', '-t', 'revision-id', '-t', 'latest'])
+        assert r.exit_code == 0
+        assert r.output.splitlines() == [
+            'export VERSION=1.0.0',
+            'export TAG_FULL=1.0.0-ab42ab42',
+            'export TAG_REVISION_ID=ab42ab42',
+            'export TAG_LATEST=latest',
+            'export IMAGE_FULL=foo/bar:1.0.0-ab42ab42',
+            'export IMAGE_REVISION_ID=foo/bar:ab42ab42',
+            'export IMAGE_LATEST=foo/bar:latest',
+            'export ARTIFACT_NAME=MyApp',
+            'export REVISION_ID=ab42ab42cd',
+            'export REVISION_SUMMARY=\'Fix \'"\'"\'quotes\'"\'"\'\'',
+            "export REVISION_CREATED='2020-01-01 00:00:00+00:00'",
+        ]
+        assert len(calls) == 1
+
+    def test_formats(self, tmpdir, monkeypatch):
+        self.setup(tmpdir, monkeypatch)
+        r = runner.invoke(codebuilder, ['env', '--format', 'json', '--prefix', 'CB_'])
+        assert r.exit_code == 0
+        values = json.loads(r.output)
+        assert values['CB_TAG_BRANCH'] == 'feature/x'
+        assert 'CB_IMAGE_FULL' not in values
+        assert 'CB_TAG_CONTENT_HASH' not in values
+        r = runner.invoke(codebuilder, ['env', '--format', 'dotenv', '-t', 'content-hash'])
+        assert r.exit_code == 0
+        assert r.output.splitlines()[:2] == ['VERSION=1.0.0', 'TAG_CONTENT_HASH=' + content_hash('.')[:12]]
+
+
 class TestGithub:
     def test_base(self):
         r = runner.invoke(codebuilder, ['github'])
@@ -0,0 +1,55 @@
+import pytest
+from botocore.stub import Stubber
+
+from codebuilder.helpers.clients import ClientPool, make_config
+from codebuilder.helpers.trace import TRACER
+
+
+@pytest.fixture(autouse=True)
+def region(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'eu-west-1')
+
+
+class TestClientPool:
+    def test_clients_are_reused(self):
+        pool = ClientPool()
+        counters = {}
+        ecr = pool.client('ecr', counters=counters)
+        assert pool.client('ecr', counters=counters) is ecr
+        assert pool.client('ecr', region='us-east-1', counters=counters) is not ecr
+        assert pool.client('kms', counters=counters) is not ecr
+        assert (pool.created, pool.reused) == (3, 1)
+        assert counters == {'aws.clients.created': 3, 'aws.clients.reused': 1}
+
+    def test_sessions_are_shared(self):
+        pool = ClientPool()
+        assert pool.session() is pool.session()
+        assert pool.client('ecr', region='us-east-1').meta.region_name == 'us-east-1'
+
+    def test_tracing_enabled_after_clients_are_created(self, monkeypatch):
+        monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'a')
+        monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'b')
+        client = ClientPool().client('kms')
+        TRACER.enable()
+        try:
+            with Stubber(client) as stubber:
+                stubber.add_response('list_keys', {'Keys': []})
+                client.list_keys()
+            assert [e['name'] for e in TRACER.events if e.get('cat') == 'aws'] == ['kms.ListKeys']
+        finally:
+            TRACER.disable()
+
+    def test_options(self):
+        pool = ClientPool()
+        options = {'max_pool_connections': 16, 'retry_mode': 'adaptive', 'max_attempts': 7, 'connect_timeout': 2.0, 'read_timeout': 30.0, 'tcp_keepalive': True}
+        client = pool.client('ecr', options=options)
+        config = client.meta.config
+        assert config.max_pool_connections == 16
+        assert config.retries['mode'] == 'adaptive'
+        assert config.retries['total_max_attempts'] == 7
+        assert (config.connect_timeout, config.read_timeout, config.tcp_keepalive) == (2.0, 30.0, True)
+        assert pool.client('ecr') is not client
+
+    def test_default_config(self):
+        config = make_config({})
+        assert config.max_pool_connections == 50
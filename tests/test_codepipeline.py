@@ -0,0 +1,89 @@
+import datetime
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+from codebuilder.helpers.aws import AWSHelper, codepipeline_index_state
+
+BUILD_ID = 'project:0b8c2b6e-1ad7-4c3a-9a39-6d8bb9f1d2f1'
+REVISIONS = [{'name': 'MyApp', 'revisionId': 'ab42ab42cd'}]
+
+
+def pipeline_state(stages=50, actions=20, build_id=None):
+    now = datetime.datetime(2017, 1, 1)
+    state = {'pipelineName': 'pipeline', 'stageStates': []}
+    for stage in range(stages):
+        stage_state = {
+            'stageName': 'Stage{}'.format(stage),
+            'latestExecution': {'pipelineExecutionId': 'execution-{}'.format(stage), 'status': 'Succeeded'},
+            'actionStates': []
+        }
+        for action in range(actions):
+            stage_state['actionStates'].append({
+                'actionName': 'Action{}'.format(action),
+                'latestExecution': {'status': 'Succeeded', 'externalExecutionId': 'project:{}-{}'.format(stage, action), 'lastStatusChange': now}
+            })
+        state['stageStates'].append(stage_state)
+    if build_id:
+        state['stageStates'][-1]['actionStates'][-1]['latestExecution']['externalExecutionId'] = build_id
+    return state
+
+
+def action_executions(count, build_id=None, execution_id='superseded'):
+    details = [{
+        'pipelineExecutionId': 'execution-{}'.format(i),
+        'output': {'executionResult': {'externalExecutionId': 'project:{}'.format(i)}}
+    } for i in range(count)]
+    if build_id:
+        details[-1] = {'pipelineExecutionId': execution_id, 'output': {'executionResult': {'externalExecutionId': build_id}}}
+    return {'actionExecutionDetails': details}
+
+
+@pytest.fixture
+def codepipeline(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'eu-west-1')
+    client = boto3.session.Session(aws_access_key_id='x', aws_secret_access_key='x').client('codepipeline')
+    monkeypatch.setattr(AWSHelper, 'client', lambda self, service, region=None: client)
+    with Stubber(client) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+
+def test_index_state():
+    index = codepipeline_index_state(pipeline_state(stages=3, actions=2, build_id=BUILD_ID))
+    assert index[BUILD_ID] == 'execution-2'
+    assert index['project:0-1'] == 'execution-0'
+    assert len(index) == 6
+
+
+def test_lookup_from_state(codepipeline):
+    codepipeline.add_response('get_pipeline_state', pipeline_state(build_id=BUILD_ID), {'name': 'pipeline'})
+    codepipeline.add_response('get_pipeline_execution', {'pipelineExecution': {'artifactRevisions': REVISIONS}},
+                              {'pipelineName': 'pipeline', 'pipelineExecutionId': 'execution-49'})
+    helper = AWSHelper()
+    assert helper._codepipeline_get_artifacts_revision('pipeline', BUILD_ID) == REVISIONS
+    assert helper.counters['codepipeline.state.calls'] == 1
+    assert 'codepipeline.search.calls' not in helper.counters
+
+
+def test_lookup_falls_back_to_action_executions(codepipeline):
+    codepipeline.add_response('get_pipeline_state', pipeline_state(), {'name': 'pipeline'})
+    codepipeline.add_response('list_action_executions', dict(action_executions(100), nextToken='2'), {'pipelineName': 'pipeline', 'maxResults': 100})
+    codepipeline.add_response('list_action_executions', action_executions(100, build_id=BUILD_ID), {'pipelineName': 'pipeline', 'maxResults': 100, 'nextToken': '2'})
+    codepipeline.add_response('get_pipeline_execution', {'pipelineExecution': {'artifactRevisions': REVISIONS}},
+                              {'pipelineName': 'pipeline', 'pipelineExecutionId': 'superseded'})
+    helper = AWSHelper()
+    assert helper._codepipeline_get_artifacts_revision('pipeline', BUILD_ID) == REVISIONS
+    assert helper.counters['codepipeline.search.calls'] == 2
+    assert 'codepipeline.search.ms' in helper.counters
+
+
+def test_fallback_search_is_bounded(codepipeline):
+    codepipeline.add_response('get_pipeline_state', pipeline_state(), {'name': 'pipeline'})
+    for page in range(5):
+        params = {'pipelineName': 'pipeline', 'maxResults': 100}
+        if page:
+            params['nextToken'] = str(page)
+        codepipeline.add_response('list_action_executions', dict(action_executions(100), nextToken=str(page + 1)), params)
+    assert AWSHelper()._codepipeline_get_artifacts_revision('pipeline', BUILD_ID) is None
@@ -0,0 +1,109 @@
+import os
+
+from click.testing import CliRunner
+
+from codebuilder.cli import cli as codebuilder
+from codebuilder.helpers.contenthash import DockerIgnore, content_hash, walk_context
+
+runner = CliRunner()
+
+
+def make_tree(tmpdir, files):
+    for path, content in files.items():
+        tmpdir.join(path).write(content, ensure=True)
+
+
+def paths(context):
+    return [path for path, _ in walk_context(str(context))]
+
+
+class TestDockerIgnore:
+    def test_patterns(self):
+        ignore = DockerIgnore(['# comment', '', '*.pyc', '/build', 'docs/**/*.md', '!docs/keep.md'])
+        assert ignore.matches('foo.pyc')[0]
+        assert not ignore.matches('src/foo.pyc')[0]
+        assert ignore.matches('build')[0]
+        assert ignore.matches('docs/a/b/c.md')[0]
+        assert ignore.matches('docs/c.md')[0]
+        assert not ignore.matches('docs/keep.md')[0]
+        assert not ignore.matches('README.md')[0]
+
+    def test_character_classes(self):
+        ignore = DockerIgnore(['file[0-9].txt', 'log?', 'x[!a].y'])
+        assert ignore.matches('file1.txt')[0]
+        assert not ignore.matches('filea.txt')[0]
+        assert ignore.matches('log1')[0]
+        assert not ignore.matches('log/1')[0]
+        assert ignore.matches('xb.y')[0]
+        assert not ignore.matches('xa.y')[0]
+
+    def test_walk(self, tmpdir):
+        make_tree(tmpdir, {
+            '.dockerignore': 'node_modules\n*.log\nDockerfile\ntmp\n!tmp/keep\n',
+            'Dockerfile': 'FROM scratch\n',
+            'app.py': '',
+            'debug.log': '',
+            'node_modules/a/index.js': '',
+            'src/lib.py': '',
+            'src/trace.log': '',
+            'tmp/drop': '',
+            'tmp/keep': '',
+        })
+        assert paths(tmpdir) == ['.dockerignore', 'Dockerfile', 'app.py', 'src', 'src/lib.py', 'src/trace.log', 'tmp/keep']
+
+
+class TestContentHash:
+    def test_stable(self, tmpdir):
+        make_tree(tmpdir.join('a'), {'Dockerfile': 'FROM scratch\n', 'src/app.py': 'print(1)\n'})
+        make_tree(tmpdir.join('b'), {'src/app.py': 'print(1)\n', 'Dockerfile': 'FROM scratch\n'})
+        assert content_hash(str(tmpdir.join('a'))) == content_hash(str(tmpdir.join('b')))
+
+    def test_changes(self, tmpdir):
+        make_tree(tmpdir, {'.dockerignore': '*.log\n', 'app.py': 'print(1)\n'})
+        digest = content_hash(str(tmpdir))
+        tmpdir.join('debug.log').write('ignored')
+        assert content_hash(str(tmpdir)) == digest
+        tmpdir.join('app.py').chmod(0o755)
+        executable = content_hash(str(tmpdir))
+        assert executable != digest
+        tmpdir.join('app.py').write('print(2)\n')
+        assert content_hash(str(tmpdir)) not in (digest, executable)
+        tmpdir.join('empty').mkdir()
+        assert content_hash(str(tmpdir)) != executable
+
+    def test_cache(self, tmpdir):
+        context, cache_dir = tmpdir.join('context'), str(tmpdir.join('cache'))
+        make_tree(context, {'a.txt': 'a', 'b.txt': 'b', 'c/d.txt': 'd'})
+        old = 1500000000
+        for path in ('a.txt', 'b.txt', 'c/d.txt'):
+            os.utime(str(context.join(path)), (old, old))
+        counters = {}
+        digest = content_hash(str(context), cache_dir=cache_dir, counters=counters)
+        assert counters == {'content_hash.files': 3, 'content_hash.hashed': 3}
+
+        counters = {}
+        assert content_hash(str(context), cache_dir=cache_dir, counters=counters) == digest
+        assert counters['content_hash.hashed'] == 0
+
+        context.join('b.txt').write('B')
+        os.utime(str(context.join('b.txt')), (old + 1, old + 1))
+        counters = {}
+        assert content_hash(str(context), cache_dir=cache_dir, counters=counters) != digest
+        assert counters['content_hash.hashed'] == 1
+        assert content_hash(str(context)) == content_hash(str(context), cache_dir=cache_dir)
+
+    def test_recent_files_are_not_cached(self, tmpdir):
+        context, cache_dir = tmpdir.join('context'), str(tmpdir.join('cache'))
+        make_tree(context, {'a.txt': 'a'})
+        content_hash(str(context), cache_dir=cache_dir)
+        counters = {}
+        content_hash(str(context), cache_dir=cache_dir, counters=counters)
+        assert counters['content_hash.hashed'] == 1
+
+    def test_tag(self, tmpdir, monkeypatch):
+        monkeypatch.setenv('CODEBUILDER_CACHE_DIR', str(tmpdir.join('cache')))
+        make_tree(tmpdir.join('context'), {'Dockerfile': 'FROM scratch\n'})
+        digest = content_hash(str(tmpdir.join('context')))
+        r = runner.invoke(codebuilder, ['docker', '--image-name', 'foo/bar', '--build-context', str(tmpdir.join('context')), 'get-image', 'content-hash'])
+        assert r.exit_code == 0
+        assert r.output == 'foo/bar:{}\n'.format(digest[:12])
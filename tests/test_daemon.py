@@ -0,0 +1,109 @@
+import io
+import os
+import sys
+import time
+import errno
+import socket
+import subprocess
+
+import pytest
+
+from codebuilder.daemon import forward, should_forward
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def daemon(tmpdir):
+    path = str(tmpdir.join('codebuilder.sock'))
+    environ = dict(os.environ, PYTHONPATH=ROOT)
+    process = subprocess.Popen(
+        [sys.executable, '-c', 'from codebuilder.cli import cli; cli()', 'serve', '--socket', path, '--idle-timeout', '5'],
+        stderr=subprocess.PIPE, env=environ
+    )
+    for _ in range(200):
+        if os.path.exists(path):
+            break
+        time.sleep(0.05)
+    yield path, process
+    process.terminate()
+    process.wait()
+
+
+ENTRY_POINT = "import sys; sys.argv[0] = 'codebuilder'; from codebuilder.daemon import main; main()"
+
+
+def run(argv, path):
+    stdout, stderr = io.BytesIO(), io.BytesIO()
+    status = forward(argv, path, stdout, stderr)
+    return status, stdout.getvalue(), stderr.getvalue()
+
+
+def run_entry_point(argv, **env):
+    process = subprocess.Popen(
+        [sys.executable, '-c', ENTRY_POINT] + argv,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=dict(os.environ, PYTHONPATH=ROOT, **env)
+    )
+    stdout, stderr = process.communicate()
+    return process.returncode, stdout, stderr
+
+
+def test_output_matches_in_process(daemon, tmpdir, monkeypatch):
+    path, _ = daemon
+    tmpdir.join('VERSION').write('1.0.0')
+    tmpdir.chdir()
+    monkeypatch.setenv('IMAGE_NAME', 'foo/bar')
+    for argv in (['docker', 'get-image', 'version'], ['docker', 'get-tag', '--format', 'json', 'version'], ['docker', 'get-tag', 'bogus'], ['--version']):
+        expected = run_entry_point(argv, CODEBUILDER_NO_DAEMON='1')
+        assert run(argv, path) == expected
+        assert run_entry_point(argv, CODEBUILDER_SOCKET=path) == expected
+
+
+def test_in_place_edit_uses_client_cwd(daemon, tmpdir):
+    path, _ = daemon
+    tmpdir.join('config.json').write('{}')
+    tmpdir.chdir()
+    status, _, _ = run(['docker', 'get-tag', '--format', 'json', '--source-json-file', 'config.json', '--in-place', 'latest', 'Tag'], path)
+    assert status == 0
+    assert tmpdir.join('config.json').read() == '{\n  "Tag": "latest"\n}'
+
+
+def test_idle_timeout(tmpdir):
+    path = str(tmpdir.join('codebuilder.sock'))
+    r = subprocess.call(
+        [sys.executable, '-c', 'from codebuilder.cli import cli; cli()', 'serve', '--socket', path, '--idle-timeout', '0.2'],
+        env=dict(os.environ, PYTHONPATH=ROOT), stderr=subprocess.PIPE
+    )
+    assert r == 0
+    assert not os.path.exists(path)
+
+
+def test_falls_back_without_daemon(tmpdir):
+    assert run(['--version'], str(tmpdir.join('missing.sock'))) == (None, b'', b'')
+    assert not should_forward(['aws', 'kms', 'batch-decrypt', '--blobs-file', '-'], {})
+    assert not should_forward(['serve'], {})
+    assert not should_forward(['--version'], {'CODEBUILDER_NO_DAEMON': '1'})
+    assert should_forward(['--version'], {})
+
+
+def test_only_forwards_to_own_socket(daemon, tmpdir, monkeypatch):
+    path, _ = daemon
+    regular = tmpdir.join('regular.sock')
+    regular.write('')
+    assert run(['--version'], str(regular)) == (None, b'', b'')
+    link = str(tmpdir.join('link.sock'))
+    os.symlink(path, link)
+    assert run(['--version'], link) == (None, b'', b'')
+    uid = os.getuid()
+    monkeypatch.setattr(os, 'getuid', lambda: uid + 1)
+    assert run(['--version'], path) == (None, b'', b'')
+
+
+def test_falls_back_on_connect_error(daemon, monkeypatch):
+    path, _ = daemon
+
+    def connect(self, address):
+        raise socket.error(errno.EACCES, os.strerror(errno.EACCES))
+
+    monkeypatch.setattr(socket.socket, 'connect', connect)
+    assert run(['--version'], path) == (None, b'', b'')
@@ -0,0 +1,67 @@
+import json
+import os
+import time
+
+from codebuilder.helpers.document import JSONDocument
+
+# Seconds allowed to apply a batch of assignments to a multi-megabyte file
+DOCUMENT_BUDGET = float(os.getenv('CODEBUILDER_DOCUMENT_BUDGET', '3.0'))
+
+
+def cloudformation_parameters(count):
+    return {'Parameters': dict(('Parameter{:05d}'.format(i), 'value-{:05d}-'.format(i) + 'x' * 64) for i in range(count))}
+
+
+class TestJSONDocument:
+    def test_set_and_dumps(self):
+        document = JSONDocument()
+        document.set('/value', 'foo')
+        document.set(['Parameters', 'DockerImage'], 'foo/bar:1.0.0')
+        assert json.loads(document.dumps()) == {'value': 'foo', 'Parameters': {'DockerImage': 'foo/bar:1.0.0'}}
+
+    def test_in_place_shorter_document(self, tmpdir):
+        source = tmpdir.join('config.json')
+        source.write(json.dumps({'Parameters': {'DockerImage': 'x' * 1000}}))
+        with open(str(source), 'r+') as f:
+            document = JSONDocument(f)
+            document.set('Parameters/DockerImage', 'foo/bar')
+            assert document.save()
+        assert json.loads(source.read()) == {'Parameters': {'DockerImage': 'foo/bar'}}
+
+    def test_unchanged_document_is_not_written(self, tmpdir):
+        source = tmpdir.join('config.json')
+        source.write('{"Parameters": {"DockerImage": "foo/bar"}}')
+        mtime = os.path.getmtime(str(source))
+        with open(str(source), 'r+') as f:
+            document = JSONDocument(f)
+            assert not document.update([('Parameters/DockerImage', 'foo/bar')])
+            assert not document.save()
+        assert source.read() == '{"Parameters": {"DockerImage": "foo/bar"}}'
+        assert os.path.getmtime(str(source)) == mtime
+
+    def test_save_keeps_permissions(self, tmpdir):
+        source = tmpdir.join('config.json')
+        source.write('{}')
+        source.chmod(0o640)
+        with open(str(source), 'r+') as f:
+            document = JSONDocument(f)
+            document.set('a', 1)
+            document.save()
+        assert source.stat().mode & 0o777 == 0o640
+
+    def test_benchmark_large_cloudformation_parameters(self, tmpdir):
+        source = tmpdir.join('parameters.json')
+        source.write(json.dumps(cloudformation_parameters(50000), indent=2, sort_keys=True))
+        assert source.size() > 4 * 1024 * 1024
+
+        assignments = [('Parameters/Parameter{:05d}'.format(i * 1000), 'updated') for i in range(50)]
+        start = time.time()
+        with open(str(source), 'r+') as f:
+            document = JSONDocument(f)
+            document.update(assignments)
+            document.save()
+        elapsed = time.time() - start
+
+        result = json.loads(source.read())
+        assert all(result['Parameters'][path.split('/')[1]] == 'updated' for path, _ in assignments)
+        assert elapsed < DOCUMENT_BUDGET, '50 assignments on {} bytes took {:.3f}s'.format(source.size(), elapsed)
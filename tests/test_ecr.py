@@ -0,0 +1,286 @@
+import hashlib
+import threading
+
+import pytest
+
+from codebuilder.helpers import aws as aws_helper
+from codebuilder.helpers.aws import AWSHelper
+
+
+class FakePaginator(object):
+    def __init__(self, pages):
+        self._pages = pages
+
+    def paginate(self, **kwargs):
+        return self._pages(**kwargs)
+
+
+class FakeECR(object):
+    """
+    In-memory stand-in for the boto3 ECR client, enough for ecr_prune.
+    """
+
+    def __init__(self, untagged=0, page_size=1000, flaky=()):
+        self.images = set('sha256:{:064x}'.format(i) for i in range(untagged))
+        self.page_size = page_size
+        self.flaky = set(flaky)
+        self.lock = threading.Lock()
+        self.listed = 0
+        self.deleted = 0
+        self.max_outstanding = 0
+        self.delete_calls = 0
+
+    def get_paginator(self, operation):
+        assert operation == 'describe_images'
+        return FakePaginator(self._describe_images)
+
+    def _describe_images(self, repositoryName, filter):
+        assert filter == {'tagStatus': 'UNTAGGED'}
+        digests = sorted(self.images)
+        for start in range(0, len(digests), self.page_size):
+            with self.lock:
+                self.listed += len(digests[start:start + self.page_size])
+                self.max_outstanding = max(self.max_outstanding, self.listed - self.deleted)
+            yield {'imageDetails': [{'imageDigest': d, 'imageSizeInBytes': 1024} for d in digests[start:start + self.page_size]]}
+
+    def batch_delete_image(self, repositoryName, imageIds):
+        assert 0 < len(imageIds) <= 100
+        response = {'imageIds': [], 'failures': []}
+        with self.lock:
+            self.delete_calls += 1
+            for image_id in imageIds:
+                digest = image_id['imageDigest']
+                if digest in self.flaky:
+                    self.flaky.discard(digest)
+                    response['failures'].append({'imageId': image_id, 'failureCode': 'ImageReferencedByManifestList', 'failureReason': 'busy'})
+                elif digest in self.images:
+                    self.images.discard(digest)
+                    self.deleted += 1
+                    response['imageIds'].append(image_id)
+                else:
+                    response['failures'].append({'imageId': image_id, 'failureCode': 'ImageNotFound', 'failureReason': 'gone'})
+        return response
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(aws_helper, 'ECR_DELETE_RETRY_DELAY', 0)
+
+
+class TestPrune:
+    def test_reports_sizes(self):
+        results = list(AWSHelper().ecr_prune('repo', client=FakeECR(untagged=3)))
+        assert [r['imageSizeInBytes'] for r in results] == [1024] * 3
+
+    def test_empty(self):
+        assert list(AWSHelper().ecr_prune('repo', client=FakeECR())) == []
+
+    def test_paginates_and_batches(self):
+        client = FakeECR(untagged=2500, page_size=1000)
+        results = list(AWSHelper().ecr_prune('repo', client=client))
+        assert len(results) == 2500
+        assert not client.images
+        assert client.delete_calls == 25
+
+    def test_retries_partial_failures(self):
+        client = FakeECR(untagged=150, flaky=['sha256:{:064x}'.format(3)])
+        results = list(AWSHelper().ecr_prune('repo', client=client))
+        assert len(results) == 150
+        assert not any('failureCode' in r for r in results)
+        assert not client.images
+
+    def test_reports_permanent_failures(self):
+        client = FakeECR(untagged=10)
+        real_delete = client.batch_delete_image
+        def delete_twice(repositoryName, imageIds):
+            real_delete(repositoryName, imageIds)
+            return real_delete(repositoryName, imageIds)
+        client.batch_delete_image = delete_twice
+        results = list(AWSHelper().ecr_prune('repo', client=client))
+        assert [r['failureCode'] for r in results] == ['ImageNotFound'] * 10
+
+    def test_large_repository_bounded_memory(self):
+        client = FakeECR(untagged=50000, page_size=1000)
+        count = 0
+        for result in AWSHelper().ecr_prune('repo', workers=8, client=client):
+            count += 1
+        assert count == 50000
+        assert not client.images
+        # listing never runs further ahead than the page in flight plus the
+        # delete backlog (2 * workers batches of 100)
+        assert client.max_outstanding <= 1000 + 2 * 8 * 100 + 1000
+
+
+class FakeRegistry(object):
+    """
+    ECR client stand-in serving several repositories.
+    """
+
+    def __init__(self, repositories):
+        self.repositories = repositories
+
+    def get_paginator(self, operation):
+        if operation == 'describe_repositories':
+            names = sorted(self.repositories)
+            return FakePaginator(lambda: iter([
+                {'repositories': [{'repositoryName': name} for name in names[:2]]},
+                {'repositories': [{'repositoryName': name} for name in names[2:]]},
+            ]))
+        return FakePaginator(lambda repositoryName, filter: self.repositories[repositoryName]._describe_images(repositoryName, filter))
+
+    def batch_delete_image(self, repositoryName, imageIds):
+        return self.repositories[repositoryName].batch_delete_image(repositoryName, imageIds)
+
+
+class TestPruneRepositories:
+    def test_list_repositories(self):
+        client = FakeRegistry({'team-a': FakeECR(), 'team-b': FakeECR(), 'other': FakeECR()})
+        assert sorted(AWSHelper().ecr_list_repositories('team-*', client=client)) == ['team-a', 'team-b']
+        assert len(list(AWSHelper().ecr_list_repositories(client=client))) == 3
+
+    def test_prune_repositories(self):
+        registry = FakeRegistry({'a': FakeECR(untagged=250), 'b': FakeECR(untagged=0), 'c': FakeECR(untagged=10)})
+        summaries = AWSHelper().ecr_prune_repositories(['a', 'b', 'c'], workers=2, client=registry)
+        summaries = dict((s['repositoryName'], s) for s in summaries)
+        assert summaries['a']['deleted'] == 250
+        assert summaries['a']['reclaimedBytes'] == 250 * 1024
+        assert summaries['b']['deleted'] == 0
+        assert summaries['c']['failures'] == []
+
+
+REGISTRY = '123456789012.dkr.ecr.eu-west-1.amazonaws.com'
+
+
+class FakeImages(object):
+    """
+    ECR client stand-in answering batch_get_image from repository -> tags.
+    """
+
+    def __init__(self, repositories):
+        self.repositories = repositories
+        self.calls = []
+
+    def batch_get_image(self, registryId, repositoryName, imageIds):
+        from botocore.exceptions import ClientError
+
+        assert len(imageIds) <= 100
+        self.calls.append((repositoryName, len(imageIds)))
+        if repositoryName not in self.repositories:
+            raise ClientError({'Error': {'Code': 'RepositoryNotFoundException', 'Message': 'missing'}}, 'BatchGetImage')
+        tags = self.repositories[repositoryName]
+        return {
+            'images': [{'imageId': {'imageTag': i['imageTag'], 'imageDigest': 'sha256:' + i['imageTag']}} for i in imageIds if i['imageTag'] in tags],
+            'failures': [{'imageId': i, 'failureCode': 'ImageNotFound'} for i in imageIds if i['imageTag'] not in tags]
+        }
+
+
+class TestImagesExist:
+    def test_batches_per_repository(self):
+        client = FakeImages({'foo': set(str(i) for i in range(0, 250, 2)), 'bar': set(['latest'])})
+        images = ['{}/foo:{}'.format(REGISTRY, i) for i in range(250)] + [REGISTRY + '/bar:latest', REGISTRY + '/baz:latest']
+        results = AWSHelper().ecr_images_exist(images, client=client)
+        assert results[REGISTRY + '/foo:4'] == 'sha256:4'
+        assert results[REGISTRY + '/foo:5'] is None
+        assert results[REGISTRY + '/bar:latest'] == 'sha256:latest'
+        assert results[REGISTRY + '/baz:latest'] is None
+        assert sorted(client.calls) == [('bar', 1), ('baz', 1), ('foo', 50), ('foo', 100), ('foo', 100)]
+
+    def test_rejects_other_registries(self):
+        with pytest.raises(ValueError):
+            AWSHelper().ecr_images_exist(['foo/bar:latest'], client=FakeImages({}))
+
+    def test_command_exit_status(self, tmpdir, monkeypatch):
+        from click.testing import CliRunner
+        from codebuilder.cli import cli as codebuilder
+
+        tmpdir.join('VERSION').write('1.0.0')
+        tmpdir.chdir()
+        client = FakeImages({'foo': set(['1.0.0'])})
+        monkeypatch.setattr(AWSHelper, 'client', lambda self, service, region=None: client)
+        args = ['docker', '--image-name', REGISTRY + '/foo', 'image-exists']
+        r = CliRunner().invoke(codebuilder, args + ['version'])
+        assert (r.exit_code, r.output) == (0, REGISTRY + '/foo:1.0.0 sha256:1.0.0\n')
+        r = CliRunner().invoke(codebuilder, args + ['version', 'latest'])
+        assert (r.exit_code, r.output.splitlines()[-1]) == (1, REGISTRY + '/foo:latest missing')
+        r = CliRunner().invoke(codebuilder, args + ['-q', 'revision-id'])
+        assert (r.exit_code, r.output) == (1, '')
+
+
+class FakeManifests(object):
+    """
+    ECR client stand-in keeping repository -> tag -> manifest, the digest of
+    a manifest being derived from its content.
+    """
+
+    def __init__(self, repositories):
+        self.repositories = repositories
+        self.gets, self.puts = [], []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def digest(manifest):
+        return 'sha256:' + hashlib.sha256(manifest.encode('utf-8')).hexdigest()
+
+    def batch_get_image(self, registryId, repositoryName, imageIds, acceptedMediaTypes):
+        from botocore.exceptions import ClientError
+
+        assert len(imageIds) <= 100
+        with self.lock:
+            self.gets.append((repositoryName, len(imageIds)))
+        if repositoryName not in self.repositories:
+            raise ClientError({'Error': {'Code': 'RepositoryNotFoundException', 'Message': 'missing'}}, 'BatchGetImage')
+        tags = self.repositories[repositoryName]
+        return {'images': [{
+            'imageId': {'imageTag': i['imageTag'], 'imageDigest': self.digest(tags[i['imageTag']])},
+            'imageManifest': tags[i['imageTag']],
+            'imageManifestMediaType': 'application/vnd.docker.distribution.manifest.v2+json',
+        } for i in imageIds if i['imageTag'] in tags]}
+
+    def put_image(self, registryId, repositoryName, imageManifest, imageTag, imageManifestMediaType):
+        with self.lock:
+            self.puts.append((repositoryName, imageTag))
+            self.repositories[repositoryName][imageTag] = imageManifest
+        return {'image': {'imageId': {'imageTag': imageTag, 'imageDigest': self.digest(imageManifest)}}}
+
+
+class TestRetag:
+    def test_copies_manifests(self):
+        client = FakeManifests({
+            'foo': dict(('1.0.{}'.format(i), 'manifest-foo-{}'.format(i)) for i in range(150)),
+            'bar': {'1.0.0': 'manifest-bar', 'latest': 'manifest-bar'},
+        })
+        copies = [('{}/foo:1.0.{}'.format(REGISTRY, i), 'v{}'.format(i)) for i in range(150)]
+        copies += [(REGISTRY + '/bar:1.0.0', 'latest'), (REGISTRY + '/baz:1.0.0', 'latest')]
+        results = dict((r['image'], r) for r in AWSHelper().ecr_retag(copies, workers=8, client=client))
+        assert len(results) == 152
+        assert results[REGISTRY + '/foo:v42']['status'] == 'tagged'
+        assert client.repositories['foo']['v42'] == 'manifest-foo-42'
+        assert results[REGISTRY + '/bar:latest']['status'] == 'unchanged'
+        assert results[REGISTRY + '/baz:latest']['status'] == 'missing'
+        assert sorted(client.gets) == [('bar', 2), ('baz', 2), ('foo', 100), ('foo', 100), ('foo', 100)]
+        assert len(client.puts) == 150
+
+        client.gets, client.puts = [], []
+        results = list(AWSHelper().ecr_retag(copies[:150], client=client))
+        assert set(r['status'] for r in results) == set(['unchanged'])
+        assert client.puts == []
+
+    def test_command(self, tmpdir, monkeypatch):
+        from click.testing import CliRunner
+        from codebuilder.cli import cli as codebuilder
+
+        tmpdir.join('VERSION').write('1.0.0')
+        tmpdir.chdir()
+        monkeypatch.setenv('GITHUB_BRANCH', 'master')
+        client = FakeManifests({'foo': {'1.0.0': 'manifest-foo', 'latest': 'manifest-foo'}, 'bar': {'1.0.0': 'manifest-bar'}, 'baz': {}})
+        monkeypatch.setattr(AWSHelper, 'client', lambda self, service, region=None: client)
+        args = ['docker', '--image-name', REGISTRY + '/foo', 'retag', 'version', '--remote', '-t', 'latest', '-t', 'branch']
+        r = CliRunner().invoke(codebuilder, args + ['-r', 'foo', '-r', 'bar'])
+        assert r.exit_code == 0
+        assert sorted(r.output.splitlines()) == [
+            REGISTRY + '/bar:latest tagged', REGISTRY + '/bar:master tagged',
+            REGISTRY + '/foo:latest unchanged', REGISTRY + '/foo:master tagged',
+        ]
+        r = CliRunner().invoke(codebuilder, args + ['-r', 'baz'])
+        assert r.exit_code == 1
+        assert '{0}/baz:latest: {0}/baz:1.0.0 not found'.format(REGISTRY) in r.output
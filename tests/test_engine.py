@@ -0,0 +1,227 @@
+import json
+import time
+import threading
+
+import pytest
+
+import socketserver
+
+from http.server import BaseHTTPRequestHandler
+
+from botocore.exceptions import NoCredentialsError
+from click.testing import CliRunner
+
+from codebuilder.cli import cli as codebuilder
+from codebuilder.helpers.aws import AWSHelper
+from codebuilder.helpers.docker import DockerHelper
+from codebuilder.helpers.engine import DockerEngineClient, DockerError, registry_host, split_image
+
+from test_ecr import FakeImages, REGISTRY
+
+
+class FakeEngineHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, dict(self.headers)))
+        if '/tag?' in self.path:
+            if 'tag=broken' in self.path:
+                return self.reply(404, {'message': 'No such image'})
+            return self.reply(201, None)
+        if '/push?' in self.path:
+            if 'tag=denied' in self.path:
+                return self.reply(200, [{'status': 'Preparing'}, {'errorDetail': {'message': 'denied'}, 'error': 'denied: not authorized'}])
+            return self.reply(200, [{'status': 'Pushing'}, {'status': 'digest: sha256:ab42 size: 42'}])
+        if '/images/create?' in self.path:
+            if 'tag=slow' in self.path:
+                time.sleep(2)
+            if 'tag=broken' in self.path:
+                return self.reply(200, [{'status': 'Pulling'}, {'error': 'manifest unknown'}])
+            return self.reply(200, [{'status': 'Pulling'}, {'status': 'Downloaded newer image'}])
+        self.reply(404, {'message': 'not found'})
+
+    def reply(self, status, body):
+        if isinstance(body, list):
+            data = ''.join(json.dumps(line) + '\r\n' for line in body).encode('utf-8')
+        elif body is not None:
+            data = json.dumps(body).encode('utf-8')
+        else:
+            data = b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeEngine(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def engine(tmpdir):
+    path = str(tmpdir.join('docker.sock'))
+    server = FakeEngine(path, FakeEngineHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_split_image():
+    assert split_image('foo/bar:1.0.0') == ('foo/bar', '1.0.0')
+    assert split_image('localhost:5000/foo') == ('localhost:5000/foo', None)
+    assert split_image('localhost:5000/foo:latest') == ('localhost:5000/foo', 'latest')
+
+
+def test_registry_host():
+    assert registry_host('123456789012.dkr.ecr.eu-west-1.amazonaws.com/foo') == '123456789012.dkr.ecr.eu-west-1.amazonaws.com'
+    assert registry_host('localhost/foo') == 'localhost'
+    assert registry_host('registry:5000/foo/bar') == 'registry:5000'
+    assert registry_host('foo/bar') is None
+    assert registry_host('foo.bar') is None
+
+
+class TestDockerEngineClient:
+    def test_tag_and_push_reuse_connections(self, engine):
+        client = DockerEngineClient(engine.server_address, max_connections=2)
+        for i in range(10):
+            client.tag('foo/bar', 'foo/bar', str(i))
+            client.push('foo/bar', str(i), 'e30=')
+        assert len(engine.requests) == 20
+        assert client.connections_created == 1
+        assert engine.requests[1][0] == '/images/foo/bar/push?tag=0'
+        assert engine.requests[1][1]['X-Registry-Auth'] == 'e30='
+
+    def test_errors(self, engine):
+        client = DockerEngineClient(engine.server_address)
+        with pytest.raises(DockerError) as e:
+            client.tag('foo/bar', 'foo/bar', 'broken')
+        assert 'No such image' in str(e.value)
+        with pytest.raises(DockerError) as e:
+            client.push('foo/bar', 'denied', 'e30=')
+        assert 'not authorized' in str(e.value)
+
+
+class TestApplyTags:
+    def test_push_concurrently(self, engine, tmpdir, monkeypatch):
+        monkeypatch.setenv('DOCKER_HOST', 'unix://' + engine.server_address)
+        monkeypatch.setenv('DOCKER_CONFIG', str(tmpdir))
+        monkeypatch.setenv('GITHUB_BRANCH', 'master')
+        tmpdir.join('VERSION').write('1.0.0')
+        tmpdir.chdir()
+        r = CliRunner().invoke(codebuilder, ['docker', '--image-name', 'foo/bar', 'apply-tags', '--push', '-t', 'version', '-t', 'branch', '-t', 'latest'])
+        assert r.exit_code == 0
+        assert sorted(line.split()[1] for line in r.output.splitlines()) == ['foo/bar:1.0.0', 'foo/bar:latest', 'foo/bar:master']
+        paths = sorted(path for path, _ in engine.requests)
+        assert paths == [
+            '/images/foo/bar/push?tag=1.0.0', '/images/foo/bar/push?tag=latest', '/images/foo/bar/push?tag=master',
+            '/images/foo/bar/tag?repo=foo%2Fbar&tag=1.0.0', '/images/foo/bar/tag?repo=foo%2Fbar&tag=latest', '/images/foo/bar/tag?repo=foo%2Fbar&tag=master',
+        ]
+
+    def test_fail_fast(self, engine, tmpdir, monkeypatch):
+        monkeypatch.setenv('DOCKER_HOST', 'unix://' + engine.server_address)
+        monkeypatch.setenv('GITHUB_BRANCH', 'broken')
+        tmpdir.chdir()
+        r = CliRunner().invoke(codebuilder, ['docker', '--image-name', 'foo/bar', 'apply-tags', '-t', 'branch'])
+        assert r.exit_code == 1
+        assert 'No such image' in r.output
+
+
+class TestRetag:
+    def test_local(self, engine, tmpdir, monkeypatch):
+        monkeypatch.setenv('DOCKER_HOST', 'unix://' + engine.server_address)
+        monkeypatch.setenv('DOCKER_CONFIG', str(tmpdir))
+        tmpdir.join('VERSION').write('1.0.0')
+        tmpdir.chdir()
+        r = CliRunner().invoke(codebuilder, ['docker', '--image-name', 'foo/bar', 'retag', 'version', '--push', '-t', 'latest'])
+        assert r.exit_code == 0
+        assert r.output == 'foo/bar:latest pushed\n'
+        assert [path for path, _ in engine.requests] == ['/images/foo/bar:1.0.0/tag?repo=foo%2Fbar&tag=latest', '/images/foo/bar/push?tag=latest']
+
+
+    def test_invalid_options(self, engine, tmpdir, monkeypatch):
+        monkeypatch.setenv('DOCKER_HOST', 'unix://' + engine.server_address)
+        tmpdir.join('VERSION').write('1.0.0')
+        tmpdir.chdir()
+        for image_name, args in (
+            (REGISTRY + '/foo', ['--remote', '--push']),
+            ('foo/bar', ['-r', 'baz']),
+            ('bar', ['-r', 'baz']),
+        ):
+            r = CliRunner().invoke(codebuilder, ['docker', '--image-name', image_name, 'retag', 'version', '-t', 'latest'] + args)
+            assert r.exit_code == 2
+        assert engine.requests == []
+
+        r = CliRunner().invoke(codebuilder, ['docker', '--image-name', 'localhost:5000/foo', 'retag', 'version', '-t', 'latest', '-r', 'baz'])
+        assert r.exit_code == 0
+        assert r.output == 'localhost:5000/baz:latest tagged\n'
+
+
+class TestCachePull:
+    def invoke(self, engine, monkeypatch, tags, args=()):
+        monkeypatch.setenv('DOCKER_HOST', 'unix://' + engine.server_address)
+        client = FakeImages({'foo': set(tags)})
+        monkeypatch.setattr(AWSHelper, 'client', lambda self, service, region=None: client)
+        monkeypatch.setattr(DockerHelper, 'get_registry_auth', lambda self, repository: 'e30=')
+        return REGISTRY + '/foo', CliRunner().invoke(codebuilder, ['docker', '--image-name', REGISTRY + '/foo', 'cache-pull'] + list(args))
+
+    def test_pulls_existing_images(self, engine, tmpdir, monkeypatch):
+        monkeypatch.setenv('GITHUB_BRANCH', 'master')
+        tmpdir.join('VERSION').write('1.0.0')
+        tmpdir.chdir()
+        image, r = self.invoke(engine, monkeypatch, ['master', 'latest'])
+        assert r.exit_code == 0
+        assert r.output.splitlines() == [
+            'Skipped {}:1.0.0: not found'.format(image),
+            '--cache-from {0}:master --cache-from {0}:latest'.format(image),
+        ]
+        assert sorted(path for path, _ in engine.requests) == [
+            '/images/create?fromImage={}&tag=latest'.format(image.replace('/', '%2F')),
+            '/images/create?fromImage={}&tag=master'.format(image.replace('/', '%2F')),
+        ]
+
+    def test_failures_are_skipped(self, engine, tmpdir, monkeypatch):
+        monkeypatch.setenv('GITHUB_BRANCH', 'broken')
+        tmpdir.chdir()
+        image, r = self.invoke(engine, monkeypatch, ['broken', 'latest'])
+        assert r.exit_code == 0
+        assert r.output.splitlines() == [
+            'Skipped {}:broken: manifest unknown'.format(image),
+            '--cache-from {}:latest'.format(image),
+        ]
+
+    def test_credential_errors_are_reported(self, engine, tmpdir, monkeypatch):
+        monkeypatch.setenv('GITHUB_BRANCH', 'master')
+        tmpdir.chdir()
+        def get_registry_auth(self, repository):
+            raise NoCredentialsError()
+        monkeypatch.setattr(DockerHelper, 'get_registry_auth', get_registry_auth)
+        monkeypatch.setattr(AWSHelper, 'client', lambda self, service, region=None: FakeImages({'foo': {'master'}}))
+        start = time.time()
+        r = CliRunner().invoke(codebuilder, ['docker', '--image-name', REGISTRY + '/foo', 'cache-pull', '-t', 'branch', '--timeout', '5'])
+        assert time.time() - start < 1.5
+        assert r.exit_code == 0
+        assert r.output == 'Skipped {}/foo:master: Unable to locate credentials\n'.format(REGISTRY)
+        assert engine.requests == []
+
+    def test_time_budget(self, engine, tmpdir, monkeypatch):
+        monkeypatch.setenv('GITHUB_BRANCH', 'slow')
+        tmpdir.chdir()
+        start = time.time()
+        image, r = self.invoke(engine, monkeypatch, ['slow', 'latest'], ['--timeout', '0.5'])
+        assert time.time() - start < 1.5
+        assert r.exit_code == 0
+        assert r.output.splitlines() == [
+            'Skipped {}:slow: not pulled within 0.5s'.format(image),
+            '--cache-from {}:latest'.format(image),
+        ]
@@ -0,0 +1,108 @@
+from click.testing import CliRunner
+import os
+import sys
+
+from codebuilder.cli import cli as codebuilder
+from codebuilder.helpers.aws import AWSHelper
+from codebuilder.helpers.knownhosts import hash_name, name_matches, pinned_entries, update_known_hosts
+
+from test_cli import FakeKMS, b64
+
+runner = CliRunner()
+
+FAKE_KEYSCAN = '''#!{python}
+import sys
+with open({log!r}, 'a') as f:
+    f.write(' '.join(sys.argv[1:]) + '\\n')
+host = sys.argv[-1]
+if host == 'down.example.com':
+    sys.stderr.write('timeout\\n')
+    sys.exit(1)
+sys.stdout.write('# {{}} SSH-2.0\\n{{}} ssh-ed25519 KEY-{{}}\\n'.format(host, host, host))
+'''
+
+
+def ssh_env(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    monkeypatch.setenv('PATH', str(tmpdir), prepend=os.pathsep)
+    monkeypatch.setattr(AWSHelper, 'client', lambda self, service, region=None: FakeKMS())
+    script = tmpdir.join('ssh-keyscan')
+    script.write(FAKE_KEYSCAN.format(python=sys.executable, log=str(tmpdir.join('keyscan.log'))))
+    script.chmod(0o755)
+    return tmpdir.join('.ssh')
+
+
+def test_pinned_host_keys_without_network(tmpdir, monkeypatch):
+    ssh = ssh_env(tmpdir, monkeypatch)
+    r = runner.invoke(codebuilder, ['github', 'ssh-config', b64('private key')])
+    assert r.exit_code == 0
+    assert ssh.join('id_rsa').read() == 'private key\n'
+    lines = ssh.join('known_hosts').readlines()
+    assert len(lines) == 3 and all(name_matches(line.split()[0], 'github.com') for line in lines)
+    assert not tmpdir.join('keyscan.log').check()
+
+    ssh.join('id_rsa').remove()
+    r = runner.invoke(codebuilder, ['github', 'ssh-config', b64('private key')])
+    assert ssh.join('known_hosts').readlines() == lines
+
+
+def test_keys_mapped_to_hosts(tmpdir, monkeypatch):
+    ssh = ssh_env(tmpdir, monkeypatch)
+    args = ['github', 'ssh-config', '--key', 'gitlab.com=' + b64('gitlab key'), '--key', 'git.example.com:2222=' + b64('internal key')]
+    r = runner.invoke(codebuilder, args)
+    assert r.exit_code == 2
+    assert 'No pinned host key for [git.example.com]:2222' in r.output
+    assert not ssh.check()
+
+    for _ in range(2):
+        r = runner.invoke(codebuilder, args + ['--keyscan'])
+        assert r.exit_code == 0
+    assert ssh.join('codebuilder_git.example.com_2222').read() == 'internal key\n'
+    config = ssh.join('config').read()
+    assert config.count('# BEGIN codebuilder') == 1
+    assert 'Host git.example.com\n    HostName git.example.com\n    Port 2222\n    IdentityFile {}\n'.format(ssh.join('codebuilder_git.example.com_2222')) in config
+    # gitlab.com keys are pinned, only the other host is scanned
+    assert len(ssh.join('known_hosts').readlines()) == len(pinned_entries(['gitlab.com'])) + 1
+    assert tmpdir.join('keyscan.log').readlines() == ['-T 5 -p 2222 git.example.com\n'] * 2
+
+
+def test_pinned_and_scanned_hosts(tmpdir, monkeypatch):
+    ssh = ssh_env(tmpdir, monkeypatch)
+    args = ['github', 'ssh-config', b64('private key'), '--key', 'git.internal:2222=' + b64('internal key')]
+    r = runner.invoke(codebuilder, args)
+    assert r.exit_code == 2
+    assert not ssh.check()
+
+    r = runner.invoke(codebuilder, args + ['--keyscan'])
+    assert r.exit_code == 0
+    assert ssh.join('id_rsa').read() == 'private key\n'
+    lines = ssh.join('known_hosts').readlines()
+    assert len(lines) == len(pinned_entries(['github.com'])) + 1
+    assert tmpdir.join('keyscan.log').readlines() == ['-T 5 -p 2222 git.internal\n']
+
+
+def test_keyscan_failures(tmpdir, monkeypatch):
+    ssh = ssh_env(tmpdir, monkeypatch)
+    r = runner.invoke(codebuilder, ['github', 'ssh-config', '--key', 'gitlab.com=' + b64('key'), '--host', 'down.example.com', '--keyscan'])
+    assert r.exit_code == 1
+    assert 'Keyscan failed for down.example.com: timeout' in r.output
+    assert len(ssh.join('known_hosts').readlines()) == len(pinned_entries(['gitlab.com']))
+    assert tmpdir.join('keyscan.log').readlines() == ['-T 5 down.example.com\n']
+
+
+def test_known_hosts_deduplication(tmpdir):
+    path = tmpdir.join('known_hosts')
+    entry = pinned_entries(['github.com'])[0]
+    path.write('\n'.join([
+        'other.example.com ssh-ed25519 OTHER',
+        ' '.join([hash_name('github.com'), entry[1], entry[2]]),
+        ' '.join([hash_name('github.com'), entry[1], entry[2]]),
+        '',
+        'github.com,140.82.121.4 {} {}'.format(entry[1], entry[2]),
+        'other.example.com ssh-ed25519 OTHER',
+    ]) + '\n')
+    assert update_known_hosts(str(path), [entry]) == 0
+    lines = path.readlines()
+    assert len(lines) == 3
+    assert lines[0] == 'other.example.com ssh-ed25519 OTHER\n'
+    assert lines[2].startswith('github.com,140.82.121.4 ')
@@ -0,0 +1,198 @@
+import json
+import datetime
+
+import pytest
+from click.testing import CliRunner
+
+from codebuilder.cli import cli as codebuilder
+from codebuilder.helpers.aws import AWSHelper
+from codebuilder.helpers.retention import RetentionError, RetentionPolicy, RetentionRule
+
+from test_ecr import FakePaginator
+
+NOW = datetime.datetime(2020, 6, 1)
+
+
+def image(digest, tags=(), days=0, size=1024):
+    return {
+        'imageDigest': digest,
+        'imageTags': list(tags),
+        'imagePushedAt': NOW - datetime.timedelta(days=days),
+        'imageSizeInBytes': size,
+    }
+
+
+def expired(policy, images):
+    return sorted(image['imageDigest'] for image, _ in policy.evaluate(images))
+
+
+def timestamp(dt):
+    import calendar
+    return calendar.timegm(dt.utctimetuple())
+
+
+class TestRetentionPolicy:
+    def test_keep_newest_per_prefix(self):
+        rules = [RetentionRule(1, 'tagged', tag_prefixes=['release-'], count_number=2), RetentionRule(2, 'tagged', tag_prefixes=['pr-'], count_number=1)]
+        images = [image('r{}'.format(days), ['release-{}'.format(days)], days) for days in (5, 1, 3, 2)]
+        images += [image('p{}'.format(days), ['pr-{}'.format(days)], days) for days in (4, 6)]
+        images.append(image('other', ['latest'], 100))
+        assert expired(RetentionPolicy(rules, now=timestamp(NOW)), images) == ['p6', 'r3', 'r5']
+
+    def test_rule_priority_and_age(self):
+        rules = [
+            RetentionRule(1, 'untagged', count_type='sinceImagePushed', count_number=0),
+            RetentionRule(2, 'tagged', tag_patterns=['v*'], count_number=1),
+            RetentionRule(3, 'any', count_type='sinceImagePushed', count_number=30),
+        ]
+        images = [
+            image('untagged', days=0),
+            image('v-old-kept', ['v1'], 400),
+            image('v-older', ['v0'], 500),
+            image('feature-old', ['feature'], 31),
+            image('feature-new', ['feature-2'], 29),
+        ]
+        # v1 is the newest v* image: kept by rule 2 although older than 30 days
+        assert expired(RetentionPolicy(rules, now=timestamp(NOW)), images) == ['feature-old', 'untagged', 'v-older']
+
+    def test_protect(self):
+        rules = [RetentionRule(1, 'any', count_type='sinceImagePushed', count_number=1)]
+        images = [image('a', ['v1.0.0'], 10), image('b', ['v1.0.0-rc1'], 10), image('c', [], 10)]
+        policy = RetentionPolicy(rules, protect=[r'^v\d+\.\d+\.\d+$'], now=timestamp(NOW))
+        assert expired(policy, images) == ['b', 'c']
+
+    def test_streaming(self):
+        consumed = []
+
+        def images():
+            for i in range(100000):
+                consumed.append(i)
+                yield {'imageDigest': str(i), 'imageTags': ['build-{}'.format(i)], 'imagePushedAt': i}
+
+        policy = RetentionPolicy([RetentionRule(1, 'tagged', tag_prefixes=['build-'], count_number=10)])
+        results = policy.evaluate(images())
+        first, _ = next(results)
+        assert first['imageDigest'] == '0'
+        assert len(consumed) == 11
+        assert sum(1 for _ in results) == 100000 - 11
+
+    def test_lifecycle_policy(self):
+        document = {'rules': [
+            {'rulePriority': 2, 'selection': {'tagStatus': 'any', 'countType': 'imageCountMoreThan', 'countNumber': 1}, 'action': {'type': 'expire'}},
+            {'rulePriority': 1, 'selection': {'tagStatus': 'tagged', 'tagPrefixList': ['prod', 'web'], 'countType': 'sinceImagePushed', 'countUnit': 'days', 'countNumber': 7}, 'action': {'type': 'expire'}},
+        ]}
+        policy = RetentionPolicy.from_lifecycle_policy(json.dumps(document), now=timestamp(NOW))
+        assert [rule.priority for rule in policy.rules] == [1, 2]
+        images = [
+            image('prod-web-old', ['prod-1', 'web-1'], 8),
+            image('prod-web-new', ['prod-2', 'web-2'], 6),
+            image('prod-only', ['prod-3'], 9),
+            image('newest', ['x'], 0),
+        ]
+        assert expired(policy, images) == ['prod-only', 'prod-web-old']
+
+    @pytest.mark.parametrize('rule', [
+        {'rulePriority': 0, 'selection': {'tagStatus': 'any', 'countType': 'imageCountMoreThan', 'countNumber': 1}, 'action': {'type': 'expire'}},
+        {'rulePriority': 1, 'selection': {'tagStatus': 'tagged', 'countType': 'imageCountMoreThan', 'countNumber': 1}, 'action': {'type': 'expire'}},
+        {'rulePriority': 1, 'selection': {'tagStatus': 'any', 'countType': 'sinceImagePushed', 'countNumber': 1}, 'action': {'type': 'expire'}},
+        {'rulePriority': 1, 'selection': {'tagStatus': 'any', 'countType': 'imageCountMoreThan', 'countNumber': 0}, 'action': {'type': 'expire'}},
+        {'rulePriority': 1, 'selection': {'tagStatus': 'any', 'countType': 'imageCountMoreThan', 'countNumber': 1}, 'action': {'type': 'keep'}},
+    ])
+    def test_invalid_lifecycle_policy(self, rule):
+        with pytest.raises(RetentionError):
+            RetentionPolicy.from_lifecycle_policy({'rules': [rule]})
+
+
+class FakeRepository(object):
+    """
+    ECR client stand-in listing tagged and untagged images, 2 per page.
+    """
+
+    def __init__(self, images):
+        self.images = dict((image['imageDigest'], image) for image in images)
+        self.filters = []
+        self.deleted = []
+
+    def get_paginator(self, operation):
+        assert operation == 'describe_images'
+        return FakePaginator(self._describe_images)
+
+    def _describe_images(self, repositoryName, filter=None):
+        self.filters.append(filter)
+        images = sorted(self.images.values(), key=lambda image: image['imageDigest'])
+        if filter:
+            images = [image for image in images if not image['imageTags']]
+        for start in range(0, len(images), 2):
+            yield {'imageDetails': [dict(image) for image in images[start:start + 2]]}
+
+    def batch_delete_image(self, repositoryName, imageIds):
+        for image_id in imageIds:
+            self.deleted.append(image_id['imageDigest'])
+            del self.images[image_id['imageDigest']]
+        return {'imageIds': imageIds, 'failures': []}
+
+
+class TestPruneCommand:
+    def repository(self, monkeypatch):
+        now = datetime.datetime.utcnow()
+        client = FakeRepository([
+            dict(image('untagged'), imagePushedAt=now),
+            dict(image('release-1', ['release-1'], size=2048), imagePushedAt=now - datetime.timedelta(days=3)),
+            dict(image('release-2', ['release-2'], size=2048), imagePushedAt=now - datetime.timedelta(days=2)),
+            dict(image('release-3', ['release-3'], size=2048), imagePushedAt=now - datetime.timedelta(days=1)),
+            dict(image('v1', ['v1.0.0'], size=4096), imagePushedAt=now - datetime.timedelta(days=90)),
+            dict(image('old', ['feature'], size=4096), imagePushedAt=now - datetime.timedelta(days=90)),
+        ])
+        monkeypatch.setattr(AWSHelper, 'client', lambda self, service, region=None: client)
+        return client
+
+    def test_dry_run(self, monkeypatch):
+        client = self.repository(monkeypatch)
+        r = CliRunner().invoke(codebuilder, [
+            'aws', 'ecr', 'prune', 'repo', '--keep', '2', '--tag-prefix', 'release-', '--older-than', '30',
+            '--protect', r'^v\d', '--dry-run'
+        ])
+        assert r.exit_code == 0
+        lines = r.output.splitlines()
+        assert sorted(line.split()[3] for line in lines[:-1]) == ['old', 'release-1', 'untagged']
+        assert 'tags=release-1 size=2.0 KiB' in r.output
+        assert lines[-1] == 'Total: 3 image(s) would be deleted, 7.0 KiB reclaimed'
+        assert client.deleted == []
+        assert client.filters == [None]
+
+    def test_delete(self, monkeypatch):
+        client = self.repository(monkeypatch)
+        r = CliRunner().invoke(codebuilder, ['aws', 'ecr', 'prune', 'repo', '--keep', '1'])
+        assert r.exit_code == 0
+        assert sorted(client.deleted) == ['old', 'release-1', 'release-2', 'untagged', 'v1']
+
+    def test_policy(self, tmpdir, monkeypatch):
+        client = self.repository(monkeypatch)
+        policy = tmpdir.join('policy.json')
+        policy.write(json.dumps({'rules': [
+            {'rulePriority': 1, 'selection': {'tagStatus': 'untagged', 'countType': 'sinceImagePushed', 'countUnit': 'days', 'countNumber': 1}, 'action': {'type': 'expire'}},
+        ]}))
+        r = CliRunner().invoke(codebuilder, ['aws', 'ecr', 'prune', 'repo', '--policy', str(policy), '--dry-run'])
+        assert (r.exit_code, r.output) == (0, 'Total: 0 image(s) would be deleted, 0 B reclaimed\n')
+        assert client.filters == [{'tagStatus': 'UNTAGGED'}]
+
+        r = CliRunner().invoke(codebuilder, ['aws', 'ecr', 'prune', 'repo', '--policy', str(policy), '--keep', '1'])
+        assert r.exit_code == 2
+        r = CliRunner().invoke(codebuilder, ['aws', 'ecr', 'prune', 'repo', '--keep', '1', '--older-than', '30'])
+        assert r.exit_code == 2
+        assert '--older-than' in r.output
+        policy.write('{"rules": []}')
+        r = CliRunner().invoke(codebuilder, ['aws', 'ecr', 'prune', 'repo', '--policy', str(policy)])
+        assert r.exit_code == 2
+        assert 'no rules' in r.output
+
+    def test_all_repositories_dry_run(self, monkeypatch):
+        client = self.repository(monkeypatch)
+        monkeypatch.setattr(AWSHelper, 'ecr_list_repositories', lambda self, pattern=None, client=None: iter(['repo']))
+        r = CliRunner().invoke(codebuilder, ['aws', 'ecr', 'prune', '--all', '--older-than', '30', '--dry-run'])
+        assert r.exit_code == 0
+        assert r.output.splitlines() == [
+            'repo: 3 image(s) would be deleted, 9.0 KiB reclaimed',
+            'Total: 3 image(s) would be deleted, 9.0 KiB reclaimed in 1 repositories',
+        ]
+        assert client.deleted == []
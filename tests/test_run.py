@@ -0,0 +1,91 @@
+from click.testing import CliRunner
+import json
+import threading
+
+import pytest
+
+from codebuilder.cli import cli as codebuilder
+from codebuilder.helpers.steps import StepError, parse_steps, run_steps
+
+runner = CliRunner()
+
+
+def write_steps(tmpdir, steps, name='steps.json'):
+    path = tmpdir.join(name)
+    path.write(json.dumps({'steps': steps}))
+    return str(path)
+
+
+class TestParseSteps:
+    def test_names_and_needs(self):
+        steps = parse_steps([{'run': 'docker get-tag latest'}, {'name': 'b', 'run': ['docker', 'get-tag', 'version'], 'needs': 'docker get-tag latest'}])
+        assert list(steps) == ['docker get-tag latest', 'b']
+        assert steps['b']['needs'] == ['docker get-tag latest']
+
+    def test_in_place_edits_of_a_file_are_ordered(self):
+        steps = parse_steps([
+            {'name': 'a', 'run': 'aws kms decrypt X --format json --source-json-file c.json --in-place A'},
+            {'name': 'b', 'run': 'aws kms decrypt Y --format json --source-json-file=c.json --in-place B'},
+            {'name': 'c', 'run': 'aws kms decrypt Z --format json --source-json-file other.json --in-place C'},
+        ])
+        assert [steps[name]['needs'] for name in 'abc'] == [[], ['a'], []]
+
+    @pytest.mark.parametrize('steps', [
+        [],
+        [{'name': 'a', 'run': 'docker get-tag latest', 'needs': ['missing']}],
+        [{'name': 'a', 'run': 'docker get-tag latest', 'needs': ['b']}, {'name': 'b', 'run': 'docker get-tag latest', 'needs': ['a']}],
+        [{'name': 'a', 'run': '--verbose docker get-tag latest'}],
+    ])
+    def test_invalid(self, steps):
+        with pytest.raises(StepError):
+            parse_steps(steps)
+
+
+def test_independent_steps_run_concurrently():
+    started = {'a': threading.Event(), 'b': threading.Event()}
+    steps = parse_steps([{'name': 'a', 'run': 'a'}, {'name': 'b', 'run': 'b'}, {'name': 'c', 'run': 'c', 'needs': ['a', 'b']}])
+    def execute(step):
+        if step['name'] in started:
+            started[step['name']].set()
+            assert started['b' if step['name'] == 'a' else 'a'].wait(5)
+        return {'status': 0}
+    results = list(run_steps(steps, execute))
+    assert [(step['name'], result['status']) for step, result in results] == [('a', 0), ('b', 0), ('c', 0)]
+
+
+def test_run_prints_steps_in_order(tmpdir):
+    tmpdir.join('VERSION').write('1.0.0')
+    tmpdir.join('config.json').write('{}')
+    tmpdir.chdir()
+    path = write_steps(tmpdir, [
+        {'name': 'version', 'run': 'docker get-tag version'},
+        {'name': 'image', 'run': 'docker --image-name foo/bar get-image latest'},
+        {'name': 'edit-1', 'run': 'docker get-tag --format json --source-json-file config.json --in-place version Version'},
+        {'name': 'edit-2', 'run': 'docker get-tag --format json --source-json-file config.json --in-place latest Latest'},
+    ])
+    r = runner.invoke(codebuilder, ['run', path])
+    assert r.exit_code == 0
+    lines = r.output.splitlines()
+    assert lines[:4] == ['==> version', '1.0.0', '==> image', 'foo/bar:latest']
+    assert [line.split()[:2] for line in lines[-4:]] == [['version', 'ok'], ['image', 'ok'], ['edit-1', 'ok'], ['edit-2', 'ok']]
+    assert json.loads(tmpdir.join('config.json').read()) == {'Version': '1.0.0', 'Latest': 'latest'}
+
+
+def test_failed_step_skips_dependents(tmpdir):
+    path = write_steps(tmpdir, [
+        {'name': 'bad', 'run': 'docker get-tag bogus'},
+        {'name': 'after', 'run': 'docker get-tag latest', 'needs': ['bad']},
+        {'name': 'other', 'run': 'docker get-tag latest'},
+    ], name='steps.yml')
+    r = runner.invoke(codebuilder, ['run', path])
+    assert r.exit_code == 1
+    assert 'invalid choice: bogus' in r.output
+    summary = [line.split()[:2] for line in r.output.splitlines()[-3:]]
+    assert summary == [['bad', 'failed'], ['after', 'skipped'], ['other', 'ok']]
+
+
+def test_unknown_command_fails_before_running(tmpdir):
+    path = write_steps(tmpdir, [{'name': 'ok', 'run': 'docker get-tag latest'}, {'name': 'typo', 'run': 'dokcer get-tag latest'}])
+    r = runner.invoke(codebuilder, ['run', path])
+    assert r.exit_code == 2
+    assert '==> ok' not in r.output
@@ -0,0 +1,252 @@
+import io
+import os
+import datetime
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+from click.testing import CliRunner
+
+from codebuilder.cli import cli as codebuilder
+from codebuilder.helpers import s3cache
+from codebuilder.helpers.aws import AWSHelper
+from codebuilder.helpers.s3cache import S3Cache, S3CacheError, plan_chunks
+
+
+class FakeS3(object):
+    """
+    S3 client stand-in keeping objects in memory, with 1 item list pages.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.calls = []
+        self.lock = threading.Lock()
+        self.clock = 0
+
+    def _record(self, name, key):
+        with self.lock:
+            self.calls.append((name, key))
+
+    def put_object(self, Bucket, Key, Body):
+        self._record('put_object', Key)
+        with self.lock:
+            self.clock += 1
+            self.objects[(Bucket, Key)] = (Body, datetime.datetime(2020, 1, 1) + datetime.timedelta(seconds=self.clock))
+        return {}
+
+    def get_object(self, Bucket, Key):
+        self._record('get_object', Key)
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'missing'}}, 'GetObject')
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)][0])}
+
+    def head_object(self, Bucket, Key):
+        self._record('head_object', Key)
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=None):
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        page = {'Contents': [{'Key': key, 'LastModified': self.objects[(Bucket, key)][1]} for key in keys[start:start + 1]]}
+        if start + 1 < len(keys):
+            page.update(IsTruncated=True, NextContinuationToken=str(start + 1))
+        return page
+
+    def count(self, name, prefix=''):
+        return len([key for call, key in self.calls if call == name and key.startswith(prefix)])
+
+
+def make_tree(root, files):
+    for path, content in files.items():
+        root.join(path).write_binary(content, ensure=True)
+
+
+def read_tree(root):
+    files = {}
+    for directory, _, names in os.walk(str(root)):
+        for name in names:
+            path = os.path.join(directory, name)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, str(root))] = f.read()
+    return files
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(s3cache, 'S3_CACHE_CHUNK_SIZE', 1024)
+
+
+def test_plan_chunks(small_chunks):
+    chunks = plan_chunks([('r', 'big', 2500), ('r', 'a', 10), ('r', 'b', 20)])
+    assert chunks[:3] == [[('r', 'big', 0, 1024)], [('r', 'big', 1024, 1024)], [('r', 'big', 2048, 452)]]
+    assert [piece for chunk in chunks[3:] for piece in chunk] == [('r', 'a', 0, 10), ('r', 'b', 0, 20)]
+
+
+class TestS3Cache:
+    def test_round_trip(self, tmpdir, small_chunks):
+        files = {'big.bin': os.urandom(5000), 'a/b/small.txt': b'small', 'a/empty': b''}
+        files.update(('pkgs/{}.txt'.format(i), 'package {}'.format(i).encode('utf-8')) for i in range(200))
+        make_tree(tmpdir.join('src'), files)
+        tmpdir.join('src', 'a', 'b', 'small.txt').chmod(0o755)
+        tmpdir.join('src', 'empty-dir').ensure(dir=True)
+        tmpdir.join('src', 'link').mksymlinkto('a/b/small.txt')
+        client = FakeS3()
+        cache = S3Cache(client, 'bucket', workers=8)
+        tmpdir.chdir()
+        manifest = cache.save('pip-master', ['src'])
+        assert manifest['key'] == 'pip-master'
+
+        tmpdir.join('src').move(tmpdir.join('saved'))
+        assert cache.restore(cache.find_manifest('pip-master')) == len(files)
+        assert read_tree(tmpdir.join('src')) == read_tree(tmpdir.join('saved'))
+        assert tmpdir.join('src', 'a', 'b', 'small.txt').stat().mode & 0o777 == 0o755
+        assert tmpdir.join('src', 'empty-dir').isdir()
+        assert tmpdir.join('src', 'link').readlink() == 'a/b/small.txt'
+        assert tmpdir.join('src', 'big.bin').mtime() == tmpdir.join('saved', 'big.bin').mtime()
+
+    def test_only_changed_chunks_upload(self, tmpdir, small_chunks):
+        make_tree(tmpdir.join('src'), dict(('{}.txt'.format(i), os.urandom(300)) for i in range(100)))
+        client = FakeS3()
+        cache = S3Cache(client, 'bucket')
+        tmpdir.chdir()
+        cache.save('npm-master', ['src'])
+        chunks = client.count('put_object', 'codebuilder-cache/chunks/')
+
+        make_tree(tmpdir.join('src'), {'42.txt': os.urandom(300)})
+        client.calls = []
+        cache.counters.clear()
+        cache.save('npm-feature', ['src'], restore_keys=['npm-master'])
+        assert client.count('put_object', 'codebuilder-cache/chunks/') == 1
+        # chunks of a restore key manifest may have expired, they are checked
+        assert client.count('head_object') == chunks
+        assert cache.counters['s3cache.chunks'] == chunks
+
+        # unchanged tree: nothing uploaded, not even the manifest
+        client.calls = []
+        cache.save('npm-feature', ['src'])
+        assert client.count('put_object') == 0
+        assert client.count('head_object') == 0
+
+    def test_restore_keys(self, tmpdir):
+        client = FakeS3()
+        cache = S3Cache(client, 'bucket')
+        tmpdir.chdir()
+        for key, content in (('pip-master', b'old'), ('pip-release', b'other'), ('pip-master-2', b'new')):
+            make_tree(tmpdir.join('src'), {'f': content})
+            cache.save(key, ['src'])
+        assert cache.find_manifest('pip-feature') is None
+        assert cache.find_manifest('pip-feature', ['gradle-', 'pip-master'])['key'] == 'pip-master-2'
+        assert cache.find_manifest('pip-release', ['pip-master'])['key'] == 'pip-release'
+
+    def test_restore_skips_unchanged_files(self, tmpdir, small_chunks):
+        make_tree(tmpdir.join('src'), {'a': os.urandom(2000), 'b': os.urandom(2000)})
+        client = FakeS3()
+        cache = S3Cache(client, 'bucket')
+        tmpdir.chdir()
+        manifest = cache.save('key', ['src'])
+        tmpdir.join('src', 'b').remove()
+        client.calls = []
+        assert cache.restore(manifest) == 1
+        assert client.count('get_object') == 2
+
+    def test_corrupted_chunk(self, tmpdir):
+        make_tree(tmpdir.join('src'), {'a': b'content'})
+        client = FakeS3()
+        cache = S3Cache(client, 'bucket')
+        tmpdir.chdir()
+        manifest = cache.save('key', ['src'])
+        for bucket, key in list(client.objects):
+            if '/chunks/' in key:
+                client.objects[(bucket, key)] = (b'garbage', client.objects[(bucket, key)][1])
+        tmpdir.join('src', 'a').remove()
+        with pytest.raises(S3CacheError):
+            cache.restore(manifest)
+
+
+    def test_missing_chunk_keeps_files(self, tmpdir, small_chunks):
+        content = os.urandom(3000)
+        make_tree(tmpdir.join('src'), {'a': content, 'b': b'small'})
+        client = FakeS3()
+        cache = S3Cache(client, 'bucket')
+        tmpdir.chdir()
+        manifest = cache.save('key', ['src'])
+        big = [key for bucket, key in client.objects if '/chunks/' in key and len(client.objects[(bucket, key)][0]) == 1024]
+        del client.objects[('bucket', big[0])]
+        make_tree(tmpdir.join('src'), {'a': b'old', 'b': b'old'})
+        with pytest.raises(S3CacheError) as e:
+            cache.restore(manifest)
+        assert 'missing, 1 file(s) not restored' in str(e.value)
+        assert tmpdir.join('src', 'a').read_binary() == b'old'
+        assert tmpdir.join('src', 'b').read_binary() == b'small'
+        assert sorted(tmpdir.join('src').listdir()) == [tmpdir.join('src', 'a'), tmpdir.join('src', 'b')]
+
+        # a save uploads the chunk again, though the restore key manifest references it
+        make_tree(tmpdir.join('src'), {'a': content})
+        cache.save('key-2', ['src'], restore_keys=['key'])
+        assert ('bucket', big[0]) in client.objects
+
+    def test_restore_rejects_paths_outside_root(self, tmpdir):
+        make_tree(tmpdir.join('src'), {'a': b'content'})
+        client = FakeS3()
+        cache = S3Cache(client, 'bucket')
+        tmpdir.chdir()
+        manifest = cache.save('key', ['src'])
+        file_entry = manifest['roots']['src']['files'][0]
+        outside = tmpdir.join('outside').ensure(dir=True)
+        for entry in (
+            {'dirs': ['../escaped'], 'files': [], 'symlinks': []},
+            {'dirs': [], 'files': [[str(outside.join('a'))] + file_entry[1:]], 'symlinks': []},
+            {'dirs': [], 'files': [], 'symlinks': [['../link', 'a']]},
+            # a symlink of the manifest is not followed by its files
+            {'dirs': [], 'files': [['escape/a'] + file_entry[1:]], 'symlinks': [['escape', str(outside)]]},
+        ):
+            if tmpdir.join('src').check():
+                tmpdir.join('src').remove()
+            with pytest.raises(S3CacheError):
+                cache.restore(dict(manifest, roots={'src': entry}))
+            assert not outside.listdir()
+            assert not tmpdir.join('escaped').check()
+
+        tmpdir.join('src').remove()
+        tmpdir.join('src').ensure(dir=True)
+        tmpdir.join('src', 'escape').mksymlinkto(outside)
+        with pytest.raises(S3CacheError):
+            cache.restore(dict(manifest, roots={'src': {'dirs': ['escape/dir'], 'files': [], 'symlinks': []}}))
+        assert not outside.listdir()
+
+        tmpdir.join('src', 'a').mksymlinkto(outside.join('a'))
+        assert cache.restore(manifest) == 1
+        assert tmpdir.join('src', 'a').read_binary() == b'content'
+        assert not outside.listdir()
+
+
+def test_commands(tmpdir, monkeypatch):
+    client = FakeS3()
+    monkeypatch.setattr(AWSHelper, 'client', lambda self, service, region=None: client)
+    monkeypatch.setenv('CODEBUILDER_CACHE_BUCKET', 'bucket')
+    make_tree(tmpdir.join('cache'), {'a': b'a', 'b/c': b'c'})
+    tmpdir.chdir()
+    r = CliRunner().invoke(codebuilder, ['aws', 'cache', 'save', '--key', 'pip-master', 'cache'])
+    assert r.exit_code == 0
+    assert r.output == 'Saved 2 file(s) to pip-master: 1 of 1 chunk(s) uploaded (2 B)\n'
+
+    tmpdir.join('cache').remove()
+    r = CliRunner().invoke(codebuilder, ['aws', 'cache', 'restore', '--key', 'pip-feature', 'cache'])
+    assert (r.exit_code, r.output) == (0, 'Cache not found: pip-feature\n')
+    r = CliRunner().invoke(codebuilder, ['aws', 'cache', 'restore', '--key', 'pip-feature', '--restore-key', 'pip-', 'cache'])
+    assert r.exit_code == 0
+    assert r.output == 'Restored 2 file(s) from pip-master (1 chunk(s), 2 B)\n'
+    assert read_tree(tmpdir.join('cache')) == {'a': b'a', os.path.join('b', 'c'): b'c'}
+
+    for bucket, key in list(client.objects):
+        if '/chunks/' in key:
+            del client.objects[(bucket, key)]
+    tmpdir.join('cache').remove()
+    r = CliRunner().invoke(codebuilder, ['aws', 'cache', 'restore', '--key', 'pip-master', 'cache'])
+    assert r.exit_code == 0
+    assert r.output.startswith('Cache not restored from pip-master: Chunk ')
+    assert r.output.endswith(' is missing, 2 file(s) not restored\n')
+    assert read_tree(tmpdir.join('cache')) == {}
@@ -0,0 +1,169 @@
+import json
+
+from botocore.exceptions import ClientError
+from click.testing import CliRunner
+
+from codebuilder.cli import cli as codebuilder
+from codebuilder.helpers.aws import AWSHelper
+
+runner = CliRunner()
+
+PARAMETERS = {
+    '/myapp/db/password': 'db-password',
+    '/myapp/api/key': 'api-key',
+    '/myapp/api/url': 'https://api.example.com/?a=1&b=2',
+    '/other/token': 'token',
+}
+
+SECRETS = {
+    'myapp/signing-key': {'SecretString': 'signing "key"'},
+    'arn:aws:secretsmanager:eu-west-1:123456789012:secret:myapp/cert-AbCdEf': {'SecretBinary': b'\x00cert'},
+}
+
+
+class FakePaginator(object):
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Path, Recursive, WithDecryption):
+        assert Recursive and WithDecryption
+        names = sorted(name for name in PARAMETERS if name.startswith(Path.rstrip('/') + '/'))
+        for start in range(0, len(names), 2):
+            self.client.calls.append(('get_parameters_by_path', Path))
+            yield {'Parameters': [{'Name': name, 'Value': PARAMETERS[name]} for name in names[start:start + 2]]}
+
+
+class FakeSSM(object):
+    def __init__(self):
+        self.calls = []
+
+    def get_paginator(self, operation):
+        assert operation == 'get_parameters_by_path'
+        return FakePaginator(self)
+
+    def get_parameters(self, Names, WithDecryption):
+        assert WithDecryption and len(Names) <= 10
+        self.calls.append(('get_parameters', len(Names)))
+        parameters = []
+        for name in Names:
+            base, _, version = name.partition(':')
+            if base in PARAMETERS or name.startswith('/many/'):
+                parameter = {'Name': base, 'Value': PARAMETERS.get(base, name)}
+                if version:
+                    parameter['Selector'] = ':' + version
+                parameters.append(parameter)
+        return {'Parameters': parameters, 'InvalidParameters': [name for name in Names if name.partition(':')[0] not in PARAMETERS and not name.startswith('/many/')]}
+
+
+class FakeSecretsManager(object):
+    def __init__(self):
+        self.calls = []
+
+    def get_secret_value(self, SecretId):
+        self.calls.append(SecretId)
+        if SecretId not in SECRETS:
+            raise ClientError({'Error': {'Code': 'ResourceNotFoundException', 'Message': 'Secrets Manager can\'t find the specified secret.'}}, 'GetSecretValue')
+        return dict(SECRETS[SecretId], ARN=SecretId)
+
+
+def fake_clients(monkeypatch):
+    clients = {'ssm': FakeSSM(), 'secretsmanager': FakeSecretsManager()}
+    monkeypatch.setattr(AWSHelper, 'client', lambda self, service, region=None: clients[service])
+    return clients
+
+
+class TestHelper:
+    def test_get_parameters_in_batches(self, monkeypatch):
+        clients = fake_clients(monkeypatch)
+        aws = AWSHelper()
+        names = ['/many/{}'.format(i) for i in range(25)] + ['/myapp/db/password:1', '/missing']
+        values, errors = aws.ssm_get_parameters(names + names[:5])
+        assert len(values) == 26
+        assert values['/myapp/db/password:1'] == 'db-password'
+        assert list(errors) == ['/missing']
+        assert sorted(clients['ssm'].calls) == [('get_parameters', 7), ('get_parameters', 10), ('get_parameters', 10)]
+
+        # fetched values are cached, missing ones are asked again
+        clients['ssm'].calls = []
+        values, errors = aws.ssm_get_parameters(['/many/3', '/missing'])
+        assert values == {'/many/3': '/many/3'}
+        assert clients['ssm'].calls == [('get_parameters', 1)]
+
+    def test_secrets_and_paths_are_cached(self, monkeypatch):
+        clients = fake_clients(monkeypatch)
+        aws = AWSHelper()
+        for _ in range(2):
+            assert aws.ssm_get_parameters_by_path('/myapp') == dict((k, v) for k, v in PARAMETERS.items() if k.startswith('/myapp/'))
+            values, errors = aws.secretsmanager_get_secret_values(list(SECRETS) + ['nope'])
+        assert values['myapp/signing-key'] == 'signing "key"'
+        assert values['arn:aws:secretsmanager:eu-west-1:123456789012:secret:myapp/cert-AbCdEf'] == 'AGNlcnQ='
+        assert list(errors) == ['nope']
+        assert clients['ssm'].calls == [('get_parameters_by_path', '/myapp')] * 2
+        assert sorted(clients['secretsmanager'].calls) == sorted(list(SECRETS) + ['nope', 'nope'])
+
+        clients['ssm'].calls = []
+        assert aws.ssm_get_parameters(['/myapp/api/key'])[0] == {'/myapp/api/key': 'api-key'}
+        assert clients['ssm'].calls == []
+
+
+class TestFetch:
+    def test_json_in_place(self, tmpdir, monkeypatch):
+        fake_clients(monkeypatch)
+        source = tmpdir.join('config.json')
+        source.write(json.dumps({'Parameters': {'Existing': 'value'}}))
+        r = runner.invoke(codebuilder, [
+            'aws', 'secrets', 'fetch',
+            '--set', 'Parameters/DbPassword=/myapp/db/password',
+            '--set', 'Parameters/Token=ssm:/other/token',
+            '--set', 'Parameters/SigningKey=secretsmanager:myapp/signing-key',
+            '--path', 'Parameters/Api=/myapp/api/',
+            '--source-json-file', str(source), '--in-place'
+        ])
+        assert r.exit_code == 0
+        assert json.loads(source.read()) == {'Parameters': {
+            'Existing': 'value',
+            'DbPassword': 'db-password',
+            'Token': 'token',
+            'SigningKey': 'signing "key"',
+            'Api': {'key': 'api-key', 'url': 'https://api.example.com/?a=1&b=2'},
+        }}
+
+    def test_dotenv(self, tmpdir, monkeypatch):
+        fake_clients(monkeypatch)
+        output = tmpdir.join('.env')
+        r = runner.invoke(codebuilder, [
+            'aws', 'secrets', 'fetch', '--format', 'dotenv', '--output', str(output),
+            '--set', 'SIGNING_KEY=secretsmanager:myapp/signing-key',
+            '--set', 'CERT=arn:aws:secretsmanager:eu-west-1:123456789012:secret:myapp/cert-AbCdEf',
+            '--path', 'MYAPP=/myapp',
+        ])
+        assert r.exit_code == 0
+        assert output.read() == (
+            'CERT=AGNlcnQ=\n'
+            'MYAPP_API_KEY=api-key\n'
+            'MYAPP_API_URL="https://api.example.com/?a=1&b=2"\n'
+            'MYAPP_DB_PASSWORD=db-password\n'
+            'SIGNING_KEY="signing \\"key\\""\n'
+        )
+        assert output.stat().mode & 0o777 == 0o600
+
+    def test_nothing_written_on_failure(self, tmpdir, monkeypatch):
+        fake_clients(monkeypatch)
+        source = tmpdir.join('config.json')
+        source.write('{}')
+        r = runner.invoke(codebuilder, [
+            'aws', 'secrets', 'fetch', '--set', 'a=/myapp/db/password', '--set', 'b=/missing', '--set', 'c=secretsmanager:nope',
+            '--source-json-file', str(source), '--in-place'
+        ])
+        assert r.exit_code == 1
+        assert 'Failed to fetch b: /missing: parameter not found' in r.output
+        assert 'Failed to fetch c: nope: ' in r.output
+        assert source.read() == '{}'
+
+    def test_usage(self, monkeypatch):
+        fake_clients(monkeypatch)
+        r = runner.invoke(codebuilder, ['aws', 'secrets', 'fetch'])
+        assert r.exit_code == 2
+        r = runner.invoke(codebuilder, ['aws', 'secrets', 'fetch', '--format', 'dotenv', '--set', 'not-a-name=/x'])
+        assert r.exit_code == 2
+        assert 'Invalid variable name(s): not-a-name' in r.output
@@ -0,0 +1,78 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must stay off the startup path of commands not talking to AWS
+HEAVY_MODULES = ('boto3', 'botocore', 'dpath')
+
+# Extra cold start time (seconds) allowed on top of a bare `import click`
+STARTUP_BUDGET = float(os.getenv('CODEBUILDER_STARTUP_BUDGET', '0.25'))
+
+RUN_CLI = """
+import json, sys
+from codebuilder.cli import cli
+try:
+    cli.main(sys.argv[1:], prog_name='codebuilder')
+except SystemExit:
+    pass
+heavy = sorted(m for m in sys.modules if m.split('.')[0] in {heavy!r})
+sys.stderr.write('\\n' + json.dumps(heavy) + '\\n')
+""".format(heavy=HEAVY_MODULES)
+
+NON_AWS_COMMANDS = [
+    ['--version'],
+    ['--help'],
+    ['docker', 'get-tag', 'latest'],
+    ['docker', '--image-name', 'foo/bar', 'get-image', 'latest'],
+    ['env', '--image-name', 'foo/bar'],
+    ['github', '--help'],
+    ['aws', '--help'],
+]
+
+
+def run_python(code, args=(), env=None):
+    environ = dict(os.environ)
+    for name in ('CODEBUILD_BUILD_ID', 'CODEBUILD_INITIATOR'):
+        environ.pop(name, None)
+    environ['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, environ.get('PYTHONPATH')]))
+    environ.update(env or {})
+    start = time.time()
+    process = subprocess.Popen(
+        [sys.executable, '-c', code] + list(args),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environ
+    )
+    out, err = process.communicate()
+    return time.time() - start, out, err
+
+
+def cold_start(code, args=(), env=None, runs=3):
+    return min(run_python(code, args, env)[0] for _ in range(runs))
+
+
+def loaded_heavy_modules(args, env=None):
+    _, _, err = run_python(RUN_CLI, args, env)
+    return json.loads(err.decode('utf-8').strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize('args', NON_AWS_COMMANDS, ids=' '.join)
+def test_non_aws_commands_do_not_import_aws_sdk(args):
+    assert loaded_heavy_modules(args) == []
+
+
+def test_completion_does_not_import_aws_sdk():
+    env = {'_CODEBUILDER_COMPLETE': 'complete', 'COMP_WORDS': 'codebuilder docker get-tag ', 'COMP_CWORD': '3'}
+    assert loaded_heavy_modules([], env) == []
+
+
+@pytest.mark.parametrize('args', [['--version'], ['docker', 'get-tag', 'latest']], ids=' '.join)
+def test_cold_start_budget(args):
+    baseline = cold_start('import click')
+    elapsed = cold_start(RUN_CLI, args)
+    assert elapsed - baseline < STARTUP_BUDGET, \
+        'cold start of `codebuilder {}` took {:.3f}s over bare click import'.format(' '.join(args), elapsed - baseline)
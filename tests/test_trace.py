@@ -0,0 +1,56 @@
+from click.testing import CliRunner
+from botocore.stub import Stubber
+import boto3
+import json
+
+from codebuilder.cli import cli as codebuilder
+from codebuilder.helpers.trace import Tracer
+
+runner = CliRunner()
+
+
+def load_chrome_trace(path):
+    """Closes the appendable array the way trace viewers do"""
+    return json.loads(path.read().rstrip().rstrip(',') + ']')
+
+
+def test_trace_appends_across_invocations(tmpdir):
+    trace = tmpdir.join('trace.json')
+    for _ in range(2):
+        r = runner.invoke(codebuilder, ['--trace', str(trace), 'docker', 'get-tag', 'latest'])
+        assert r.output == 'latest\n'
+    events = load_chrome_trace(trace)
+    commands = [e for e in events if e.get('cat') == 'command']
+    assert [e['name'] for e in commands] == ['codebuilder docker get-tag'] * 2
+    assert len([e for e in events if e['ph'] == 'M']) == 2
+
+    r = runner.invoke(codebuilder, ['docker', 'get-tag', 'latest'])
+    assert len(load_chrome_trace(trace)) == len(events)
+
+
+def test_trace_summary(tmpdir):
+    trace = tmpdir.join('trace.txt')
+    r = runner.invoke(codebuilder, ['--trace', str(trace), '--trace-format', 'summary', 'docker', 'get-tag', 'latest'])
+    assert r.exit_code == 0
+    lines = trace.read().splitlines()
+    assert lines[0].split() == ['category', 'name', 'count', 'total', 'ms', 'max', 'ms']
+    assert any(line.startswith('command') for line in lines)
+
+
+def test_aws_calls_are_traced():
+    tracer = Tracer()
+    tracer.enable()
+    session = boto3.Session(region_name='eu-west-1', aws_access_key_id='a', aws_secret_access_key='b')
+    tracer.instrument_session(session)
+    client = session.client('ecr')
+    with Stubber(client) as stubber:
+        stubber.add_response('describe_repositories', {'repositories': [], 'ResponseMetadata': {'RetryAttempts': 2}})
+        stubber.add_client_error('list_images', 'RepositoryNotFoundException')
+        client.describe_repositories()
+        try:
+            client.list_images(repositoryName='missing')
+        except client.exceptions.RepositoryNotFoundException:
+            pass
+    calls = [e for e in tracer.events if e.get('cat') == 'aws']
+    assert [e['name'] for e in calls] == ['ecr.DescribeRepositories', 'ecr.ListImages']
+    assert calls[0]['args'] == {'retries': 2}